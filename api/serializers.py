@@ -43,7 +43,12 @@ class VitaminSerializer(serializers.ModelSerializer):
         return obj.get_absolute_url()
 
     def get_image_url(self, obj):
-        return obj.images.filter(is_main=True).first().image.url
+        # Prefetched by the API views, see `api.views.for_serializer`
+        if hasattr(obj, 'main_images'):
+            image = obj.main_images[0] if obj.main_images else None
+        else:
+            image = obj.images.filter(is_main=True).first()
+        return image.image.url if image else None
 
     def get_final_price(self, obj):
         return calculate_price(obj).final_price
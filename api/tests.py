@@ -1,3 +1,36 @@
+from django.core.cache import cache
+from django.db.models import Count
 from django.test import TestCase
 
-# Create your tests here.
+from vitamins.models import Brand, Category, Vitamin
+from vitamins.testing import QueryBudgetMixin, seed_catalog
+
+
+class ApiQueryBudgetTestCase(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        seed_catalog()
+        cls.brands = list(Brand.objects.annotate(products=Count('vitamins')).filter(products__gt=0)
+                          .order_by('products'))
+        cls.category = Category.objects.first()
+        cls.vitamin = Vitamin.objects.first()
+
+    def setUp(self):
+        cache.clear()
+
+    def test_lists(self):
+        # The list and, for the products, their main images
+        self.assertQueryBudget('api-categories', '/api/categories/', 1)
+        self.assertQueryBudget('api-brands', '/api/brands/', 1)
+        self.assertQueryBudget('api-category-vitamins', f'/api/categories/{self.category.pk}/vitamins/', 2)
+        self.assertQueryBudget('api-vitamins', '/api/vitamins/', 2)
+        self.assertQueryBudget('api-vitamin', f'/api/vitamins/{self.vitamin.pk}/', 2)
+
+    def test_brand_vitamins_do_not_grow_with_the_brand(self):
+        smallest, largest = self.brands[0], self.brands[-1]
+        self.assertGreater(largest.products, smallest.products * 10)
+        self.assertQueriesDoNotGrow('api-brand-vitamins', {
+            brand.products: self.assertQueryBudget('api-brand-vitamins', f'/api/brands/{brand.pk}/vitamins/',
+                                                   2)['queries']
+            for brand in (smallest, largest)
+        })
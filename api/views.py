@@ -1,9 +1,19 @@
+from django.db.models import Prefetch
 from django.shortcuts import render
 from rest_framework import viewsets
 from rest_framework.generics import ListAPIView
 
 from api.serializers import CategorySerializer, VitaminSerializer, BrandSerializer
-from vitamins.models import Category, Vitamin, Brand
+from vitamins.models import Category, Vitamin, Brand, VitaminImage
+
+
+def for_serializer(queryset):
+    """
+    Loads the brands and the main images `VitaminSerializer` reads, so a list takes the same queries for any length.
+    """
+    return queryset.select_related('brand').prefetch_related(
+        Prefetch('images', queryset=VitaminImage.objects.filter(is_main=True), to_attr='main_images')
+    )
 
 
 class CategoryViewSet(viewsets.ReadOnlyModelViewSet):
@@ -19,7 +29,7 @@ class VitaminsByCategory(ListAPIView):
 
     def get_queryset(self):
         category_id = self.kwargs['pk']
-        return Vitamin.objects.filter(cat_id=category_id).order_by('count')
+        return for_serializer(Vitamin.objects.filter(cat_id=category_id).order_by('count'))
 
 
 class BrandViewSet(viewsets.ReadOnlyModelViewSet):
@@ -35,8 +45,9 @@ class VitaminsByBrand(ListAPIView):
 
     def get_queryset(self):
         brand_id = self.kwargs['pk']
-        return Vitamin.objects.filter(brand_id=brand_id).order_by('count')
+        return for_serializer(Vitamin.objects.filter(brand_id=brand_id).order_by('count'))
+
 
 class VitaminAPIView(viewsets.ReadOnlyModelViewSet):
-    queryset = Vitamin.objects.all()
+    queryset = for_serializer(Vitamin.objects.all())
     serializer_class = VitaminSerializer
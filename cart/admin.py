@@ -5,4 +5,7 @@ from cart.models import PromoCod
 
 @admin.register(PromoCod)
 class PromoCodAdmin(admin.ModelAdmin):
-    list_display = ('code', 'is_active', 'discount', 'min_sum')
+    list_display = ('code', 'is_active', 'discount', 'min_sum', 'valid_from', 'valid_until',
+                    'usage_limit', 'per_user_limit', 'used_count')
+    filter_horizontal = ('brands', 'categories')
+    readonly_fields = ('used_count',)
@@ -0,0 +1,231 @@
+import hashlib
+import json
+
+from vitamins.pricing import get_pricing_version
+
+SHIPPING_COST = 200
+
+CUSTOMER_FIELDS = {
+    'last_name': 'lastname',
+    'first_name': 'firstname',
+    'email': 'email',
+    'phone_number': 'phone',
+    'comment': 'comment',
+}
+
+MAIL_CUSTOMER_FIELDS = {
+    'middle_name': 'middle_name',
+    'region': 'region',
+    'city': 'city',
+    'address': 'street',
+    'postal_code': 'zip',
+}
+
+# A draft line is stored as a list of these values, which keeps a large cart compact in the session
+LINE_FIELDS = ('product_id', 'quantity', 'final_price', 'sale_price', 'discount', 'sum')
+
+
+def set_session_value(session, key, value):
+    """
+    Sets a session value only if it differs from the stored one, so an unchanged session is not written back.
+    """
+    if key not in session or session[key] != value:
+        session[key] = value
+
+
+def cart_signature(cart_queryset, promo_code=None) -> str:
+    """
+    Returns a hash of the cart lines and of every product field the line price depends on.
+
+    Uses a single lightweight query, so it is cheap enough to run on every checkout step.
+    """
+    lines = list(cart_queryset.order_by('product_id').values_list(
+        'product_id', 'quantity', 'product__price', 'product__discount', 'product__percent', 'product__weight'
+    ))
+    payload = json.dumps([lines, promo_code or ''], default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class CheckoutDraft:
+    """
+    A serialized snapshot of the cart carried through the checkout steps.
+
+    Holds cart lines with their prices, the applied promo code, the delivery option,
+    customer data and the payment type under a single session key. The draft is protected
+    by a content hash and remembers the cart signature and pricing version it was built
+    with, so it is recalculated only when the cart or pricing has changed.
+
+    The lines are stored as lists of `LINE_FIELDS` values, and the session is written
+    only when the content hash of the draft has changed.
+    """
+    session_key = 'checkout_draft'
+
+    def __init__(self, data=None, session_key=None):
+        self.session_key = session_key or self.session_key
+        self.data = data or {
+            'lines': [],
+            'total_price': 0,
+            'total_price_without_discount': 0,
+            'discount': 0,
+            'code_name': '',
+            'delivery_option': None,
+            'customer': {},
+            'type_payment': None,
+            'signature': None,
+            'pricing_version': None,
+        }
+
+    @staticmethod
+    def content_hash(data: dict) -> str:
+        payload = json.dumps({k: v for k, v in data.items() if k != 'hash'}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    @classmethod
+    def load(cls, session, session_key=None):
+        """
+        Loads the draft from the session. Returns an empty draft if it is missing or was tampered with.
+        """
+        draft = cls(session_key=session_key)
+        data = session.get(draft.session_key)
+        if data and data.get('hash') == cls.content_hash(data):
+            draft.data = data
+            # Drafts saved before the lines were compacted
+            if any(isinstance(line, dict) for line in data['lines']):
+                data['lines'] = [[line[field] for field in LINE_FIELDS] if isinstance(line, dict) else line
+                                 for line in data['lines']]
+        return draft
+
+    def save(self, session):
+        # The loaded data is the session's own dict, so the stored hash is compared before it is replaced
+        content_hash = self.content_hash(self.data)
+        stored = session.get(self.session_key)
+        if stored is not None and stored.get('hash') == content_hash:
+            return
+        self.data['hash'] = content_hash
+        session[self.session_key] = self.data
+
+    def clear(self, session):
+        session.pop(self.session_key, None)
+
+    def is_fresh(self, signature: str, pricing_version: str) -> bool:
+        return bool(self.data['lines']) and \
+            self.data['signature'] == signature and self.data['pricing_version'] == pricing_version
+
+    def set_cart(self, cart_items, total_price, total_price_without_discount, discount, code_name,
+                 signature, pricing_version):
+        """
+        Replaces the cart part of the draft with freshly calculated lines,
+        keeping the delivery option, customer data and payment type.
+        """
+        self.data['lines'] = [[
+            item.product_id,
+            item.quantity,
+            item.product.final_price,
+            getattr(item.product, 'sale_price', None),
+            item.product.discount,
+            item.product.sum,
+        ] for item in cart_items]
+        self.data['total_price'] = total_price
+        self.data['total_price_without_discount'] = total_price_without_discount
+        self.data['discount'] = discount
+        self.data['code_name'] = code_name
+        self.data['signature'] = signature
+        self.data['pricing_version'] = pricing_version
+
+    def apply_to(self, cart_items):
+        """
+        Sets the prices stored in the draft on the products of the given cart items.
+        """
+        lines = {line['product_id']: line for line in self.lines}
+        for item in cart_items:
+            line = lines.get(item.product_id)
+            if line is None:
+                continue
+            item.product.final_price = line['final_price']
+            item.product.discount = line['discount']
+            item.product.sum = line['sum']
+            if line['sale_price'] is not None:
+                item.product.sale_price = line['sale_price']
+        return cart_items
+
+    def set_delivery_option(self, delivery_option):
+        self.data['delivery_option'] = delivery_option
+
+    def set_customer(self, post):
+        """
+        Saves the recipient's data from the checkout form.
+        """
+        fields = dict(CUSTOMER_FIELDS)
+        if self.delivery_option == 'mail':
+            fields.update(MAIL_CUSTOMER_FIELDS)
+        self.data['customer'] = {name: post.get(form_field) for name, form_field in fields.items()}
+
+    def set_type_payment(self, type_payment):
+        self.data['type_payment'] = type_payment
+
+    @property
+    def lines(self) -> list[dict]:
+        return [dict(zip(LINE_FIELDS, line)) for line in self.data['lines']]
+
+    @property
+    def delivery_option(self):
+        return self.data['delivery_option']
+
+    @property
+    def customer(self):
+        return self.data['customer']
+
+    @property
+    def type_payment(self):
+        return self.data['type_payment']
+
+    @property
+    def code_name(self):
+        return self.data['code_name']
+
+    @property
+    def shipping_cost(self):
+        return SHIPPING_COST if self.delivery_option == 'mail' else 0
+
+    @property
+    def total_price(self):
+        return self.data['total_price'] + self.shipping_cost
+
+    @property
+    def total_price_without_discount(self):
+        return self.data['total_price_without_discount']
+
+    @property
+    def discount(self):
+        return self.data['discount']
+
+    def context(self) -> dict:
+        return {
+            'total_price': self.total_price,
+            'total_price_without_discount': self.total_price_without_discount,
+            'discount': self.discount,
+            'code_name': self.code_name,
+            'delivery_option': self.delivery_option,
+        }
+
+
+def get_checkout_draft(request, cart_queryset, calculator, session_key=None) -> CheckoutDraft:
+    """
+    Returns the checkout draft for the current cart.
+
+    The draft stored in the session is reused as long as the cart lines, product prices,
+    promo code and pricing version are unchanged. Otherwise the cart is recalculated with
+    the given calculator, which must return the same tuple as `cart.views.calculator_cart`.
+    """
+    promo_code = request.session.get('promo_code')
+    pricing_version = get_pricing_version()
+    draft = CheckoutDraft.load(request.session, session_key)
+    if draft.is_fresh(cart_signature(cart_queryset, promo_code), pricing_version):
+        return draft
+
+    cart_items, total_price, total_price_without_discount, discount, code_name = calculator(request)
+    # The calculator may correct quantities, so the signature is taken after it ran
+    draft.set_cart(cart_items, total_price, total_price_without_discount, discount, code_name,
+                   cart_signature(cart_queryset, promo_code), pricing_version)
+    draft.save(request.session)
+    return draft
@@ -1,8 +1,5 @@
-from .models import Cart
+from .storage import get_cart_storage
 
 
 def cart_processor(request):
-    if request.user.is_authenticated:
-        cart_items_count = Cart.objects.filter(user=request.user).count()
-        return {'cart_items_count': cart_items_count}
-    return {'cart_items_count': 0}
+    return {'cart_items_count': get_cart_storage(request).count()}
@@ -0,0 +1,84 @@
+import time
+from importlib import import_module
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from cart.checkout import LINE_FIELDS, CheckoutDraft
+
+CUSTOMER = {'lastname': 'Иванов', 'firstname': 'Иван', 'email': 'ivan@example.com', 'phone': '+79990000000',
+            'comment': ''}
+
+# (name, session engine, compact draft saved only when changed)
+SCENARIOS = (
+    ('before', 'django.contrib.sessions.backends.db', False),
+    ('after', 'django.contrib.sessions.backends.cached_db', True),
+)
+
+
+def legacy_data(data: dict) -> dict:
+    """
+    Returns the draft in the layout used before the lines were compacted, with a line per dict.
+    """
+    return {**data, 'lines': [dict(zip(LINE_FIELDS, line)) for line in data['lines']]}
+
+
+class Command(BaseCommand):
+    help = 'Measures the session cost of a checkout request: the time, the SQL queries and the session writes ' \
+           'with the database sessions and the old draft layout (before) and with the cached sessions ' \
+           'and the compact draft saved only when changed (after). Sessions are created and deleted ' \
+           'in the configured database and cache.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='checkout requests per scenario')
+        parser.add_argument('--lines', type=int, default=30, help='cart lines in the checkout draft')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'{"scenario":<8} {"engine":<45} {"ms/request":>10} {"queries/request":>16} '
+                          f'{"writes":>7} {"bytes":>7}')
+        for name, engine, compact in SCENARIOS:
+            result = self.run_scenario(import_module(engine).SessionStore, compact, options['requests'],
+                                       options['lines'])
+            self.stdout.write(f'{name:<8} {engine:<45} {result["ms"]:>10.3f} {result["queries"]:>16.2f} '
+                              f'{result["writes"]:>7} {result["bytes"]:>7}')
+
+    @staticmethod
+    def run_scenario(session_store, compact: bool, requests: int, lines: int) -> dict:
+        """
+        Replays the checkout steps over one session, every request loading the session,
+        updating the draft the way the step view does and saving the session if it was modified.
+        """
+        draft = CheckoutDraft()
+        draft.data['lines'] = [[pk, 1, 1000, None, 0, 1000] for pk in range(1, lines + 1)]
+        session = session_store()
+        draft.save(session)
+        session.save()
+        steps = [
+            lambda draft: draft.set_delivery_option('pickup'),
+            lambda draft: draft.set_customer(CUSTOMER),
+            lambda draft: draft.set_type_payment('cash'),
+            lambda draft: None,
+        ]
+
+        writes = 0
+        started = time.perf_counter()
+        with CaptureQueriesContext(connection) as queries:
+            for number in range(requests):
+                session = session_store(session.session_key)
+                draft = CheckoutDraft.load(session)
+                steps[number % len(steps)](draft)
+                if compact:
+                    draft.save(session)
+                else:
+                    data = legacy_data(draft.data)
+                    data['hash'] = CheckoutDraft.content_hash(data)
+                    session[draft.session_key] = data
+                if session.modified:
+                    session.save()
+                    writes += 1
+        elapsed = time.perf_counter() - started
+
+        size = len(session.encode(session._get_session()))
+        session.delete()
+        return {'ms': elapsed * 1000 / requests, 'queries': len(queries) / requests, 'writes': writes, 'bytes': size}
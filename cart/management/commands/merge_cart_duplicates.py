@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from cart.models import Cart
+from cart.mutations import merge_duplicate_lines
+from preorders.models import PreOrderCart
+
+
+class Command(BaseCommand):
+    help = 'Merges duplicate (user, product) lines of carts and preorder carts. ' \
+           'Run it before applying the unique (user, product) constraints.'
+
+    def handle(self, *args, **options):
+        for model in (Cart, PreOrderCart):
+            deleted = merge_duplicate_lines(model)
+            self.stdout.write(f'{model._meta.verbose_name}: merged {deleted} duplicate lines')
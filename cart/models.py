@@ -15,6 +15,9 @@ class Cart(models.Model):
 
     class Meta:
         ordering = ['time_added']
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'product'], name='unique_cart_user_product'),
+        ]
 
     def __str__(self):
         return f"{self.quantity} x {self.product}"
@@ -28,6 +31,30 @@ class PromoCod(models.Model):
     is_active = models.BooleanField(default=False)
     discount = models.IntegerField(default=0)
     min_sum = models.IntegerField(default=0)
+    brands = models.ManyToManyField('vitamins.Brand', blank=True, related_name='promo_codes',
+                                    help_text='Скидка действует только на товары этих брендов')
+    categories = models.ManyToManyField('vitamins.Category', blank=True, related_name='promo_codes',
+                                        help_text='Скидка действует только на товары этих категорий')
+    valid_from = models.DateTimeField(blank=True, null=True)
+    valid_until = models.DateTimeField(blank=True, null=True)
+    usage_limit = models.PositiveIntegerField(blank=True, null=True, help_text='Сколько раз всего можно использовать')
+    per_user_limit = models.PositiveIntegerField(blank=True, null=True,
+                                                 help_text='Сколько раз может использовать один пользователь')
+    used_count = models.IntegerField(default=0)
 
     def __str__(self):
         return self.code
+
+
+class PromoCodUsage(models.Model):
+    promo_code = models.ForeignKey(PromoCod, on_delete=models.CASCADE, related_name='usages')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['promo_code', 'user'], name='unique_promo_code_usage'),
+        ]
+
+    def __str__(self):
+        return f"{self.promo_code} x {self.count}"
@@ -0,0 +1,84 @@
+from django.db import connection, transaction
+from django.db.models import Count, F, Min, Sum
+from django.utils import timezone
+
+from vitamins.models import Vitamin
+
+
+def add_cart_line(model, user_id: int, product_id: int, quantity: int = 1, limit_to_stock: bool = False):
+    """
+    Adds a quantity of a product to a cart line with a single
+    INSERT ... ON CONFLICT (user, product) DO UPDATE statement.
+
+    With `limit_to_stock` the line is neither created nor increased beyond `Vitamin.count`.
+    Works for any cart model with a unique (user, product) constraint.
+
+    Returns:
+        int | None: The new line quantity, or None if the product does not exist or there is not enough stock.
+    """
+    qn = connection.ops.quote_name
+    table = qn(model._meta.db_table)
+    vitamin_table = qn(Vitamin._meta.db_table)
+    stock_filter = stock_condition = ''
+    params = [user_id, quantity, timezone.now(), product_id]
+    if limit_to_stock:
+        stock_filter = f'AND v.{qn("count")} >= %s'
+        stock_condition = (f'WHERE {table}.{qn("quantity")} + EXCLUDED.{qn("quantity")} <= '
+                           f'(SELECT {qn("count")} FROM {vitamin_table} WHERE {qn("id")} = EXCLUDED.{qn("product_id")})')
+        params.append(quantity)
+
+    sql = (
+        f'INSERT INTO {table} ({qn("user_id")}, {qn("product_id")}, {qn("quantity")}, {qn("time_added")}) '
+        f'SELECT %s, v.{qn("id")}, %s, %s FROM {vitamin_table} v WHERE v.{qn("id")} = %s {stock_filter} '
+        f'ON CONFLICT ({qn("user_id")}, {qn("product_id")}) DO UPDATE '
+        f'SET {qn("quantity")} = {table}.{qn("quantity")} + EXCLUDED.{qn("quantity")} {stock_condition} '
+        f'RETURNING {qn("quantity")}'
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def subtract_cart_line(model, user_id: int, product_id: int, quantity: int = 1) -> bool:
+    """
+    Decreases a cart line with a single UPDATE, never below 1.
+
+    Returns:
+        bool: True if the line was decreased.
+    """
+    return bool(model.objects.filter(user_id=user_id, product_id=product_id, quantity__gt=quantity)
+                .update(quantity=F('quantity') - quantity))
+
+
+def set_cart_line(model, user_id: int, product_id: int, quantity: int, limit_to_stock: bool = False) -> bool:
+    """
+    Sets the quantity of an existing cart line with a single UPDATE.
+
+    Returns:
+        bool: True if the line exists and, with `limit_to_stock`, the product has enough stock.
+    """
+    queryset = model.objects.filter(user_id=user_id, product_id=product_id)
+    if limit_to_stock:
+        queryset = queryset.filter(product__count__gte=quantity)
+    return bool(queryset.update(quantity=quantity))
+
+
+def merge_duplicate_lines(model) -> int:
+    """
+    Merges cart lines with the same user and product into the oldest one, summing the quantities.
+    Must be run before the unique (user, product) constraint is applied to an existing database.
+
+    Returns:
+        int: The number of deleted duplicate lines.
+    """
+    duplicates = (model.objects.values('user_id', 'product_id')
+                  .annotate(lines=Count('id'), total=Sum('quantity'), keep=Min('id'))
+                  .filter(lines__gt=1))
+    deleted = 0
+    with transaction.atomic():
+        for duplicate in duplicates:
+            model.objects.filter(pk=duplicate['keep']).update(quantity=duplicate['total'])
+            deleted += model.objects.filter(user_id=duplicate['user_id'], product_id=duplicate['product_id']) \
+                .exclude(pk=duplicate['keep']).delete()[0]
+    return deleted
@@ -0,0 +1,307 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from vitamins.pricing import get_pricing_version
+from .models import PromoCod, PromoCodUsage
+from .storage import get_redis
+
+
+class PromoRule:
+    """
+    A read-only snapshot of a promo code with its scope, validity window and usage limits.
+
+    Rules are cached as a code-to-rule map, see `get_promo_rules`. Usage counters are not part
+    of the rule, they are kept by the configured `PROMO_COUNTER_BACKEND`.
+    """
+
+    def __init__(self, id, code, is_active, discount, min_sum, valid_from=None, valid_until=None,
+                 usage_limit=None, per_user_limit=None, brand_ids=(), category_ids=()):
+        self.id = id
+        self.code = code
+        self.is_active = is_active
+        self.discount = discount
+        self.min_sum = min_sum
+        self.valid_from = valid_from
+        self.valid_until = valid_until
+        self.usage_limit = usage_limit
+        self.per_user_limit = per_user_limit
+        self.brand_ids = frozenset(brand_ids)
+        self.category_ids = frozenset(category_ids)
+
+    @classmethod
+    def from_promo_code(cls, promo_code: PromoCod):
+        return cls(
+            id=promo_code.pk,
+            code=promo_code.code,
+            is_active=promo_code.is_active,
+            discount=promo_code.discount,
+            min_sum=promo_code.min_sum,
+            valid_from=promo_code.valid_from,
+            valid_until=promo_code.valid_until,
+            usage_limit=promo_code.usage_limit,
+            per_user_limit=promo_code.per_user_limit,
+            brand_ids=[brand.pk for brand in promo_code.brands.all()],
+            category_ids=[category.pk for category in promo_code.categories.all()],
+        )
+
+    def is_valid_at(self, moment) -> bool:
+        return self.is_active and \
+            (self.valid_from is None or self.valid_from <= moment) and \
+            (self.valid_until is None or moment <= self.valid_until)
+
+    def applies_to(self, product) -> bool:
+        """
+        Checks if the discount applies to the product. A rule without brands and categories applies to all products.
+        """
+        if self.brand_ids and product.brand_id not in self.brand_ids:
+            return False
+        if self.category_ids and product.cat_id not in self.category_ids:
+            return False
+        return True
+
+    @property
+    def has_limits(self) -> bool:
+        return self.usage_limit is not None or self.per_user_limit is not None
+
+
+def get_promo_rules() -> dict:
+    """
+    Returns the map of promo codes to their rules.
+
+    The map is cached under the current pricing version, which changes every time
+    a promo code or its scope is saved, see `cart.signals`.
+    """
+    def load():
+        promo_codes = PromoCod.objects.prefetch_related('brands', 'categories')
+        return {promo_code.code: PromoRule.from_promo_code(promo_code) for promo_code in promo_codes}
+
+    return cache.get_or_set(f'promo_rules:{get_pricing_version()}', load, 60 * 60)
+
+
+def get_promo_rule(code: str) -> PromoRule | None:
+    return get_promo_rules().get(code)
+
+
+def check_promo_rule(rule: PromoRule | None, code: str, cart_items, user=None) -> str | None:
+    """
+    Checks if the promo rule can be applied to the cart items, whose products must have prices calculated.
+
+    Returns:
+        str | None: The reason the promo code can not be applied, or None if it can.
+    """
+    if rule is None:
+        return "Не верный промокод!!!"
+
+    if not rule.is_valid_at(timezone.now()):
+        return f"Промокод '{code}' не активен!!!"
+
+    if not any(rule.applies_to(item.product) for item in cart_items):
+        return f"Промокод '{code}' не действует на товары в вашей корзине."
+
+    total_cart_price = sum(item.quantity * item.product.final_price for item in cart_items)
+    if rule.min_sum and rule.min_sum > total_cart_price:
+        return f"Общая сумма корзины должна быть не менее {rule.min_sum}, чтобы применить промокод."
+
+    if rule.has_limits:
+        if rule.per_user_limit is not None and not (user and user.is_authenticated):
+            return f"Войдите в аккаунт, чтобы применить промокод '{code}'."
+        total, used = get_promo_counter().usage(rule, user.pk if user else None)
+        if rule.usage_limit is not None and total >= rule.usage_limit:
+            return f"Промокод '{code}' больше не действует."
+        if rule.per_user_limit is not None and used >= rule.per_user_limit:
+            return f"Вы уже использовали промокод '{code}'."
+    return None
+
+
+class PromoLimitReached(Exception):
+    pass
+
+
+class BasePromoCounter:
+    """
+    Counts redemptions of promo codes with usage limits.
+    """
+
+    def usage(self, rule: PromoRule, user_id: int | None) -> tuple:
+        """
+        Returns the total number of redemptions and the number of redemptions by the user.
+        """
+        raise NotImplementedError
+
+    def redeem(self, rule: PromoRule, user_id: int) -> bool:
+        """
+        Atomically counts one redemption if neither the total nor the per-user limit is reached.
+
+        Returns:
+            bool: True if the redemption was counted.
+        """
+        raise NotImplementedError
+
+    def release(self, rule: PromoRule, user_id: int):
+        """
+        Undoes a redemption whose order was not created.
+
+        Database counters are rolled back together with the order transaction,
+        so only counters kept outside the database need it.
+        """
+
+    def flush(self):
+        """
+        Persists pending counters to the database. Only write-behind counters have any.
+        """
+
+
+class DatabasePromoCounter(BasePromoCounter):
+    """
+    Keeps the counters in `PromoCod.used_count` and `PromoCodUsage`, updated with conditional UPDATE statements.
+    """
+
+    def usage(self, rule, user_id):
+        total = PromoCod.objects.filter(pk=rule.id).values_list('used_count', flat=True).first() or 0
+        used = 0
+        if user_id is not None:
+            used = PromoCodUsage.objects.filter(promo_code_id=rule.id, user_id=user_id) \
+                       .values_list('count', flat=True).first() or 0
+        return total, used
+
+    def redeem(self, rule, user_id):
+        try:
+            with transaction.atomic():
+                promo_codes = PromoCod.objects.filter(pk=rule.id)
+                if rule.usage_limit is not None:
+                    promo_codes = promo_codes.filter(used_count__lt=rule.usage_limit)
+                if not promo_codes.update(used_count=F('used_count') + 1):
+                    raise PromoLimitReached
+
+                PromoCodUsage.objects.get_or_create(promo_code_id=rule.id, user_id=user_id)
+                usages = PromoCodUsage.objects.filter(promo_code_id=rule.id, user_id=user_id)
+                if rule.per_user_limit is not None:
+                    usages = usages.filter(count__lt=rule.per_user_limit)
+                if not usages.update(count=F('count') + 1):
+                    raise PromoLimitReached
+        except PromoLimitReached:
+            return False
+        return True
+
+
+class RedisPromoCounter(BasePromoCounter):
+    """
+    Keeps the counters in a Redis hash per promo code, so concurrent redemptions during a flash
+    promotion do not lock the promo code row. The limits are enforced by a Lua script.
+
+    Counters are written behind to the database by the `cart.tasks.flush_promo_counters` periodic task.
+    """
+    DIRTY_SET = 'promo_usage:dirty'
+    TOTAL_FIELD = 'total'
+
+    @staticmethod
+    def key(promo_id: int) -> str:
+        return f'promo_usage:{promo_id}'
+
+    @staticmethod
+    def user_field(user_id: int | None) -> str:
+        return f'user:{user_id or 0}'
+
+    def usage(self, rule, user_id):
+        total, used = get_redis().hmget(self.key(rule.id), self.TOTAL_FIELD, self.user_field(user_id))
+        if total is None or used is None:
+            return DatabasePromoCounter().usage(rule, user_id)
+        return int(total), int(used)
+
+    def redeem(self, rule, user_id):
+        redis = get_redis()
+        key = self.key(rule.id)
+        # The counters are seeded from the database the first time a promo code or a user shows up
+        total, used = redis.hmget(key, self.TOTAL_FIELD, self.user_field(user_id))
+        if total is None or used is None:
+            total, used = DatabasePromoCounter().usage(rule, user_id)
+        limits = [-1 if limit is None else limit for limit in (rule.usage_limit, rule.per_user_limit)]
+        return bool(redis.eval(REDEEM_PROMO, 2, key, self.DIRTY_SET,
+                               self.user_field(user_id), *limits, total, used))
+
+    def release(self, rule, user_id):
+        pipeline = get_redis().pipeline()
+        pipeline.hincrby(self.key(rule.id), self.TOTAL_FIELD, -1)
+        pipeline.hincrby(self.key(rule.id), self.user_field(user_id), -1)
+        pipeline.sadd(self.DIRTY_SET, self.key(rule.id))
+        pipeline.execute()
+
+    def flush(self) -> int:
+        """
+        Writes the counters of the promo codes redeemed since the previous flush to the database.
+
+        Returns:
+            int: The number of flushed promo codes.
+        """
+        redis = get_redis()
+        flushed = 0
+        while (key := redis.spop(self.DIRTY_SET)) is not None:
+            promo_id = int(key.rsplit(':', 1)[1])
+            counters = redis.hgetall(key)
+            total = int(counters.pop(self.TOTAL_FIELD, 0))
+            with transaction.atomic():
+                if not PromoCod.objects.filter(pk=promo_id).update(used_count=total):
+                    redis.delete(key)
+                    continue
+                PromoCodUsage.objects.bulk_create(
+                    [PromoCodUsage(promo_code_id=promo_id, user_id=int(field.split(':')[1]), count=int(count))
+                     for field, count in counters.items() if field != self.user_field(None)],
+                    update_conflicts=True, unique_fields=['promo_code', 'user'], update_fields=['count'],
+                )
+            flushed += 1
+        return flushed
+
+
+# Increments both counters only if neither limit (-1 = no limit) is reached. Missing counters start from the seeds.
+# KEYS: usage hash, dirty set. ARGV: user field, total limit, user limit, total seed, user seed.
+REDEEM_PROMO = """
+local total = tonumber(redis.call('HGET', KEYS[1], 'total') or ARGV[4])
+local used = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or ARGV[5])
+local total_limit = tonumber(ARGV[2])
+local user_limit = tonumber(ARGV[3])
+if (total_limit >= 0 and total >= total_limit) or (user_limit >= 0 and used >= user_limit) then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'total', total + 1, ARGV[1], used + 1)
+redis.call('SADD', KEYS[2], KEYS[1])
+return 1
+"""
+
+
+def get_promo_counter() -> BasePromoCounter:
+    return import_string(settings.PROMO_COUNTER_BACKEND)()
+
+
+class PromoRedemption:
+    """
+    Counts the promo code redemptions of an order and undoes them if the order is not committed.
+
+    Wrap the outermost transaction of the order in it and call `redeem` inside the transaction:
+    database counters are then updated and rolled back together with the order, and counters kept
+    outside the database are released when the block raises, the failed commit included.
+    Blocks using the same redemption can be nested, the redemptions are released once.
+    """
+
+    def __init__(self, counter: BasePromoCounter | None = None):
+        self.counter = counter or get_promo_counter()
+        self.redeemed = []
+
+    def redeem(self, rule: PromoRule, user_id: int) -> bool:
+        if not self.counter.redeem(rule, user_id):
+            return False
+        self.redeemed.append((rule, user_id))
+        return True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            redeemed, self.redeemed = self.redeemed, []
+            for rule, user_id in redeemed:
+                self.counter.release(rule, user_id)
+        return False
@@ -0,0 +1,35 @@
+from django.contrib.auth.signals import user_logged_in
+from django.db.models.signals import m2m_changed, post_save, post_delete
+from django.dispatch import receiver
+
+from cart.models import Cart, PromoCod
+from cart.storage import SessionCartStorage, get_user_cart_storage
+from preorders.models import PreOrderCart
+from vitamins.pricing import bump_pricing_version
+
+
+@receiver([post_save, post_delete], sender=PromoCod)
+def promo_code_changed(sender, instance, **kwargs):
+    bump_pricing_version()
+
+
+@receiver(m2m_changed, sender=PromoCod.brands.through)
+@receiver(m2m_changed, sender=PromoCod.categories.through)
+def promo_code_scope_changed(sender, action, **kwargs):
+    if action.startswith('post_'):
+        bump_pricing_version()
+
+
+@receiver(user_logged_in)
+def merge_session_carts(sender, request, user, **kwargs):
+    """
+    Moves the carts collected by an anonymous user into the user's carts on login.
+    """
+    if request is None or not hasattr(request, 'session'):
+        return
+    for model in (Cart, PreOrderCart):
+        session_storage = SessionCartStorage(request.session, model)
+        items = session_storage.items()
+        if items:
+            get_user_cart_storage(user, model).merge(items)
+            session_storage.clear()
@@ -0,0 +1,410 @@
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from cart.models import Cart
+from cart.mutations import add_cart_line, subtract_cart_line, set_cart_line
+from vitamins.models import Vitamin
+
+
+class BaseCartStorage:
+    """
+    Stores the lines of a cart as a mapping of product id to quantity.
+
+    Works over any cart model with `user`, `product` and `quantity` fields
+    (`cart.models.Cart` and `preorders.models.PreOrderCart`).
+    """
+
+    def __init__(self, model=Cart):
+        self.model = model
+
+    def items(self) -> dict:
+        raise NotImplementedError
+
+    def get(self, product_id: int) -> int:
+        return self.items().get(product_id, 0)
+
+    def add(self, product_id: int, quantity: int = 1, limit_to_stock: bool = False):
+        """
+        Adds a quantity of a product to the cart, never beyond the stock with `limit_to_stock`.
+
+        Returns:
+            int | None: The new line quantity, or None if the product does not exist or there is not enough stock.
+        """
+        raise NotImplementedError
+
+    def subtract(self, product_id: int, quantity: int = 1) -> bool:
+        """
+        Decreases a cart line, never below 1. Returns True if the line was decreased.
+        """
+        raise NotImplementedError
+
+    def set(self, product_id: int, quantity: int, limit_to_stock: bool = False) -> bool:
+        """
+        Sets the quantity of an existing cart line. Returns True if the line was updated.
+        """
+        raise NotImplementedError
+
+    def remove(self, product_id: int) -> bool:
+        """
+        Deletes a cart line. Returns True if the line was in the cart.
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def count(self) -> int:
+        return len(self.items())
+
+    def merge(self, items: dict):
+        """
+        Adds the quantities of the given lines to the cart.
+        """
+        for product_id, quantity in items.items():
+            self.add(product_id, quantity)
+
+    def flush(self):
+        """
+        Persists pending changes to the database. Only write-behind storages have any.
+        """
+
+    def cart_items(self):
+        """
+        Returns cart model instances with products, brands and images loaded, ready for price calculation.
+        """
+        raise NotImplementedError
+
+
+class DatabaseCartStorage(BaseCartStorage):
+    """
+    Keeps the cart of a logged-in user in the cart model table.
+    """
+
+    def __init__(self, user, model=Cart):
+        super().__init__(model)
+        self.user = user
+
+    @property
+    def queryset(self):
+        return self.model.objects.filter(user=self.user)
+
+    def items(self) -> dict:
+        return dict(self.queryset.values_list('product_id', 'quantity'))
+
+    def get(self, product_id: int) -> int:
+        return self.queryset.filter(product_id=product_id).values_list('quantity', flat=True).first() or 0
+
+    def add(self, product_id: int, quantity: int = 1, limit_to_stock: bool = False):
+        return add_cart_line(self.model, self.user.pk, product_id, quantity, limit_to_stock)
+
+    def subtract(self, product_id: int, quantity: int = 1) -> bool:
+        return subtract_cart_line(self.model, self.user.pk, product_id, quantity)
+
+    def set(self, product_id: int, quantity: int, limit_to_stock: bool = False) -> bool:
+        return set_cart_line(self.model, self.user.pk, product_id, quantity, limit_to_stock)
+
+    def remove(self, product_id: int) -> bool:
+        deleted, _ = self.queryset.filter(product_id=product_id).delete()
+        return deleted > 0
+
+    def clear(self):
+        self.queryset.delete()
+
+    def count(self) -> int:
+        return self.queryset.count()
+
+    def merge(self, items: dict):
+        persist_cart(self.model, self.user.pk, items, add=True)
+
+    def cart_items(self):
+        return self.queryset.select_related('product__brand').prefetch_related('product__images')
+
+
+class SessionCartStorage(BaseCartStorage):
+    """
+    Keeps the cart of an anonymous user in the session. It is merged into
+    the user's cart on login, see `cart.signals.merge_session_carts`.
+    """
+
+    def __init__(self, session, model=Cart):
+        super().__init__(model)
+        self.session = session
+        self.session_key = f'{model._meta.model_name}_items'
+
+    def items(self) -> dict:
+        return {int(product_id): quantity for product_id, quantity in self.session.get(self.session_key, {}).items()}
+
+    def _save(self, items: dict):
+        self.session[self.session_key] = {str(product_id): quantity for product_id, quantity in items.items()}
+
+    def add(self, product_id: int, quantity: int = 1, limit_to_stock: bool = False):
+        stock = get_stock(product_id)
+        items = self.items()
+        new_quantity = items.get(product_id, 0) + quantity
+        if stock is None or (limit_to_stock and new_quantity > stock):
+            return None
+        items[product_id] = new_quantity
+        self._save(items)
+        return new_quantity
+
+    def subtract(self, product_id: int, quantity: int = 1) -> bool:
+        items = self.items()
+        if items.get(product_id, 0) <= quantity:
+            return False
+        items[product_id] -= quantity
+        self._save(items)
+        return True
+
+    def set(self, product_id: int, quantity: int, limit_to_stock: bool = False) -> bool:
+        items = self.items()
+        if product_id not in items or (limit_to_stock and quantity > (get_stock(product_id) or 0)):
+            return False
+        items[product_id] = quantity
+        self._save(items)
+        return True
+
+    def remove(self, product_id: int) -> bool:
+        items = self.items()
+        if items.pop(product_id, None) is None:
+            return False
+        self._save(items)
+        return True
+
+    def clear(self):
+        self.session.pop(self.session_key, None)
+
+    def cart_items(self):
+        items = self.items()
+        products = Vitamin.objects.filter(pk__in=items).select_related('brand').prefetch_related('images').in_bulk()
+        return [self.model(product=products[product_id], quantity=quantity)
+                for product_id, quantity in items.items() if product_id in products]
+
+
+class RedisCartStorage(DatabaseCartStorage):
+    """
+    Keeps the hot cart of a logged-in user in a Redis hash of product id to quantity.
+
+    Cart clicks and badge counts only touch Redis. Changes are written behind to the
+    database by the `cart.tasks.flush_cart_storages` periodic task, and synchronously
+    before anything reads the cart rows (cart page, checkout, order creation).
+    """
+    DIRTY_SET = 'cart_storage:dirty'
+    LOADED_FIELD = 'loaded'
+
+    def __init__(self, user, model=Cart):
+        super().__init__(user, model)
+        self.redis = get_redis()
+        self.key = self.make_key(model, user.pk)
+
+    @staticmethod
+    def make_key(model, user_id) -> str:
+        return f'cart_storage:{model._meta.label_lower}:{user_id}'
+
+    def _load(self):
+        """
+        Copies the cart rows into Redis the first time the cart is touched.
+        """
+        if self.redis.hexists(self.key, self.LOADED_FIELD):
+            return
+        pipe = self.redis.pipeline()
+        # HSETNX does not overwrite lines added concurrently by another request
+        for product_id, quantity in DatabaseCartStorage.items(self).items():
+            pipe.hsetnx(self.key, product_id, quantity)
+        pipe.hset(self.key, self.LOADED_FIELD, 1)
+        pipe.expire(self.key, settings.CART_REDIS_TTL)
+        pipe.execute()
+
+    def _changed(self, pipe) -> list:
+        pipe.sadd(self.DIRTY_SET, self.key)
+        pipe.expire(self.key, settings.CART_REDIS_TTL)
+        return pipe.execute()
+
+    def items(self) -> dict:
+        self._load()
+        return {int(product_id): int(quantity) for product_id, quantity in self.redis.hgetall(self.key).items()
+                if product_id != self.LOADED_FIELD}
+
+    def get(self, product_id: int) -> int:
+        self._load()
+        return int(self.redis.hget(self.key, product_id) or 0)
+
+    def _bounded_increment(self, product_id: int, quantity: int, minimum: int, maximum: int):
+        self._load()
+        result = self.redis.eval(BOUNDED_HINCRBY, 1, self.key, product_id, quantity, minimum, maximum)
+        if result is None:
+            return None
+        self._changed(self.redis.pipeline())
+        return int(result)
+
+    def add(self, product_id: int, quantity: int = 1, limit_to_stock: bool = False):
+        stock = get_stock(product_id)
+        if stock is None:
+            return None
+        return self._bounded_increment(product_id, quantity, 1, stock if limit_to_stock else -1)
+
+    def subtract(self, product_id: int, quantity: int = 1) -> bool:
+        self._load()
+        if not self.redis.hexists(self.key, product_id):
+            return False
+        return self._bounded_increment(product_id, -quantity, 1, -1) is not None
+
+    def set(self, product_id: int, quantity: int, limit_to_stock: bool = False) -> bool:
+        self._load()
+        if not self.redis.hexists(self.key, product_id) or \
+                (limit_to_stock and quantity > (get_stock(product_id) or 0)):
+            return False
+        pipe = self.redis.pipeline()
+        pipe.hset(self.key, product_id, quantity)
+        self._changed(pipe)
+        return True
+
+    def remove(self, product_id: int) -> bool:
+        self._load()
+        pipe = self.redis.pipeline()
+        pipe.hdel(self.key, product_id)
+        deleted, *_ = self._changed(pipe)
+        return deleted > 0
+
+    def clear(self):
+        """
+        Deletes the cart rows in the current transaction and empties the Redis hash once it commits,
+        so a rolled back order keeps the cart and a later flush does not write the lines back.
+        """
+        super().clear()
+        transaction.on_commit(self._reset)
+
+    def _reset(self):
+        pipe = self.redis.pipeline()
+        pipe.delete(self.key)
+        pipe.srem(self.DIRTY_SET, self.key)
+        pipe.hset(self.key, self.LOADED_FIELD, 1)
+        pipe.expire(self.key, settings.CART_REDIS_TTL)
+        pipe.execute()
+
+    def count(self) -> int:
+        self._load()
+        return self.redis.hlen(self.key) - 1
+
+    def merge(self, items: dict):
+        self._load()
+        pipe = self.redis.pipeline()
+        for product_id, quantity in items.items():
+            pipe.hincrby(self.key, product_id, quantity)
+        self._changed(pipe)
+
+    def flush(self):
+        flush_redis_cart(self.redis, self.key)
+
+    def cart_items(self):
+        self.flush()
+        return super().cart_items()
+
+
+# Increments a hash field only if the result stays within [ARGV[3], ARGV[4]] (no upper bound if ARGV[4] < 0).
+# Returns the new value or nil.
+BOUNDED_HINCRBY = """
+local existed = redis.call('HEXISTS', KEYS[1], ARGV[1])
+local value = redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+local maximum = tonumber(ARGV[4])
+if value < tonumber(ARGV[3]) or (maximum >= 0 and value > maximum) then
+    if existed == 1 then
+        redis.call('HINCRBY', KEYS[1], ARGV[1], -tonumber(ARGV[2]))
+    else
+        redis.call('HDEL', KEYS[1], ARGV[1])
+    end
+    return false
+end
+return value
+"""
+
+
+def get_stock(product_id: int):
+    """
+    Returns the stock of a product, or None if it does not exist.
+    """
+    return Vitamin.objects.filter(pk=product_id).values_list('count', flat=True).first()
+
+
+def persist_cart(model, user_id: int, items: dict, add: bool = False):
+    """
+    Writes the given product id to quantity mapping into the cart table with one
+    bulk insert and one bulk update. Rows missing from the mapping are deleted
+    unless `add` is set, in which case the quantities are added to the existing rows.
+    """
+    with transaction.atomic():
+        existing = {row.product_id: row for row in model.objects.filter(user_id=user_id).select_for_update()}
+        to_create, to_update = [], []
+        for product_id, quantity in items.items():
+            row = existing.get(product_id)
+            if row is None:
+                to_create.append(model(user_id=user_id, product_id=product_id, quantity=quantity))
+                continue
+            new_quantity = row.quantity + quantity if add else quantity
+            if row.quantity != new_quantity:
+                row.quantity = new_quantity
+                to_update.append(row)
+        if not add:
+            model.objects.filter(user_id=user_id).exclude(product_id__in=list(items)).delete()
+        # A line added concurrently by another request is updated instead of violating the unique constraint
+        model.objects.bulk_create(to_create, update_conflicts=True, unique_fields=['user', 'product'],
+                                  update_fields=['quantity'])
+        model.objects.bulk_update(to_update, ['quantity'])
+
+
+def flush_redis_cart(redis, key: str):
+    """
+    Persists one Redis cart to the database if it has pending changes.
+    """
+    if not redis.srem(RedisCartStorage.DIRTY_SET, key):
+        return
+    _, label, user_id = key.split(':')
+    model = _cart_models()[label]
+    items = {int(product_id): int(quantity) for product_id, quantity in redis.hgetall(key).items()
+             if product_id != RedisCartStorage.LOADED_FIELD}
+    try:
+        persist_cart(model, int(user_id), items)
+    except Exception:
+        redis.sadd(RedisCartStorage.DIRTY_SET, key)
+        raise
+
+
+def flush_all_redis_carts() -> int:
+    """
+    Persists every Redis cart with pending changes. Returns the number of carts flushed.
+    """
+    redis = get_redis()
+    keys = redis.smembers(RedisCartStorage.DIRTY_SET)
+    for key in keys:
+        flush_redis_cart(redis, key)
+    return len(keys)
+
+
+def _cart_models() -> dict:
+    from preorders.models import PreOrderCart
+    return {model._meta.label_lower: model for model in (Cart, PreOrderCart)}
+
+
+_redis = None
+
+
+def get_redis():
+    global _redis
+    if _redis is None:
+        import redis
+        _redis = redis.Redis.from_url(settings.CART_REDIS_URL, decode_responses=True)
+    return _redis
+
+
+def get_user_cart_storage(user, model=Cart) -> BaseCartStorage:
+    return import_string(settings.CART_STORAGE_BACKEND)(user, model)
+
+
+def get_cart_storage(request, model=Cart) -> BaseCartStorage:
+    """
+    Returns the cart storage for the current request: the session for anonymous users,
+    the configured `CART_STORAGE_BACKEND` for logged-in users.
+    """
+    if not request.user.is_authenticated:
+        return SessionCartStorage(request.session, model)
+    return get_user_cart_storage(request.user, model)
@@ -0,0 +1,33 @@
+from celery import shared_task
+from django.conf import settings
+from django.utils.module_loading import import_string
+import logging
+
+from cart.promo import get_promo_counter
+from cart.storage import RedisCartStorage, flush_all_redis_carts
+
+# Получаем экземпляр логгера Django, который был настроен в settings.py
+logger = logging.getLogger('django')
+
+
+@shared_task
+def flush_cart_storages():
+    """
+    Writes behind the Redis carts changed since the previous run.
+    """
+    if not issubclass(import_string(settings.CART_STORAGE_BACKEND), RedisCartStorage):
+        return 0
+    flushed = flush_all_redis_carts()
+    logger.info(f'Сохранено корзин из Redis: {flushed}')
+    return flushed
+
+
+@shared_task
+def flush_promo_counters():
+    """
+    Writes behind the promo code usage counters changed since the previous run.
+    """
+    flushed = get_promo_counter().flush()
+    if flushed:
+        logger.info(f'Сохранено счетчиков промокодов из Redis: {flushed}')
+    return flushed or 0
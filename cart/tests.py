@@ -172,3 +172,484 @@ class PromoCodeTestCase(TestCase):
         self.assertIn('total_price', response.context)
         expected_total_price = 90  # Expected price after applying 10% discount on 100
         self.assertEqual(response.context['total_price'], expected_total_price)
+
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from vitamins.models import Percent
+from .checkout import CheckoutDraft, SHIPPING_COST
+
+
+class CheckoutDraftTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.category = Category.objects.create(name='Supplements', slug='supplements')
+        self.brand = Brand.objects.create(name='Nature Made', slug='nature-made')
+        ExchangeRate.objects.create(rate=1)
+        DeliveryCost.objects.create(cost_per_kg=0)
+        Percent.objects.create(percent=0)
+        self.vitamin = Vitamin.objects.create(
+            title="Vitamin A",
+            price=100,
+            count=20,
+            cat=self.category,
+            brand=self.brand,
+            weight=0.0,
+            percent=0,
+            product_code="VIT100",
+            packaging=1,
+            unit='bottle'
+        )
+        Cart.objects.create(user=self.user, product=self.vitamin, quantity=2)
+        self.client.login(username='testuser', password='12345')
+
+    def test_draft_is_stored_under_a_single_key(self):
+        self.client.get(reverse('cart:checkout1'))
+        draft = CheckoutDraft.load(self.client.session)
+        self.assertEqual(draft.total_price, 200)
+        self.assertEqual(draft.lines[0]['quantity'], 2)
+        self.assertNotIn('total_price', self.client.session)
+
+    def test_shipping_cost_is_not_accumulated_on_reload(self):
+        self.client.get(reverse('cart:checkout1'))
+        self.client.post(reverse('cart:checkout2'), {'delivery': 'mail'})
+        response = self.client.get(reverse('cart:checkout2'))
+        self.assertEqual(response.context['total_price'], 200 + SHIPPING_COST)
+
+    def test_draft_is_reused_until_cart_changes(self):
+        self.client.get(reverse('cart:checkout1'))
+        self.client.post(reverse('cart:checkout2'), {'delivery': 'pickup'})
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(reverse('cart:checkout4'), {'payment': 'cash'})
+        # Prices come from the draft, so the pricing settings are not read again
+        self.assertFalse(any('vitamins_percent' in query['sql'] for query in queries.captured_queries))
+
+        Cart.objects.filter(user=self.user).update(quantity=3)
+        response = self.client.get(reverse('cart:checkout4'))
+        self.assertEqual(response.context['total_price'], 300)
+        self.assertEqual(CheckoutDraft.load(self.client.session).type_payment, 'cash')
+
+    def test_tampered_draft_is_ignored(self):
+        self.client.get(reverse('cart:checkout1'))
+        session = self.client.session
+        session[CheckoutDraft.session_key]['total_price'] = 1
+        session.save()
+        self.assertEqual(CheckoutDraft.load(self.client.session).total_price, 0)
+
+
+from unittest import skipUnless
+
+from django.test import override_settings
+from preorders.models import PreOrderCart
+from .storage import DatabaseCartStorage, RedisCartStorage, SessionCartStorage, get_redis
+
+
+def redis_available():
+    try:
+        return get_redis().ping()
+    except Exception:
+        return False
+
+
+class CartStorageTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.category = Category.objects.create(name='Supplements', slug='supplements')
+        self.brand = Brand.objects.create(name='Nature Made', slug='nature-made')
+        ExchangeRate.objects.create(rate=1)
+        DeliveryCost.objects.create(cost_per_kg=0)
+        Percent.objects.create(percent=0)
+        self.vitamin = Vitamin.objects.create(title="Vitamin A", price=100, count=5, cat=self.category,
+                                              brand=self.brand, product_code="VIT100", packaging=1, unit='bottle')
+        self.other = Vitamin.objects.create(title="Vitamin C", price=50, count=5, cat=self.category,
+                                            brand=self.brand, product_code="VIT200", packaging=1, unit='bottle')
+
+    def test_anonymous_user_has_session_cart(self):
+        self.client.get(reverse('cart:add_to_cart', kwargs={'product_id': self.vitamin.id}))
+        self.client.get(reverse('cart:add_to_cart', kwargs={'product_id': self.vitamin.id}))
+        self.assertEqual(Cart.objects.count(), 0)
+        self.assertEqual(SessionCartStorage(self.client.session).items(), {self.vitamin.id: 2})
+
+        response = self.client.get(reverse('cart:cart_detail'))
+        self.assertEqual(response.context['cart_items_count'], 1)
+        self.assertEqual(response.context['total_price'], 260)
+
+    def test_session_cart_is_merged_on_login(self):
+        Cart.objects.create(user=self.user, product=self.vitamin, quantity=1)
+        self.client.get(reverse('cart:add_to_cart', kwargs={'product_id': self.vitamin.id}))
+        self.client.get(reverse('cart:add_to_cart', kwargs={'product_id': self.other.id}))
+        self.client.get(reverse('preorders:add_to_preorder_cart', kwargs={'product_id': self.other.id}))
+
+        self.client.login(username='testuser', password='12345')
+
+        self.assertEqual(DatabaseCartStorage(self.user).items(), {self.vitamin.id: 2, self.other.id: 1})
+        self.assertEqual(DatabaseCartStorage(self.user, PreOrderCart).items(), {self.other.id: 1})
+        self.assertNotIn('cart_items', self.client.session)
+
+    def test_add_respects_stock_for_anonymous_user(self):
+        for _ in range(self.vitamin.count + 1):
+            self.client.get(reverse('cart:add_to_cart', kwargs={'product_id': self.vitamin.id}))
+        self.assertEqual(SessionCartStorage(self.client.session).get(self.vitamin.id), self.vitamin.count)
+
+
+@skipUnless(redis_available(), 'Redis is not available')
+@override_settings(CART_STORAGE_BACKEND='cart.storage.RedisCartStorage')
+class RedisCartStorageTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        category = Category.objects.create(name='Supplements', slug='supplements')
+        self.vitamin = Vitamin.objects.create(title="Vitamin A", price=100, count=5, cat=category,
+                                              product_code="VIT100", packaging=1, unit='bottle')
+        Cart.objects.create(user=self.user, product=self.vitamin, quantity=1)
+        self.storage = RedisCartStorage(self.user)
+        self.storage.redis.delete(self.storage.key)
+        self.addCleanup(self.storage.redis.delete, self.storage.key)
+
+    def test_changes_are_written_behind(self):
+        with self.assertNumQueries(3):
+            # Only the initial load of the existing rows and the product lookup of every add
+            self.storage.add(self.vitamin.id)
+            self.storage.add(self.vitamin.id)
+        self.assertEqual(self.storage.count(), 1)
+        self.assertEqual(Cart.objects.get().quantity, 1)
+
+        self.storage.flush()
+        self.assertEqual(Cart.objects.get().quantity, 3)
+
+        self.assertTrue(self.storage.remove(self.vitamin.id))
+        self.assertFalse(self.storage.remove(self.vitamin.id))
+        self.assertEqual(list(self.storage.cart_items()), [])
+
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import IntegrityError, connections, transaction
+from django.test import TransactionTestCase
+from .mutations import add_cart_line, merge_duplicate_lines
+
+
+class CartMutationTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        category = Category.objects.create(name='Supplements', slug='supplements')
+        self.vitamin = Vitamin.objects.create(title="Vitamin A", price=100, count=2, cat=category,
+                                              product_code="VIT100", packaging=1, unit='bottle')
+
+    def test_add_is_a_single_statement_bounded_by_stock(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(add_cart_line(Cart, self.user.pk, self.vitamin.pk, limit_to_stock=True), 1)
+        self.assertEqual(add_cart_line(Cart, self.user.pk, self.vitamin.pk, limit_to_stock=True), 2)
+        self.assertIsNone(add_cart_line(Cart, self.user.pk, self.vitamin.pk, limit_to_stock=True))
+        self.assertIsNone(add_cart_line(Cart, self.user.pk, 999, limit_to_stock=True))
+        self.assertEqual(Cart.objects.get().quantity, 2)
+
+    def test_preorder_cart_is_not_bounded_by_stock(self):
+        for _ in range(3):
+            add_cart_line(PreOrderCart, self.user.pk, self.vitamin.pk)
+        self.assertEqual(PreOrderCart.objects.get().quantity, 3)
+
+    def test_user_product_lines_are_unique(self):
+        Cart.objects.create(user=self.user, product=self.vitamin)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Cart.objects.create(user=self.user, product=self.vitamin)
+
+@skipUnless(connection.vendor == 'postgresql', 'Needs concurrent writers and ALTER TABLE constraints of PostgreSQL')
+class CartMutationTransactionTestCase(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        category = Category.objects.create(name='Supplements', slug='supplements')
+        self.vitamin = Vitamin.objects.create(title="Vitamin A", price=100, count=5, cat=category,
+                                              product_code="VIT100", packaging=1, unit='bottle')
+
+    def test_parallel_adds(self):
+        def add(_):
+            try:
+                return add_cart_line(Cart, self.user.pk, self.vitamin.pk, limit_to_stock=True)
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(add, range(20)))
+
+        self.assertEqual(Cart.objects.filter(user=self.user, product=self.vitamin).count(), 1)
+        self.assertEqual(Cart.objects.get().quantity, self.vitamin.count)
+        self.assertEqual(sorted(r for r in results if r is not None), list(range(1, self.vitamin.count + 1)))
+
+    def test_merge_duplicate_lines(self):
+        # Emulate lines created before the unique constraint existed
+        constraint = Cart._meta.constraints[0]
+        with connection.schema_editor() as editor:
+            editor.remove_constraint(Cart, constraint)
+        try:
+            Cart.objects.bulk_create([Cart(user=self.user, product=self.vitamin, quantity=q) for q in (1, 2, 3)])
+            self.assertEqual(merge_duplicate_lines(Cart), 2)
+            self.assertEqual(Cart.objects.get().quantity, 6)
+        finally:
+            with connection.schema_editor() as editor:
+                editor.add_constraint(Cart, constraint)
+
+
+class CartJsonViewsTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.category = Category.objects.create(name='Supplements', slug='supplements')
+        self.brand = Brand.objects.create(name='Nature Made', slug='nature-made')
+        ExchangeRate.objects.create(rate=1)
+        DeliveryCost.objects.create(cost_per_kg=0)
+        Percent.objects.create(percent=0)
+        self.vitamins = [
+            Vitamin.objects.create(title=f"Vitamin {i}", price=100, count=3, cat=self.category, brand=self.brand,
+                                   product_code=f"VIT{i}", packaging=1, unit='bottle')
+            for i in range(3)
+        ]
+        self.vitamin = self.vitamins[0]
+        self.client.login(username='testuser', password='12345')
+
+    def post(self, name, product_id=None, data=None, fragments=False):
+        kwargs = {'product_id': product_id} if product_id else {}
+        url = reverse(f'cart:{name}', kwargs=kwargs) + ('?fragments=1' if fragments else '')
+        return self.client.post(url, data or {})
+
+    def test_add_returns_line_totals_and_counts(self):
+        self.post('add_to_cart_json', self.vitamin.id)
+        response = self.post('add_to_cart_json', self.vitamin.id)
+        data = response.json()
+        self.assertTrue(data['ok'])
+        self.assertEqual(data['line']['quantity'], 2)
+        self.assertEqual(data['line']['sum'], 260)
+        self.assertEqual(data['totals']['total_price'], 260)
+        self.assertEqual(data['cart_items_count'], 1)
+        self.assertEqual(data['preorder_cart_items_count'], 0)
+        self.assertIn("Количество товара увеличено.", [m['text'] for m in data['messages']])
+        self.assertNotIn('fragments', data)
+
+    def test_add_beyond_stock(self):
+        for _ in range(self.vitamin.count):
+            self.post('add_to_cart_json', self.vitamin.id)
+        response = self.post('add_to_cart_json', self.vitamin.id)
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(response.json()['ok'])
+        self.assertEqual(response.json()['line']['quantity'], self.vitamin.count)
+
+    def test_minus_set_and_remove(self):
+        self.post('add_to_cart_json', self.vitamin.id)
+        self.assertEqual(self.post('minus_from_cart_json', self.vitamin.id).status_code, 409)
+
+        response = self.post('set_cart_quantity_json', self.vitamin.id, {'quantity': 3})
+        self.assertEqual(response.json()['line']['quantity'], 3)
+        self.assertEqual(self.post('set_cart_quantity_json', self.vitamin.id, {'quantity': 4}).status_code, 409)
+        self.assertEqual(self.post('set_cart_quantity_json', self.vitamin.id, {'quantity': 'x'}).status_code, 400)
+
+        self.assertEqual(self.post('minus_from_cart_json', self.vitamin.id).json()['line']['quantity'], 2)
+
+        data = self.post('remove_from_cart_json', self.vitamin.id).json()
+        self.assertIsNone(data['line'])
+        self.assertEqual(data['cart_items_count'], 0)
+        self.assertEqual(self.post('remove_from_cart_json', self.vitamin.id).status_code, 404)
+
+    def test_apply_promo(self):
+        PromoCod.objects.create(code='SALE', discount=50, is_active=True)
+        self.post('add_to_cart_json', self.vitamin.id)
+        data = self.post('apply_promo_json', data={'promo_code': 'SALE'}).json()
+        self.assertEqual(data['totals']['code_name'], 'SALE')
+        self.assertEqual(data['totals']['total_price'], 65)
+
+    def test_get_is_not_allowed(self):
+        response = self.client.get(reverse('cart:add_to_cart_json', kwargs={'product_id': self.vitamin.id}))
+        self.assertEqual(response.status_code, 405)
+        self.assertEqual(Cart.objects.count(), 0)
+
+    def test_fragments_query_count_does_not_grow_with_cart(self):
+        def count_queries():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.post('add_to_cart_json', self.vitamin.id, fragments=True)
+            self.assertIn(self.vitamin.title, response.json()['fragments']['lines'])
+            return len(queries)
+
+        count_queries()
+        one_line = count_queries()
+        for vitamin in self.vitamins[1:]:
+            Cart.objects.create(user=self.user, product=vitamin, quantity=1)
+        self.assertEqual(count_queries(), one_line)
+
+
+from datetime import timedelta
+
+from django.utils import timezone
+from .models import PromoCodUsage
+from .promo import DatabasePromoCounter, RedisPromoCounter, get_promo_rule
+
+
+class PromoRuleTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.category = Category.objects.create(name='Supplements', slug='supplements')
+        self.brand = Brand.objects.create(name='Nature Made', slug='nature-made')
+        self.other_brand = Brand.objects.create(name='Now Foods', slug='now-foods')
+        ExchangeRate.objects.create(rate=1)
+        DeliveryCost.objects.create(cost_per_kg=0)
+        Percent.objects.create(percent=0)
+        self.vitamin = Vitamin.objects.create(title="Vitamin A", price=100, count=5, cat=self.category, percent=0,
+                                              brand=self.brand, product_code="VIT100", packaging=1, unit='bottle')
+        self.other = Vitamin.objects.create(title="Vitamin C", price=100, count=5, cat=self.category, percent=0,
+                                            brand=self.other_brand, product_code="VIT200", packaging=1, unit='bottle')
+        self.promo_code = PromoCod.objects.create(code='SALE', discount=50, is_active=True)
+        Cart.objects.create(user=self.user, product=self.vitamin, quantity=1)
+        Cart.objects.create(user=self.user, product=self.other, quantity=1)
+        self.client.login(username='testuser', password='12345')
+
+    def get_cart(self, code='SALE'):
+        session = self.client.session
+        session['promo_code'] = code
+        session.save()
+        return self.client.get(reverse('cart:cart_detail'))
+
+    def test_rules_are_cached_until_promo_code_is_saved(self):
+        get_promo_rule('SALE')
+        with self.assertNumQueries(0):
+            self.assertEqual(get_promo_rule('SALE').discount, 50)
+
+        self.promo_code.discount = 20
+        self.promo_code.save()
+        self.assertEqual(get_promo_rule('SALE').discount, 20)
+
+        self.promo_code.brands.add(self.brand)
+        self.assertEqual(get_promo_rule('SALE').brand_ids, {self.brand.id})
+
+    def test_brand_scope(self):
+        self.promo_code.brands.add(self.brand)
+        response = self.get_cart()
+        self.assertEqual(response.context['code_name'], 'SALE')
+        self.assertEqual(response.context['total_price'], 50 + 100)
+
+        self.promo_code.brands.set([Brand.objects.create(name='Solgar', slug='solgar')])
+        response = self.get_cart()
+        self.assertEqual(response.context['total_price'], 200)
+        self.assertNotIn('promo_code', self.client.session)
+
+    def test_validity_window(self):
+        self.promo_code.valid_until = timezone.now() - timedelta(days=1)
+        self.promo_code.save()
+        response = self.get_cart()
+        self.assertEqual(response.context['code_name'], '')
+        self.assertIn("Промокод 'SALE' не активен!!!", [m.message for m in get_messages(response.wsgi_request)])
+
+    def test_per_user_limit(self):
+        self.promo_code.per_user_limit = 1
+        self.promo_code.save()
+        self.assertEqual(self.get_cart().context['code_name'], 'SALE')
+
+        PromoCodUsage.objects.create(promo_code=self.promo_code, user=self.user, count=1)
+        self.assertEqual(self.get_cart().context['code_name'], '')
+
+    def test_database_counter_enforces_limits(self):
+        self.promo_code.usage_limit = 2
+        self.promo_code.per_user_limit = 1
+        self.promo_code.save()
+        rule = get_promo_rule('SALE')
+        other_user = User.objects.create_user(username='other', password='12345')
+        third_user = User.objects.create_user(username='third', password='12345')
+        counter = DatabasePromoCounter()
+
+        self.assertTrue(counter.redeem(rule, self.user.pk))
+        self.assertFalse(counter.redeem(rule, self.user.pk))
+        self.assertTrue(counter.redeem(rule, other_user.pk))
+        self.assertFalse(counter.redeem(rule, third_user.pk))
+        self.assertEqual(counter.usage(rule, self.user.pk), (2, 1))
+        self.assertEqual(counter.usage(rule, third_user.pk), (2, 0))
+
+
+@skipUnless(redis_available(), 'Redis is not available')
+class RedisPromoCounterTestCase(TestCase):
+    def setUp(self):
+        self.users = [User.objects.create_user(username=f'user{i}', password='12345') for i in range(3)]
+        self.promo_code = PromoCod.objects.create(code='SALE', discount=50, is_active=True,
+                                                  usage_limit=2, per_user_limit=1)
+        self.counter = RedisPromoCounter()
+        get_redis().delete(self.counter.key(self.promo_code.id), self.counter.DIRTY_SET)
+
+    def test_counters_are_written_behind(self):
+        rule = get_promo_rule('SALE')
+        self.assertTrue(self.counter.redeem(rule, self.users[0].pk))
+        self.assertFalse(self.counter.redeem(rule, self.users[0].pk))
+        self.assertTrue(self.counter.redeem(rule, self.users[1].pk))
+        self.assertFalse(self.counter.redeem(rule, self.users[2].pk))
+        self.assertEqual(PromoCod.objects.get().used_count, 0)
+
+        self.counter.release(rule, self.users[1].pk)
+        self.assertEqual(self.counter.flush(), 1)
+        self.assertEqual(PromoCod.objects.get().used_count, 1)
+        self.assertEqual(dict(PromoCodUsage.objects.values_list('user_id', 'count')),
+                         {self.users[0].pk: 1, self.users[1].pk: 0})
+
+
+from io import StringIO
+
+from django.contrib.sessions.backends.cached_db import SessionStore
+from django.core.cache import cache
+from django.core.management import call_command
+
+
+class CheckoutSessionTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.draft = CheckoutDraft()
+        self.draft.data['lines'] = [[1, 2, 100, None, 0, 200]]
+
+    def test_unchanged_draft_is_not_written(self):
+        session = SessionStore()
+        self.draft.save(session)
+        session.save()
+
+        session = SessionStore(session.session_key)
+        draft = CheckoutDraft.load(session)
+        self.assertEqual(draft.lines, [{'product_id': 1, 'quantity': 2, 'final_price': 100, 'sale_price': None,
+                                        'discount': 0, 'sum': 200}])
+        draft.set_type_payment(None)
+        draft.save(session)
+        self.assertFalse(session.modified)
+        draft.set_type_payment('cash')
+        draft.save(session)
+        self.assertTrue(session.modified)
+
+    def test_draft_with_line_dicts_is_compacted(self):
+        data = dict(self.draft.data, lines=self.draft.lines)
+        data['hash'] = CheckoutDraft.content_hash(data)
+        draft = CheckoutDraft.load({CheckoutDraft.session_key: data})
+        self.assertEqual(draft.data['lines'], [[1, 2, 100, None, 0, 200]])
+
+    def test_session_benchmark(self):
+        output = StringIO()
+        call_command('benchmark_sessions', requests=8, lines=3, stdout=output)
+        before, after = output.getvalue().splitlines()[1:]
+        self.assertEqual(before.split()[4], '8')
+        self.assertEqual(after.split()[4], '3')
+
+
+from vitamins.testing import QueryBudgetMixin, seed_catalog
+
+
+class CartQueryBudgetTestCase(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        seed_catalog()
+        cls.user = User.objects.create_user(username='buyer', password='testpass')
+        cls.products = list(Vitamin.objects.filter(count__gte=5).order_by('pk').values_list('pk', flat=True)[:40])
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def fill_cart(self, lines: int):
+        Cart.objects.filter(user=self.user).delete()
+        Cart.objects.bulk_create([Cart(user=self.user, product_id=pk, quantity=1) for pk in self.products[:lines]])
+
+    def test_cart_and_checkout_do_not_grow_with_the_cart(self):
+        for name, url, budget in [('cart', reverse('cart:cart_detail'), 5), ('checkout1', reverse('cart:checkout1'), 4),
+                                  ('checkout4', reverse('cart:checkout4'), 6)]:
+            counts = {}
+            for lines in (2, 40):
+                self.fill_cart(lines)
+                self.client.post(reverse('cart:checkout2'), {'delivery': 'pickup'})
+                counts[lines] = self.assertQueryBudget(name, url, budget)['queries']
+            self.assertQueriesDoNotGrow(name, counts)
@@ -7,8 +7,14 @@ urlpatterns = [
     path('', views.cart_detail, name='cart_detail'),
     path("add/<int:product_id>/", views.add_to_cart, name="add_to_cart"),
     path("remove/<int:cart_item_id>/", views.remove_from_cart, name="remove_from_cart"),
+    path("remove_product/<int:product_id>/", views.remove_product_from_cart, name="remove_product_from_cart"),
     path("minus/<int:product_id>/", views.minus_from_cart, name="minus_from_cart"),
     path("add_promo_cod/", views.add_promo_cod, name="add_promo_cod"),
+    path("json/add/<int:product_id>/", views.add_to_cart_json, name="add_to_cart_json"),
+    path("json/minus/<int:product_id>/", views.minus_from_cart_json, name="minus_from_cart_json"),
+    path("json/remove/<int:product_id>/", views.remove_from_cart_json, name="remove_from_cart_json"),
+    path("json/set/<int:product_id>/", views.set_cart_quantity_json, name="set_cart_quantity_json"),
+    path("json/promo/", views.apply_promo_json, name="apply_promo_json"),
     path("checkout1/", views.checkout1, name="checkout1"),
     path("checkout2/", views.checkout2, name="checkout2"),
     path("checkout3/", views.checkout3, name="checkout3"),
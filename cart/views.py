@@ -1,105 +1,102 @@
+from django.http import Http404, JsonResponse
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
+from django.template.loader import render_to_string
+from django.views.decorators.http import require_POST
 
-from vitamins.models import Vitamin, ExchangeRate, DeliveryCost
+from preorders.models import PreOrderCart
+from vitamins.models import Vitamin
 from vitamins.views import calculate_price
-from .models import Cart, PromoCod
+from .checkout import CheckoutDraft, get_checkout_draft, set_session_value
+from .models import Cart
+from .promo import check_promo_rule, get_promo_rule
+from .storage import get_cart_storage
 
 
-@login_required
-def validate_promo(request):
+def validate_promo(request, cart_items=None):
     """
-    Validates the entered promo code.
+    Validates the entered promo code against its cached rule.
 
-    Checks if the promo code exists in the database, if it is active,
-    and if there are any restrictions on the cart total amount.
-    If the promo code is valid, it is applied to the cart.
+    Checks if the promo code exists, if it is active and within its validity window,
+    if it applies to any product in the cart, the restrictions on the cart total amount
+    and the usage limits. An invalid promo code is removed from the session.
 
     Returns:
-        bool: True if the promo code is valid and applied successfully, False otherwise.
+        PromoRule | None: The rule of the promo code if it is valid, None otherwise.
     """
-    cart_items = Cart.objects.filter(user=request.user)
+    if cart_items is None:
+        cart_items = get_cart_storage(request).cart_items()
+        calculate_price([item.product for item in cart_items])
     promo_code = request.session.get('promo_code')
 
     if not promo_code:
-        messages.error(request, "Вы не ввели промокод!!!")
-        return False
-
-    try:
-        promo_code_obj = PromoCod.objects.get(code=promo_code)
-    except PromoCod.DoesNotExist:
-        messages.error(request, "Не верный промокод!!!")
-        return False
-
-    if not promo_code_obj.is_active:
-        messages.error(request, f"Промокод '{promo_code}' не активен!!!")
-        return False
-
-    total_cart_price = sum(item.quantity * calculate_price(item.product).final_price for item in cart_items)
-    if promo_code_obj.min_sum and promo_code_obj.min_sum > total_cart_price:
-        messages.error(request,
-                       f"Общая сумма корзины должна быть не менее {promo_code_obj.min_sum}, чтобы применить промокод.")
-        return False
+        if promo_code is not None:
+            messages.error(request, "Вы не ввели промокод!!!")
+        request.session.pop('promo_code', None)
+        return None
+
+    rule = get_promo_rule(promo_code)
+    error = check_promo_rule(rule, promo_code, cart_items, request.user)
+    if error:
+        messages.error(request, error)
+        request.session.pop('promo_code', None)
+        return None
 
     # Apply promo code
-    request.session['promo_code'] = promo_code
     messages.success(request, f"Промокод {promo_code} применен! "
                               f"Применена максимальная скидка, если на товар уже была скидка!")
-    return True
+    return rule
 
 
 def calculator_cart(request):
     """
     Calculates the total price of the cart items, considering any applied promo code.
     """
-    promo_code = None
-    if validate_promo(request):
-        promo_code = PromoCod.objects.get(code=request.session.get('promo_code'))
-
-    cart_items = Cart.objects.filter(user=request.user).select_related('product__brand')
+    storage = get_cart_storage(request)
+    cart_items = storage.cart_items()
+    corrected = False
     for item in cart_items:
         if item.product.count < item.quantity or item.quantity < 1:
             item.quantity = item.product.count
             messages.error(request, f"Недостаточное количество: {item.product.title}!!!")
             messages.error(request, f"Доступное количество: {item.product.count}шт.")
-            item.save()
-        if promo_code:
-            item.product.discount = max(item.product.discount, promo_code.discount)
-        item.product = calculate_price(item.product)
+            storage.set(item.product_id, item.quantity)
+            corrected = True
+        calculate_price(item.product)
+
+    if corrected:
+        storage.flush()
+
+    rule = validate_promo(request, cart_items)
+    for item in cart_items:
+        if rule and rule.applies_to(item.product) and rule.discount > item.product.discount:
+            item.product.discount = rule.discount
+            calculate_price(item.product)
         item.product.sum = (item.product.sale_price if item.product.discount else item.product.final_price) * item.quantity
 
     total_price = sum(item.product.sum for item in cart_items)
     total_price_without_discount = sum(item.quantity * item.product.final_price for item in cart_items)
     discount = total_price_without_discount - total_price
-    return cart_items, total_price, total_price_without_discount, discount, promo_code.code if promo_code else ''
+    return cart_items, total_price, total_price_without_discount, discount, rule.code if rule else ''
 
 
-@login_required
 def add_to_cart(request, product_id: int):
     """
     Adds a product to the user's cart or increases its quantity if it already exists.
+    The quantity is never increased beyond the stock.
     """
-    product = get_object_or_404(Vitamin, pk=product_id)
-    cart_item = Cart.objects.filter(user=request.user, product=product).first()
+    quantity = get_cart_storage(request).add(product_id, limit_to_stock=True)
 
-    if cart_item:
-        if product.count - cart_item.quantity < 1:
-            messages.error(request, f"Недостаточное количество: {product.title}!!!")
-            messages.error(request, f"Доступное количество: {product.count}шт")
-            return redirect("cart:cart_detail")
+    if quantity is None:
+        product = get_object_or_404(Vitamin, pk=product_id)
+        messages.error(request, f"Недостаточное количество: {product.title}!!!")
+        messages.error(request, f"Доступное количество: {product.count}шт")
+        return redirect("cart:cart_detail")
 
-        cart_item.quantity += 1
-        cart_item.save()
+    if quantity > 1:
         messages.success(request, "Количество товара увеличено.")
-
     else:
-        if product.count == 0:
-            messages.error(request, f"Недостаточное количество: {product.title}!!!")
-            messages.error(request, f"Доступное количество: {product.count}шт")
-            return redirect("cart:cart_detail")
-
-        Cart.objects.create(user=request.user, product=product)
         messages.success(request, "Продукт добавлен в корзину.")
 
     return redirect(request.META.get('HTTP_REFERER', 'home'))
@@ -108,29 +105,33 @@ def add_to_cart(request, product_id: int):
 @login_required
 def remove_from_cart(request, cart_item_id: int):
     """
-    Removes a product from the user's cart.
+    Removes a cart line of the user's cart by its id.
     """
 
     cart_item = get_object_or_404(Cart, id=cart_item_id)
 
     if cart_item.user == request.user:
-        cart_item.delete()
+        get_cart_storage(request).remove(cart_item.product_id)
         messages.success(request, "1 Продукт удален из вашей корзины.")
 
     return redirect("cart:cart_detail")
 
 
-@login_required
-def minus_from_cart(request, product_id):
+def remove_product_from_cart(request, product_id: int):
     """
-    Decreases the quantity of a product in the user's cart by 1.
+    Removes a product from the user's cart.
     """
+    get_cart_storage(request).remove(product_id)
+    messages.success(request, "1 Продукт удален из вашей корзины.")
 
-    cart_item = Cart.objects.filter(user=request.user, product=product_id).first()
+    return redirect("cart:cart_detail")
 
-    if cart_item.quantity > 1:
-        cart_item.quantity -= 1
-        cart_item.save()
+
+def minus_from_cart(request, product_id: int):
+    """
+    Decreases the quantity of a product in the user's cart by 1.
+    """
+    if get_cart_storage(request).subtract(product_id):
         messages.success(request, "Количество товара уменьшено.")
     else:
         messages.error(request, "Количество товара в корзине не может быть меньше 1!!!")
@@ -138,7 +139,6 @@ def minus_from_cart(request, product_id):
     return redirect(request.META.get('HTTP_REFERER', 'home'))
 
 
-@login_required
 def cart_detail(request):
     """
     Renders the cart detail page displaying cart items, calculates total price, discount,
@@ -161,33 +161,164 @@ def cart_detail(request):
     return render(request, "cart/cart_detail.html", context)
 
 
-@login_required
 def add_promo_cod(request):
     """
     Adds a promo code to the session if provided via POST request.
     """
     if request.method == 'POST':
         code = request.POST['promo_code']
-        request.session['promo_code'] = code
+        set_session_value(request.session, 'promo_code', code)
     return cart_detail(request)
 
 
+CART_FRAGMENTS = {
+    'lines': 'cart/includes/cart_lines.html',
+    'totals': 'cart/includes/cart_totals.html',
+}
+
+
+def cart_json_response(request, product_id: int = None, ok: bool = True, status: int = 200):
+    """
+    Returns the state of the cart after a change as JSON: the changed line, the totals,
+    the header badge counts and the pending messages.
+
+    With `?fragments=1` the cart_detail table rows and totals are rendered as well,
+    so the page can be updated in place without a full reload.
+    """
+    cart_items, total_price, total_price_without_discount, discount, code_name = calculator_cart(request)
+    line = next((item for item in cart_items if item.product_id == product_id), None)
+    data = {
+        'ok': ok,
+        'line': {
+            'product_id': line.product_id,
+            'quantity': line.quantity,
+            'final_price': line.product.final_price,
+            'discount': line.product.discount,
+            'sum': line.product.sum,
+        } if line else None,
+        'totals': {
+            'total_price': total_price,
+            'total_price_without_discount': total_price_without_discount,
+            'discount': discount,
+            'code_name': code_name,
+        },
+        'cart_items_count': len(cart_items),
+        'preorder_cart_items_count': get_cart_storage(request, PreOrderCart).count(),
+    }
+    if request.GET.get('fragments'):
+        context = {
+            'cart_items': cart_items,
+            'total_price': total_price,
+            'total_price_without_discount': total_price_without_discount,
+            'discount': discount,
+            'code_name': code_name,
+        }
+        data['fragments'] = {name: render_to_string(template, context, request)
+                             for name, template in CART_FRAGMENTS.items()}
+    data['messages'] = [{'level': message.tags, 'text': message.message}
+                        for message in messages.get_messages(request)]
+    return JsonResponse(data, status=status)
+
+
+@require_POST
+def add_to_cart_json(request, product_id: int):
+    """
+    JSON version of `add_to_cart`.
+    """
+    quantity = get_cart_storage(request).add(product_id, limit_to_stock=True)
+
+    if quantity is None:
+        product = get_object_or_404(Vitamin, pk=product_id)
+        messages.error(request, f"Недостаточное количество: {product.title}!!!")
+        messages.error(request, f"Доступное количество: {product.count}шт")
+        return cart_json_response(request, product_id, ok=False, status=409)
+
+    if quantity > 1:
+        messages.success(request, "Количество товара увеличено.")
+    else:
+        messages.success(request, "Продукт добавлен в корзину.")
+    return cart_json_response(request, product_id)
+
+
+@require_POST
+def minus_from_cart_json(request, product_id: int):
+    """
+    JSON version of `minus_from_cart`.
+    """
+    if get_cart_storage(request).subtract(product_id):
+        messages.success(request, "Количество товара уменьшено.")
+        return cart_json_response(request, product_id)
+
+    messages.error(request, "Количество товара в корзине не может быть меньше 1!!!")
+    return cart_json_response(request, product_id, ok=False, status=409)
+
+
+@require_POST
+def remove_from_cart_json(request, product_id: int):
+    """
+    JSON version of `remove_product_from_cart`. Returns a 404 if the product is not in the cart.
+    """
+    if not get_cart_storage(request).remove(product_id):
+        raise Http404("Товара нет в корзине")
+    messages.success(request, "1 Продукт удален из вашей корзины.")
+    return cart_json_response(request, product_id)
+
+
+@require_POST
+def set_cart_quantity_json(request, product_id: int):
+    """
+    Sets the quantity of a product in the cart. The quantity is taken from the POST data
+    and is never set beyond the stock.
+    """
+    try:
+        quantity = int(request.POST.get('quantity', ''))
+    except ValueError:
+        quantity = 0
+    if quantity < 1:
+        messages.error(request, "Количество товара в корзине не может быть меньше 1!!!")
+        return cart_json_response(request, product_id, ok=False, status=400)
+
+    if get_cart_storage(request).set(product_id, quantity, limit_to_stock=True):
+        messages.success(request, "Количество товара изменено.")
+        return cart_json_response(request, product_id)
+
+    product = get_object_or_404(Vitamin, pk=product_id)
+    if product.count >= quantity:
+        raise Http404("Товара нет в корзине")
+    messages.error(request, f"Недостаточное количество: {product.title}!!!")
+    messages.error(request, f"Доступное количество: {product.count}шт")
+    return cart_json_response(request, product_id, ok=False, status=409)
+
+
+@require_POST
+def apply_promo_json(request):
+    """
+    JSON version of `add_promo_cod`.
+    """
+    set_session_value(request.session, 'promo_code', request.POST.get('promo_code', ''))
+    return cart_json_response(request)
+
+
+def get_cart_checkout_draft(request) -> CheckoutDraft:
+    """
+    Returns the checkout draft of the user's cart, recalculating it only if the cart or pricing has changed.
+    """
+    get_cart_storage(request).flush()
+    return get_checkout_draft(request, Cart.objects.filter(user=request.user), calculator_cart)
+
+
 @login_required
 def checkout1(request):
     """
     Displays the checkout page with a choice of delivery method.
     Displays order value amounts, discounts and promotional codes if there is one.
     """
-    cart_items, total_price, total_price_without_discount, discount, code_name = calculator_cart(request)
-    request.session['total_price'] = total_price
-    request.session['total_price_without_discount'] = total_price_without_discount
-    request.session['discount'] = discount
+    draft = get_cart_checkout_draft(request)
+    draft.set_delivery_option(None)
+    draft.save(request.session)
     context = {
         'title': 'Выбор способа получения заказа',
-        "total_price": total_price,
-        "total_price_without_discount": total_price_without_discount,
-        'discount': discount,
-        'code_name': request.session['promo_code'] if 'promo_code' in request.session else ''
+        **draft.context(),
     }
     return render(request, "cart/checkout1.html", context)
 
@@ -198,17 +329,15 @@ def checkout2(request):
     Displays the recipient data entry page depending on the delivery method.
     Adds shipping costs if sent by mail.
     """
+    draft = get_cart_checkout_draft(request)
     if request.method == 'POST':
-        request.session['delivery_option'] = request.POST.get('delivery')  # 'pickup' или 'mail'
-    if request.session['delivery_option'] == 'mail':
-        request.session['total_price'] += 200
+        draft.set_delivery_option(request.POST.get('delivery'))  # 'pickup' или 'mail'
+        draft.save(request.session)
+    if not draft.delivery_option:
+        return redirect('cart:checkout1')
     context = {
         'title': 'Внесение данных к заказу',
-        "total_price": request.session['total_price'],
-        "total_price_without_discount": request.session['total_price_without_discount'],
-        'discount': request.session['discount'],
-        'code_name': request.session['promo_code'] if 'promo_code' in request.session else '',
-        'delivery_option': request.session['delivery_option']
+        **draft.context(),
     }
     return render(request, "cart/checkout2.html", context)
 
@@ -216,30 +345,19 @@ def checkout2(request):
 @login_required
 def checkout3(request):
     """
-    Saves the recipient's data in the session.
+    Saves the recipient's data in the checkout draft.
     Displays the payment method selection page.
     """
+    draft = get_cart_checkout_draft(request)
+    if not draft.delivery_option:
+        return redirect('cart:checkout1')
     if request.method == 'POST':
-        request.session['last_name'] = request.POST.get('lastname')
-        request.session['first_name'] = request.POST.get('firstname')
-        request.session['email'] = request.POST.get('email')
-        request.session['phone_number'] = request.POST.get('phone')
-        request.session['comment'] = request.POST.get('comment')
-        if request.session['delivery_option'] == 'mail':
-            request.session['middle_name'] = request.POST.get('middle_name')
-            request.session['region'] = request.POST.get('region')
-            request.session['city'] = request.POST.get('city')
-            request.session['address'] = request.POST.get('street')
-            request.session['postal_code'] = request.POST.get('zip')
-
+        draft.set_customer(request.POST)
+        draft.save(request.session)
 
     context = {
         'title': 'Способ оплаты',
-        "total_price": request.session['total_price'],
-        "total_price_without_discount": request.session['total_price_without_discount'],
-        'discount': request.session['discount'],
-        'code_name': request.session['promo_code'] if 'promo_code' in request.session else '',
-        'delivery_option': request.session['delivery_option'],
+        **draft.context(),
     }
 
     return render(request, "cart/checkout3.html", context)
@@ -251,18 +369,18 @@ def checkout4(request):
     Saves the payment method.
     Displays the cart details check page.
     """
-    request.session['type_payment'] = request.POST.get('payment')
-    cart_items, total_price, total_price_without_discount, discount, code_name = calculator_cart(request)
-    if request.session['delivery_option'] == 'mail':
-        total_price += 200
+    draft = get_cart_checkout_draft(request)
+    if not draft.delivery_option:
+        return redirect('cart:checkout1')
+    if request.method == 'POST':
+        draft.set_type_payment(request.POST.get('payment'))
+        draft.save(request.session)
+    cart_items = draft.apply_to(Cart.objects.filter(user=request.user).select_related('product__brand')
+                                .prefetch_related('product__images'))
     context = {
         "cart_items": cart_items,
-        "total_price": total_price,
-        "total_price_without_discount": total_price_without_discount,
-        'discount': discount,
         'title': 'Проверка заказа перед оформлением',
-        'code_name': code_name,
-        'delivery_option': request.session['delivery_option']
+        **draft.context(),
     }
 
     return render(request, "cart/checkout4.html", context)
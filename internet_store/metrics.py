@@ -0,0 +1,274 @@
+"""
+Request instrumentation: the SQL queries and their time, the cache hits and misses, the template
+render time and the total time of every request.
+
+`InstrumentationMiddleware` collects them for the current request, adds a Server-Timing header
+to the responses of staff users and aggregates them per URL name in the `REGISTRY` of the process,
+which `metrics_view` exposes in the Prometheus text format. The cache and template numbers come from
+the cache backends and the template backend of this module, set in `CACHES` and `TEMPLATES`.
+
+The registry is kept per process, so with several workers every worker exposes its own numbers.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import ExitStack
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache.backends.locmem import LocMemCache as BaseLocMemCache
+from django.core.cache.backends.redis import RedisCache as BaseRedisCache
+from django.db import connections
+from django.http import Http404, HttpResponse
+from django.template import TemplateDoesNotExist
+from django.template.backends.django import DjangoTemplates as BaseDjangoTemplates, Template as BaseTemplate, reraise
+
+# The upper bounds of the request duration histogram in seconds, the defaults of the Prometheus clients
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+UNRESOLVED = '<unresolved>'
+
+_missing = object()
+
+
+class RequestMetrics:
+    __slots__ = ('queries', 'db_seconds', 'cache_hits', 'cache_misses', 'template_seconds', 'rendering',
+                 'total_seconds')
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.template_seconds = 0.0
+        self.rendering = False
+        self.total_seconds = 0.0
+
+    def execute(self, execute, sql, params, many, context):
+        """
+        A database execute wrapper, see `django.db.backends.base.base.BaseDatabaseWrapper.execute_wrapper`.
+        """
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_seconds += time.perf_counter() - started
+            self.queries += 1
+
+    def server_timing(self) -> str:
+        return ', '.join([
+            f'db;dur={self.db_seconds * 1000:.1f};desc="{self.queries} queries"',
+            f'cache;desc="{self.cache_hits} hits, {self.cache_misses} misses"',
+            f'tpl;dur={self.template_seconds * 1000:.1f}',
+            f'total;dur={self.total_seconds * 1000:.1f}',
+        ])
+
+
+# The metrics of the request being handled in the current thread or task
+current_metrics: ContextVar[RequestMetrics | None] = ContextVar('current_metrics', default=None)
+
+
+def record_cache(hits: int, misses: int):
+    metrics = current_metrics.get()
+    if metrics is not None:
+        metrics.cache_hits += hits
+        metrics.cache_misses += misses
+
+
+class CacheMetricsMixin:
+    """
+    Counts the hits and misses of `get` in the metrics of the current request.
+    """
+
+    def get(self, key, default=None, version=None):
+        value = super().get(key, _missing, version)
+        if value is _missing:
+            record_cache(0, 1)
+            return default
+        record_cache(1, 0)
+        return value
+
+
+class RedisCache(CacheMetricsMixin, BaseRedisCache):
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        found = super().get_many(keys, version)
+        record_cache(len(found), len(keys) - len(found))
+        return found
+
+
+class LocMemCache(CacheMetricsMixin, BaseLocMemCache):
+    # Its get_many calls get, which counts the keys
+    pass
+
+
+class Template(BaseTemplate):
+    def render(self, context=None, request=None):
+        metrics = current_metrics.get()
+        if metrics is None or metrics.rendering:
+            # Templates rendered by a template are part of its time
+            return super().render(context, request)
+        metrics.rendering = True
+        started = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            metrics.template_seconds += time.perf_counter() - started
+            metrics.rendering = False
+
+
+class DjangoTemplates(BaseDjangoTemplates):
+    """
+    The Django template backend whose templates add their render time to the metrics of the current request.
+    """
+
+    def from_string(self, template_code):
+        return Template(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        try:
+            return Template(self.engine.get_template(template_name), self)
+        except TemplateDoesNotExist as exc:
+            reraise(exc, self)
+
+
+class ViewStats:
+    __slots__ = ('buckets', 'duration_seconds', 'queries', 'db_seconds', 'cache_hits', 'cache_misses',
+                 'template_seconds')
+
+    def __init__(self, size: int):
+        # The counts of the requests per histogram bucket, the last one is +Inf
+        self.buckets = [0] * (size + 1)
+        self.duration_seconds = 0.0
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.template_seconds = 0.0
+
+
+# The per URL name totals: (metric name, ViewStats attribute, description)
+TOTALS = (
+    ('store_http_request_db_queries_total', 'queries', 'SQL queries by URL name.'),
+    ('store_http_request_db_seconds_total', 'db_seconds', 'SQL time by URL name.'),
+    ('store_http_request_cache_hits_total', 'cache_hits', 'Cache hits by URL name.'),
+    ('store_http_request_cache_misses_total', 'cache_misses', 'Cache misses by URL name.'),
+    ('store_http_request_template_seconds_total', 'template_seconds', 'Template render time by URL name.'),
+)
+
+
+class MetricsRegistry:
+    """
+    Aggregates the request metrics per URL name: the request counts by method and status,
+    the duration histogram and the totals of the queries, the SQL time, the cache lookups and the render time.
+    """
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.requests = {}  # (view, method, status): count
+        self.views = {}  # view: ViewStats
+
+    def observe(self, view: str, method: str, status: int, metrics: RequestMetrics):
+        bucket = bisect_left(self.buckets, metrics.total_seconds)
+        with self.lock:
+            key = (view, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            stats = self.views.get(view)
+            if stats is None:
+                stats = self.views[view] = ViewStats(len(self.buckets))
+            stats.buckets[bucket] += 1
+            stats.duration_seconds += metrics.total_seconds
+            stats.queries += metrics.queries
+            stats.db_seconds += metrics.db_seconds
+            stats.cache_hits += metrics.cache_hits
+            stats.cache_misses += metrics.cache_misses
+            stats.template_seconds += metrics.template_seconds
+
+    def reset(self):
+        with self.lock:
+            self.requests.clear()
+            self.views.clear()
+
+    def render(self) -> str:
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        with self.lock:
+            requests = sorted(self.requests.items())
+            views = [(escape(view), self.views[view]) for view in sorted(self.views)]
+            bounds = [*map(str, self.buckets), '+Inf']
+
+            lines = ['# HELP store_http_requests_total Requests by URL name, method and status.',
+                     '# TYPE store_http_requests_total counter']
+            lines += [f'store_http_requests_total{{view="{escape(view)}",method="{method}",status="{status}"}} {count}'
+                      for (view, method, status), count in requests]
+
+            lines += ['# HELP store_http_request_duration_seconds Request duration by URL name.',
+                      '# TYPE store_http_request_duration_seconds histogram']
+            for view, stats in views:
+                cumulative = 0
+                for bound, count in zip(bounds, stats.buckets):
+                    cumulative += count
+                    lines.append(f'store_http_request_duration_seconds_bucket{{view="{view}",le="{bound}"}} {cumulative}')
+                lines.append(f'store_http_request_duration_seconds_sum{{view="{view}"}} {stats.duration_seconds:.6f}')
+                lines.append(f'store_http_request_duration_seconds_count{{view="{view}"}} {cumulative}')
+
+            for name, attribute, description in TOTALS:
+                lines += [f'# HELP {name} {description}', f'# TYPE {name} counter']
+                lines += [f'{name}{{view="{view}"}} {format_value(getattr(stats, attribute))}' for view, stats in views]
+        return '\n'.join(lines) + '\n'
+
+
+def escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value) -> str:
+    return f'{value:.6f}' if isinstance(value, float) else str(value)
+
+
+REGISTRY = MetricsRegistry()
+
+
+def view_name(request) -> str:
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match is not None and match.view_name else UNRESOLVED
+
+
+class InstrumentationMiddleware:
+    """
+    Measures every request, see `RequestMetrics`, aggregates the numbers in `REGISTRY` and adds
+    a Server-Timing header for staff users. Goes first in `MIDDLEWARE`, so the time covers the other middleware.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        metrics = RequestMetrics()
+        token = current_metrics.set(metrics)
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(connections[alias].execute_wrapper(metrics.execute))
+                response = self.get_response(request)
+        finally:
+            current_metrics.reset(token)
+        metrics.total_seconds = time.perf_counter() - started
+
+        REGISTRY.observe(view_name(request), request.method, response.status_code, metrics)
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_staff:
+            response['Server-Timing'] = metrics.server_timing()
+        return response
+
+
+def metrics_view(request):
+    """
+    Returns the metrics of this process in the Prometheus text format to staff users and to the addresses
+    in `METRICS_ALLOWED_IPS`, empty by default, and a 404 to everybody else.
+    """
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS and not request.user.is_staff:
+        raise Http404
+    return HttpResponse(REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
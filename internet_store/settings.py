@@ -39,9 +39,10 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    # The operator classes of the indexes, see users.models.LowerPrefixIndex
+    'django.contrib.postgres',
     'django_extensions',
     'vitamins.apps.InternetStoreMainConfig',
-    'debug_toolbar',
     'widget_tweaks',
     'users',
     'cart',
@@ -55,21 +56,34 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Goes first, so the request time covers the other middleware
+    'internet_store.metrics.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    # Django's middleware with the verified session user cached, see users.authentication
+    'users.authentication.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'debug_toolbar.middleware.DebugToolbarMiddleware',
 ]
 
+# The debug toolbar patches every request, so it only runs in development
+if DEBUG:
+    INSTALLED_APPS.append('debug_toolbar')
+    MIDDLEWARE.append('debug_toolbar.middleware.DebugToolbarMiddleware')
+
+# Addresses allowed to read /metrics besides staff users, see internet_store.metrics.
+# Empty by default, so /metrics is staff-only: behind a reverse proxy on the same host every client
+# comes from 127.0.0.1. List only addresses the proxy can not forward, e.g. a separate scraper network.
+METRICS_ALLOWED_IPS = [ip for ip in os.getenv('METRICS_ALLOWED_IPS', '').split(',') if ip]
+
 ROOT_URLCONF = 'internet_store.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # Django templates with the render time recorded, see internet_store.metrics
+        'BACKEND': 'internet_store.metrics.DjangoTemplates',
         'DIRS': [
             BASE_DIR / 'templates',
         ],
@@ -109,11 +123,17 @@ MY_EMAIL = os.getenv('MY_EMAIL')
 
 CACHES = {
     "default": {
-        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        # The Redis cache with the hits and misses recorded, see internet_store.metrics
+        "BACKEND": "internet_store.metrics.RedisCache",
         "LOCATION": "redis://127.0.0.1:6379",
     }
 }
 
+# Sessions are read from Redis and written through to the database, which keeps them across a cache flush.
+# The checkout writes the session only when its draft changed, see `cart.checkout.CheckoutDraft.save`
+SESSION_ENGINE = "django.contrib.sessions.backends.cached_db"
+SESSION_CACHE_ALIAS = "default"
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -194,6 +214,37 @@ CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
 
 CELERY_TIMEZONE = 'Europe/Moscow'
 
+CELERY_BEAT_SCHEDULE = {
+    'flush-cart-storages': {
+        'task': 'cart.tasks.flush_cart_storages',
+        'schedule': 60.0,
+    },
+    'flush-promo-counters': {
+        'task': 'cart.tasks.flush_promo_counters',
+        'schedule': 60.0,
+    },
+    'send-outbox-emails': {
+        'task': 'orders.tasks.send_outbox_emails',
+        'schedule': 60.0,
+    },
+    'rollup-daily-sales': {
+        'task': 'orders.tasks.rollup_daily_sales',
+        'schedule': 60.0 * 15,
+    },
+    'compact-stock-ledger': {
+        'task': 'vitamins.tasks.compact_stock_ledger',
+        'schedule': 60.0 * 60 * 24,
+    },
+}
+
+# Cart storage for logged-in users: 'cart.storage.DatabaseCartStorage' keeps carts in the Cart table,
+# 'cart.storage.RedisCartStorage' keeps hot carts in Redis hashes with write-behind persistence.
+# Anonymous users always get a session cart that is merged into their cart on login.
+CART_STORAGE_BACKEND = os.getenv('CART_STORAGE_BACKEND', 'cart.storage.DatabaseCartStorage')
+CART_REDIS_URL = 'redis://127.0.0.1:6379/1'
+CART_REDIS_TTL = 60 * 60 * 24 * 7
+PROMO_COUNTER_BACKEND = os.getenv('PROMO_COUNTER_BACKEND', 'cart.promo.DatabasePromoCounter')
+
 AUTHENTICATION_BACKENDS = [
     'social_core.backends.github.GithubOAuth2',
     'social_core.backends.vk.VKOAuth2',
@@ -201,7 +252,7 @@ AUTHENTICATION_BACKENDS = [
     'django.contrib.auth.backends.ModelBackend',
     'users.authentication.EmailAuthBackend',
 ]
-EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
+EMAIL_BACKEND = os.getenv("EMAIL_BACKEND", "django.core.mail.backends.smtp.EmailBackend")
 
 EMAIL_HOST = "smtp.yandex.ru"
 EMAIL_PORT = 465
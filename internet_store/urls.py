@@ -18,6 +18,7 @@ from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
 
+from internet_store.metrics import metrics_view
 from vitamins.sitemaps import VitaminSitemap, BrandFilterSitemap, CategoryFilterSitemap, HomePageSitemap, \
     ContactPageSitemap
 from vitamins.views import custom_page_not_found_view
@@ -35,7 +36,6 @@ sitemaps = {
 handler404 = custom_page_not_found_view
 
 urlpatterns = [
-    path("__debug__/", include("debug_toolbar.urls")),
     path('captcha/', include('captcha.urls')),
     path('admin/', admin.site.urls),
     path('api/', include('api.urls', namespace='api')),
@@ -45,7 +45,8 @@ urlpatterns = [
     path('orders/', include('orders.urls', namespace='orders')),
     path('', include('vitamins.urls')),
     path('social-auth/', include('social_django.urls', namespace='social')),
-    path('sitemap.xml', sitemap, {'sitemaps': sitemaps}, name='from django.contrib.sitemaps.views import sitemap')
+    path('sitemap.xml', sitemap, {'sitemaps': sitemaps}, name='from django.contrib.sitemaps.views import sitemap'),
+    path('metrics', metrics_view, name='metrics'),
 ]
 
 if settings.DEBUG:
@@ -62,6 +63,6 @@ if settings.DEBUG:
         path('', include('vitamins.urls')),
         path('social-auth/', include('social_django.urls', namespace='social')),
         path('captcha/', include('captcha.urls')),
-        path('sitemap.xml', sitemap, {'sitemaps': sitemaps}, name='from django.contrib.sitemaps.views import sitemap')
-
+        path('sitemap.xml', sitemap, {'sitemaps': sitemaps}, name='from django.contrib.sitemaps.views import sitemap'),
+        path('metrics', metrics_view, name='metrics'),
     ]
@@ -1,8 +1,28 @@
 from django.contrib import admin
 from django.db import transaction
-from django.utils.safestring import mark_safe
+from django.http import HttpResponse
+from django.template.response import TemplateResponse
+from django.urls import path
+from django.utils import timezone
 
-from orders.models import Order, OrderItem, OrderStatus
+from orders.cancellation import cancel_orders
+from orders.export import export_response
+from orders.forms import SalesReportForm
+from orders.models import ArchivedOrder, ArchivedOrderItem, DailySales, EmailStatus, Order, OrderItem, OutboxEmail
+from orders.outbox import schedule_outbox_drain
+from orders.reports import sales_report, write_sales_csv
+from users.admin import UserLookupFilter
+from vitamins.admin import thumbnail, with_main_image
+
+
+@admin.action(description='Выгрузить в CSV')
+def export_csv(modeladmin, request, queryset):
+    return export_response([queryset], f'{queryset.model._meta.model_name}_{timezone.localdate():%Y%m%d}')
+
+
+@admin.action(description='Выгрузить в CSV для Excel')
+def export_excel(modeladmin, request, queryset):
+    return export_response([queryset], f'{queryset.model._meta.model_name}_{timezone.localdate():%Y%m%d}', 'excel')
 
 
 class OrderItemInline(admin.TabularInline):
@@ -10,11 +30,12 @@ class OrderItemInline(admin.TabularInline):
     extra = 0  # Prevents extra empty forms
     readonly_fields = ('vitamin_photo', 'product', 'quantity', 'price', 'discount', 'sum')
 
+    def get_queryset(self, request):
+        return with_main_image(super().get_queryset(request).select_related('product'), 'product')
+
     @admin.display(description='Photo')
     def vitamin_photo(self, instance):
-        if instance.product.images.exists():
-            return mark_safe(f'<img src="{instance.product.images.first().image.url}" width="75" />')
-        return ""
+        return thumbnail(getattr(instance, 'main_image', None), instance.product.title)
 
 
 @admin.register(Order)
@@ -25,27 +46,119 @@ class OrderAdmin(admin.ModelAdmin):
     fields = ['user', 'created_at', 'type_delivery', 'type_payment', 'payment_status', 'status',
               'total_price', 'without_discount', 'discount_sum', 'shipping_address', 'comment', 'email', 'phone_number']
     readonly_fields = ('created_at',)
-    actions = ('canceling_order',)
-    list_filter = ('status', 'type_payment', 'type_delivery', 'payment_status', 'user')
+    actions = ('canceling_order', export_csv, export_excel)
+    list_filter = ('status', 'type_payment', 'type_delivery', 'payment_status', UserLookupFilter)
+    autocomplete_fields = ('user',)
+    search_fields = ('=id', 'email', 'phone_number')
+    list_select_related = ('user',)
+    date_hierarchy = 'created_at'
 
     @admin.action(description='Отменить выбранные заказы')
     def canceling_order(self, request, queryset):
-        with transaction.atomic():
-            for order in queryset:
-                for item in order.items.all():
-                    item.product.adding_count(item.quantity)
-                order.status = OrderStatus.CANCELED
-                order.save()
+        canceled = cancel_orders(queryset)
+        self.message_user(request, f'Отменено заказов: {canceled}')
 
 
 @admin.register(OrderItem)
 class OrderItemAdmin(admin.ModelAdmin):
     list_display = ('id', 'order', 'vitamin_photo', 'product', 'quantity', 'price', 'sum', 'discount')
     readonly_fields = ('vitamin_photo',)
+    list_select_related = ('order', 'product')
+    autocomplete_fields = ('order', 'product')
+
+    def get_queryset(self, request):
+        return with_main_image(super().get_queryset(request), 'product')
 
     @admin.display(description='vitamin_photo')
     def vitamin_photo(self, order_item: OrderItem):
-        return mark_safe(
-            f"<a href='{order_item.product.images.first().image.url if order_item.product.images.first() else order_item.product.pk}'>"
-            f"<img src='{order_item.product.images.first().image.url if order_item.product.images.first() else order_item.product.pk}'"
-            f" alt='{order_item.product.title}' width='75'></a>")
+        return thumbnail(getattr(order_item, 'main_image', None), order_item.product.title)
+
+
+@admin.register(OutboxEmail)
+class OutboxEmailAdmin(admin.ModelAdmin):
+    list_display = ('id', 'subject', 'status', 'attempts', 'created_at', 'next_attempt_at', 'sent_at')
+    list_filter = ('status',)
+    search_fields = ('dedup_key', 'subject')
+    readonly_fields = ('dedup_key', 'subject', 'body', 'html_body', 'from_email', 'recipients', 'status', 'attempts',
+                       'last_error', 'created_at', 'next_attempt_at', 'sent_at')
+    actions = ('resend',)
+
+    @admin.action(description='Отправить повторно')
+    def resend(self, request, queryset):
+        queryset.update(status=EmailStatus.PENDING, attempts=0, next_attempt_at=timezone.now())
+        transaction.on_commit(schedule_outbox_drain)
+
+
+@admin.register(DailySales)
+class DailySalesAdmin(admin.ModelAdmin):
+    list_display = ('date', 'source', 'product', 'brand', 'category', 'type_delivery', 'type_payment',
+                    'units', 'revenue', 'discount')
+    list_filter = ('source', 'type_delivery', 'type_payment', 'date')
+    list_select_related = ('product', 'brand', 'category')
+    date_hierarchy = 'date'
+    change_list_template = 'admin/orders/dailysales/change_list.html'
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def get_urls(self):
+        return [
+            path('dashboard/', self.admin_site.admin_view(self.dashboard_view), name='orders_dailysales_dashboard'),
+        ] + super().get_urls()
+
+    def dashboard_view(self, request):
+        """
+        Shows the sales grouped by brand, category, product, day, delivery or payment type,
+        read from the rollups. With `export=csv` the report is downloaded as a CSV file.
+        """
+        form = SalesReportForm(request.GET or None)
+        params = form.cleaned_data if form.is_valid() else {'group_by': 'brand'}
+        rows = sales_report(params['group_by'], params.get('start'), params.get('end'), params.get('source'))
+
+        if request.GET.get('export') == 'csv':
+            response = HttpResponse(content_type='text/csv; charset=utf-8')
+            response['Content-Disposition'] = f'attachment; filename="sales_{params["group_by"]}.csv"'
+            write_sales_csv(rows, response)
+            return response
+
+        context = {
+            **self.admin_site.each_context(request),
+            'title': 'Продажи',
+            'opts': self.model._meta,
+            'form': form,
+            'rows': rows,
+            'total': {key: sum(row[key] or 0 for row in rows) for key in ('units', 'revenue', 'discount')},
+            'query': request.GET.urlencode(),
+        }
+        return TemplateResponse(request, 'admin/orders/dailysales/dashboard.html', context)
+
+
+class ArchivedOrderItemInline(OrderItemInline):
+    model = ArchivedOrderItem
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(ArchivedOrder)
+class ArchivedOrderAdmin(admin.ModelAdmin):
+    """
+    Read-only access to the archived orders, see `orders.archive`.
+    """
+    list_display = OrderAdmin.list_display + ('archived_at',)
+    inlines = [ArchivedOrderItemInline]
+    fields = OrderAdmin.fields + ['updated_at', 'archived_at']
+    list_filter = ('status', 'type_payment', 'type_delivery', 'payment_status', UserLookupFilter)
+    list_select_related = ('user',)
+    date_hierarchy = 'created_at'
+    actions = (export_csv, export_excel)
+    search_fields = ('=id', 'email', 'phone_number')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
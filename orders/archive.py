@@ -0,0 +1,85 @@
+from django.db import transaction
+from django.http import Http404
+
+from orders.history import bump_history_version
+from orders.models import ArchivedOrder, ArchivedOrderItem, Order, OrderItem, OrderStatus
+from preorders.models import ArchivedPreOrder, ArchivedPreOrderItem, PreOrder, PreOrderItem
+
+# Only orders that will not change any more are archived
+ARCHIVED_STATUSES = (OrderStatus.EXECUTED, OrderStatus.CANCELED)
+BATCH_SIZE = 500
+
+# The hot order and item models with their archive models
+ARCHIVES = {
+    'orders': (Order, OrderItem, ArchivedOrder, ArchivedOrderItem),
+    'preorders': (PreOrder, PreOrderItem, ArchivedPreOrder, ArchivedPreOrderItem),
+}
+
+
+def get_order_or_archived(model, archive_model, **lookup):
+    """
+    Returns the order from the hot table or, if it has been archived, from the archive.
+
+    Raises:
+        Http404: If there is no such order in either of them.
+    """
+    order = model.objects.filter(**lookup).first() or archive_model.objects.filter(**lookup).first()
+    if order is None:
+        raise Http404('Заказ не найден')
+    return order
+
+
+def copy_rows(queryset, target_model):
+    """
+    Inserts the rows of the queryset into a model with the same columns with one INSERT per batch.
+
+    Raises:
+        IntegrityError: If a row conflicts with an existing one, so the batch is rolled back
+            instead of deleting hot rows that were not copied.
+    """
+    attnames = [field.attname for field in queryset.model._meta.concrete_fields]
+    target_model.objects.bulk_create([target_model(**row) for row in queryset.values(*attnames)],
+                                     batch_size=BATCH_SIZE)
+
+
+def archive_batch(model, item_model, archive_model, archive_item_model, before, batch_size: int = BATCH_SIZE) -> int:
+    """
+    Moves a batch of executed or canceled orders created before the moment, with their items,
+    from the hot tables to the archive in one transaction.
+
+    Orders locked by other transactions are skipped and picked up by the next batch.
+
+    Returns:
+        int: The number of archived orders.
+    """
+    with transaction.atomic():
+        orders = list(model.objects.filter(created_at__lt=before, status__in=ARCHIVED_STATUSES)
+                      .select_for_update(skip_locked=True).order_by('pk')
+                      .values_list('pk', 'user_id')[:batch_size])
+        if not orders:
+            return 0
+        order_ids = [pk for pk, _ in orders]
+
+        copy_rows(model.objects.filter(pk__in=order_ids), archive_model)
+        copy_rows(item_model.objects.filter(order_id__in=order_ids), archive_item_model)
+        item_model.objects.filter(order_id__in=order_ids).delete()
+        model.objects.filter(pk__in=order_ids).delete()
+
+        user_ids = {user_id for _, user_id in orders}
+        transaction.on_commit(lambda: bump_history_version(*user_ids))
+    return len(orders)
+
+
+def archive_orders(before, batch_size: int = BATCH_SIZE, names=None):
+    """
+    Moves the executed and canceled orders and preorders created before the moment to the archive
+    batch by batch, so the hot tables are never locked for long.
+
+    Yields:
+        tuple: The archive name and the number of orders moved by each batch.
+    """
+    for name, models in ARCHIVES.items():
+        if names and name not in names:
+            continue
+        while archived := archive_batch(*models, before, batch_size):
+            yield name, archived
@@ -0,0 +1,291 @@
+"""
+The benchmark suite of the store: a data generator, micro-benchmarks of the pricing, the shop filters,
+the cart calculation and the order creation, and a multi-threaded load driver that runs the browse,
+search, add to cart and checkout scenarios through the WSGI app with the Django test client.
+
+Results are dicts of timing summaries, see `summarize`, that `compare` diffs against a stored baseline.
+The `benchmark` management command runs the suite in a throwaway test database.
+"""
+import math
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.contrib.sessions.backends.cached_db import SessionStore
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test import Client, RequestFactory
+from django.urls import reverse
+
+from cart.models import Cart
+from cart.views import calculator_cart, get_cart_checkout_draft
+from orders.models import Order, OrderItem, OrderStatus
+from orders.views import create_order_from_cart
+from users.models import User
+from vitamins.models import Brand, Category, Tag, Vitamin
+from vitamins.testing import seed_catalog
+from vitamins.views import ShopVitamin, calculate_price
+
+PASSWORD = 'benchmark'
+CUSTOMER = {'lastname': 'Иванов', 'firstname': 'Иван', 'email': 'bench@example.com', 'phone': '+79990000000',
+            'comment': ''}
+# Higher is better for these metrics, lower for the others
+HIGHER_IS_BETTER = ('rps',)
+METRICS = ('p50', 'p95', 'p99', 'rps')
+
+
+def percentile(samples: list, percent: float) -> float:
+    """
+    Returns the nearest-rank percentile of the samples.
+    """
+    ordered = sorted(samples)
+    return ordered[max(1, math.ceil(percent / 100 * len(ordered))) - 1]
+
+
+def summarize(samples: list, elapsed: float | None = None, errors: int = 0) -> dict:
+    """
+    Returns the count, the mean and the percentiles of durations in milliseconds and the requests
+    per second, over `elapsed` seconds if given, otherwise over the sum of the durations.
+    """
+    if not samples:
+        return {'count': 0, 'errors': errors}
+    elapsed = elapsed if elapsed is not None else sum(samples) / 1000
+    return {
+        'count': len(samples),
+        'errors': errors,
+        'mean': round(sum(samples) / len(samples), 3),
+        'p50': round(percentile(samples, 50), 3),
+        'p95': round(percentile(samples, 95), 3),
+        'p99': round(percentile(samples, 99), 3),
+        'rps': round(len(samples) / elapsed, 2) if elapsed else None,
+    }
+
+
+def generate_data(vitamins: int, users: int, orders: int, cart_lines: int = 3, seed: int = 1):
+    """
+    Creates a catalog of `vitamins` products, see `vitamins.testing.seed_catalog`, and `users` users
+    with carts of up to `cart_lines` lines and `orders` orders spread over them, all in bulk.
+    """
+    generator = random.Random(seed)
+    seed_catalog(vitamins)
+    # A throwaway database, so the stock is raised directly for the checkouts not to run out of it
+    Vitamin.objects.update(count=10 ** 6)
+
+    password = make_password(PASSWORD)
+    User.objects.bulk_create([User(username=f'bench{number}', email=f'bench{number}@example.com', password=password)
+                              for number in range(users)])
+    user_ids = list(User.objects.filter(username__startswith='bench').values_list('pk', flat=True))
+    products = list(Vitamin.objects.values_list('pk', 'price'))
+
+    Cart.objects.bulk_create([
+        Cart(user_id=user_id, product_id=pk, quantity=generator.randint(1, 3))
+        for user_id in user_ids for pk, _ in generator.sample(products, generator.randint(1, cart_lines))
+    ], batch_size=1000)
+
+    Order.objects.bulk_create([
+        Order(user_id=generator.choice(user_ids), shipping_address='-', email='bench@example.com',
+              status=generator.choice(OrderStatus.values))
+        for _ in range(orders)
+    ], batch_size=1000)
+    OrderItem.objects.bulk_create([
+        OrderItem(order_id=order_id, product_id=pk, quantity=1, price=price, sum=price)
+        for order_id in Order.objects.values_list('pk', flat=True)
+        for pk, price in generator.sample(products, generator.randint(1, 4))
+    ], batch_size=1000)
+    return user_ids
+
+
+def shop_filters() -> dict:
+    """
+    Returns the GET parameters of the shop for each of its filters, with the largest brand, category and tag.
+    """
+    largest = {model: model.objects.annotate(products=Count('vitamins')).order_by('-products')
+               .values_list('slug', flat=True).first() for model in (Brand, Category, Tag)}
+    return {
+        'all': {},
+        'brand': {'brand': largest[Brand]},
+        'category': {'category': largest[Category]},
+        'tag': {'tag': largest[Tag]},
+        'discount': {'discount': '1'},
+        'query': {'query': 'Витамин 1'},
+    }
+
+
+def make_request(user, data: dict | None = None):
+    """
+    Returns a GET request of the user with a session and messages, as the middleware would set them up.
+    """
+    request = RequestFactory().get('/', data or {})
+    request.user = user
+    request.session = SessionStore()
+    request._messages = FallbackStorage(request)
+    return request
+
+
+def repeat(function, times: int) -> list:
+    """
+    Calls the function `times` times and returns the durations in milliseconds.
+    """
+    durations = []
+    for _ in range(times):
+        started = time.perf_counter()
+        function()
+        durations.append((time.perf_counter() - started) * 1000)
+    return durations
+
+
+def run_micro(times: int) -> dict:
+    """
+    Times `calculate_price` over a shop page and a full list, `ShopVitamin.get_queryset` with each
+    filter up to the first page, `calculator_cart` and `create_order_from_cart`. The order creation
+    runs in a transaction that is rolled back, so every run starts from the same cart and stock.
+    """
+    results = {}
+    page, catalog = list(Vitamin.objects.all()[:6]), list(Vitamin.objects.all()[:500])
+    calculate_price(page)  # Loads the cached pricing settings
+    results['calculate_price[6]'] = summarize(repeat(lambda: calculate_price(page), times))
+    results['calculate_price[500]'] = summarize(repeat(lambda: calculate_price(catalog), times))
+
+    user = User.objects.filter(username__startswith='bench').first()
+    for name, data in shop_filters().items():
+        def shop(data=data):
+            view = ShopVitamin()
+            view.setup(make_request(user, data))
+            queryset = view.get_queryset()
+            queryset.count()
+            calculate_price(list(queryset[:ShopVitamin.paginate_by]))
+        results[f'shop_queryset[{name}]'] = summarize(repeat(shop, times))
+
+    results['calculator_cart'] = summarize(repeat(lambda: calculator_cart(make_request(user)), times))
+
+    durations = []
+    for _ in range(times):
+        request = make_request(user)
+        draft = get_cart_checkout_draft(request)
+        draft.set_delivery_option('pickup')
+        draft.set_customer(CUSTOMER)
+        draft.save(request.session)
+        with transaction.atomic():
+            started = time.perf_counter()
+            create_order_from_cart(request, 'Иванов Иван')
+            durations.append((time.perf_counter() - started) * 1000)
+            transaction.set_rollback(True)
+    results['create_order_from_cart'] = summarize(durations)
+    return results
+
+
+class VirtualUser:
+    """
+    Runs the scenarios of one logged-in user with its own test client and records the duration
+    and the status of every request.
+    """
+    SCENARIOS = ('browse', 'search', 'add_to_cart', 'checkout')
+
+    def __init__(self, user, products: list, pages: int, generator: random.Random):
+        self.client = Client(raise_request_exception=False)
+        self.client.force_login(user)
+        self.products = products
+        self.pages = pages
+        self.generator = generator
+        self.samples = []  # (step, milliseconds, status)
+        self.errors = []  # The exceptions of the failed requests
+
+    def request(self, step: str, method: str, url: str, data: dict | None = None):
+        started = time.perf_counter()
+        response = getattr(self.client, method)(url, data or {})
+        self.samples.append((step, (time.perf_counter() - started) * 1000, response.status_code))
+        if getattr(response, 'exc_info', None):
+            self.errors.append(f'{step}: {response.exc_info[1]!r}')
+
+    def browse(self):
+        self.request('home', 'get', reverse('home'))
+        self.request('shop', 'get', reverse('shop'), {'page': self.generator.randint(1, self.pages)})
+        self.request('product', 'get', self.generator.choice(self.products)[1])
+
+    def search(self):
+        self.request('search', 'get', reverse('shop'), {'query': f'Витамин {self.generator.randint(1, 99)}'})
+
+    def add_to_cart(self):
+        pk = self.generator.choice(self.products)[0]
+        self.request('add_to_cart', 'post', reverse('cart:add_to_cart_json', args=[pk]))
+
+    def checkout(self):
+        self.request('checkout1', 'get', reverse('cart:checkout1'))
+        self.request('checkout2', 'post', reverse('cart:checkout2'), {'delivery': 'pickup'})
+        self.request('checkout3', 'post', reverse('cart:checkout3'), CUSTOMER)
+        self.request('checkout4', 'post', reverse('cart:checkout4'), {'payment': 'cash'})
+        self.request('create_order', 'post', reverse('orders:create_order'))
+
+    def run(self, iterations: int):
+        try:
+            for _ in range(iterations):
+                for scenario in self.SCENARIOS:
+                    getattr(self, scenario)()
+        finally:
+            # Every thread has its own database connection
+            connection.close()
+        return self.samples, self.errors
+
+
+def run_load(threads: int, iterations: int, seed: int = 1) -> dict:
+    """
+    Runs `threads` virtual users through `iterations` rounds of the scenarios each and returns
+    the summary of every step and of all requests. A response with a 5xx status counts as an error.
+
+    SQLite locks the whole database for a write, so concurrent checkouts on it fail with
+    "database table is locked" errors, use PostgreSQL for the numbers that matter.
+    """
+    generator = random.Random(seed)
+    users = list(User.objects.filter(username__startswith='bench').order_by('pk')[:threads])
+    products = [(vitamin.pk, vitamin.get_absolute_url())
+                for vitamin in Vitamin.objects.select_related('brand').order_by('pk')[:200]]
+    pages = max(1, Vitamin.objects.count() // ShopVitamin.paginate_by)
+    virtual_users = [VirtualUser(user, products, pages, random.Random(generator.random())) for user in users]
+    lock = threading.Lock()
+    samples, errors = [], []
+
+    def run(virtual_user):
+        result, failed = virtual_user.run(iterations)
+        with lock:
+            samples.extend(result)
+            errors.extend(failed)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(virtual_users)) as pool:
+        for future in [pool.submit(run, virtual_user) for virtual_user in virtual_users]:
+            future.result()
+    elapsed = time.perf_counter() - started
+
+    results = {}
+    for step in dict.fromkeys(step for step, _, _ in samples):
+        durations = [duration for name, duration, _ in samples if name == step]
+        failed = sum(1 for name, _, status in samples if name == step and status >= 500)
+        results[step] = summarize(durations, elapsed, failed)
+    results['total'] = summarize([duration for _, duration, _ in samples], elapsed,
+                                 sum(1 for _, _, status in samples if status >= 500))
+    results['total']['error_samples'] = sorted(set(errors))[:10]
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """
+    Returns the (section, name, metric, baseline, current, change in percent, regressed) rows
+    of the metrics present in both results. A metric regressed if it got worse by more than `threshold` percent.
+    """
+    rows = []
+    for section in ('micro', 'load'):
+        for name, summary in results.get(section, {}).items():
+            base = baseline.get(section, {}).get(name)
+            if not base:
+                continue
+            for metric in METRICS:
+                old, new = base.get(metric), summary.get(metric)
+                if not old or new is None:
+                    continue
+                change = (new - old) / old * 100
+                worse = -change if metric in HIGHER_IS_BETTER else change
+                rows.append((section, name, metric, old, new, round(change, 1), worse > threshold))
+    return rows
@@ -0,0 +1,62 @@
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from orders.history import bump_history_version
+from orders.models import OrderItem, OrderStatus
+from orders.outbox import queue_emails
+from orders.signals import email_version, status_email
+from vitamins.stock import return_stock
+
+
+def bulk_cancel(queryset, item_model, restock, make_email) -> int:
+    """
+    Cancels the orders of the queryset with a fixed number of statements, whatever the number of orders:
+
+        - the not yet canceled orders are locked and read once;
+        - the quantities to restore are summed per order and product with one GROUP BY;
+        - `restock(lines, statuses)` applies them to the products and records them in the stock ledger,
+          see `vitamins.stock`, `statuses` mapping the order ids to their statuses before the cancellation;
+        - the statuses are flipped with one UPDATE;
+        - the cached history pages of the users are invalidated after the commit;
+        - the status emails built by `make_email(order, version)` are written to the outbox
+          with one INSERT and sent after the commit.
+
+    Already canceled orders are skipped, so canceling an order twice does not restore its products twice.
+
+    Returns:
+        int: The number of canceled orders.
+    """
+    with transaction.atomic():
+        # The ids are taken in a subquery, so the joins of an admin changelist are not locked
+        orders = list(queryset.model.objects.filter(pk__in=queryset.values('pk'))
+                      .exclude(status=OrderStatus.CANCELED).select_for_update()
+                      .order_by('pk').only('pk', 'user', 'email', 'status', 'updated_at'))
+        if not orders:
+            return 0
+        order_ids = [order.pk for order in orders]
+
+        lines = list(item_model.objects.filter(order_id__in=order_ids).order_by()
+                     .values('order_id', 'product_id').annotate(quantity=Sum('quantity'))
+                     .values_list('order_id', 'product_id', 'quantity'))
+        restock(lines, {order.pk: order.status for order in orders})
+
+        # The status is updated without save(), so the emails are built here instead of the pre_save signal
+        queryset.model.objects.filter(pk__in=order_ids).update(status=OrderStatus.CANCELED, updated_at=timezone.now())
+
+        emails = []
+        for order in orders:
+            order.status = OrderStatus.CANCELED
+            emails.append(make_email(order, email_version(order)))
+        queue_emails(emails)
+
+        user_ids = {order.user_id for order in orders}
+        transaction.on_commit(lambda: bump_history_version(*user_ids))
+    return len(orders)
+
+
+def cancel_orders(queryset) -> int:
+    """
+    Cancels the orders and returns their products to the stock, see `bulk_cancel`.
+    """
+    return bulk_cancel(queryset, OrderItem, lambda lines, statuses: return_stock(lines), status_email)
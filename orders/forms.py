@@ -0,0 +1,14 @@
+from django import forms
+
+from orders.models import SalesSource
+
+
+class SalesReportForm(forms.Form):
+    group_by = forms.ChoiceField(label='Группировать по', initial='brand', choices=[
+        ('brand', 'Бренд'), ('category', 'Категория'), ('vitamin', 'Товар'), ('date', 'День'),
+        ('delivery', 'Тип доставки'), ('payment', 'Тип оплаты'), ('source', 'Источник'),
+    ])
+    start = forms.DateField(label='С', required=False, widget=forms.DateInput(attrs={'type': 'date'}))
+    end = forms.DateField(label='По', required=False, widget=forms.DateInput(attrs={'type': 'date'}))
+    source = forms.ChoiceField(label='Источник', required=False, choices=[('', 'Все')] + SalesSource.choices)
+
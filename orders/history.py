@@ -0,0 +1,96 @@
+from datetime import datetime
+from uuid import uuid4
+
+from django.core.cache import cache
+from django.db.models import Count, IntegerField, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+
+from vitamins.models import VitaminImage
+
+HISTORY_PAGE_SIZE = 20
+HISTORY_CACHE_TIMEOUT = 60 * 60
+
+
+def get_history_version(user_id: int) -> str:
+    """
+    Returns the version of the user's order history, an opaque token stored in the cache.
+    It changes every time one of the user's orders or preorders is saved, see `bump_history_version`.
+    """
+    return cache.get_or_set(f'order_history_version:{user_id}', lambda: uuid4().hex, None)
+
+
+def bump_history_version(*user_ids):
+    """
+    Invalidates the cached history pages of the users.
+    """
+    cache.set_many({f'order_history_version:{user_id}': uuid4().hex for user_id in user_ids}, None)
+
+
+def encode_cursor(order) -> str:
+    return f'{order.created_at.isoformat()}_{order.pk}'
+
+
+def decode_cursor(cursor: str | None) -> tuple | None:
+    """
+    Returns the creation time and id of the last order of the previous page, or None for an invalid cursor.
+    """
+    if not cursor:
+        return None
+    try:
+        created_at, pk = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(created_at), int(pk)
+    except ValueError:
+        return None
+
+
+def with_item_summary(queryset, item_model):
+    """
+    Annotates every order with the number of its lines (`items_count`) and the image
+    of the product of its first line (`first_image`), computed by subqueries in the same SELECT.
+    """
+    items = item_model.objects.filter(order=OuterRef('pk')).order_by()
+    return queryset.annotate(
+        items_count=Coalesce(Subquery(items.values('order').annotate(count=Count('pk')).values('count')[:1],
+                                      output_field=IntegerField()), 0),
+        first_product_id=Subquery(items.order_by('pk').values('product_id')[:1]),
+    ).annotate(
+        first_image=Subquery(VitaminImage.objects.filter(vitamin_id=OuterRef('first_product_id'))
+                             .values('image')[:1]),
+    )
+
+
+def history_page(model, item_model, user, status: str | None = None, cursor: str | None = None,
+                 page_size: int = HISTORY_PAGE_SIZE, archive: tuple = ()) -> tuple:
+    """
+    Returns a page of the user's orders, newest first, and the cursor of the next page (None on the last page).
+
+    Pages are selected by keyset pagination on (created_at, id), so a page costs one query
+    however many orders the user has, plus one for the archive if `archive` gives its order
+    and item models, see `orders.archive`. The first page is cached per user, model and status
+    until one of the user's orders is saved.
+    """
+    position = decode_cursor(cursor)
+
+    def select(order_model, order_item_model) -> list:
+        orders = order_model.objects.filter(user=user).order_by('-created_at', '-pk') \
+            .only('pk', 'created_at', 'total_price', 'status')
+        if status:
+            orders = orders.filter(status=status)
+        if position:
+            created_at, pk = position
+            orders = orders.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=pk))
+        # One extra row tells whether there is a next page
+        return list(with_item_summary(orders, order_item_model)[:page_size + 1])
+
+    def load():
+        orders = select(model, item_model)
+        if archive:
+            # Both tables are in the same keyset order, so their pages are merged
+            orders = sorted(orders + select(*archive), key=lambda order: (order.created_at, order.pk),
+                            reverse=True)[:page_size + 1]
+        return orders[:page_size], encode_cursor(orders[page_size - 1]) if len(orders) > page_size else None
+
+    if position:
+        return load()
+    key = f'order_history:{model._meta.label_lower}:{user.pk}:{status or ""}:{get_history_version(user.pk)}'
+    return cache.get_or_set(key, load, HISTORY_CACHE_TIMEOUT)
@@ -0,0 +1,25 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from orders.archive import ARCHIVES, BATCH_SIZE, archive_orders
+
+
+class Command(BaseCommand):
+    help = 'Moves executed and canceled orders and preorders older than N months to the archive tables in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months', type=int, default=12, help='Archive the orders older than this.')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+        parser.add_argument('--only', choices=list(ARCHIVES), action='append',
+                            help='Archive only orders or only preorders.')
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(days=30 * options['months'])
+        totals = dict.fromkeys(options['only'] or ARCHIVES, 0)
+        for name, archived in archive_orders(before, options['batch_size'], options['only']):
+            totals[name] += archived
+            self.stdout.write(f'{name}: archived {totals[name]}')
+        for name, total in totals.items():
+            self.stdout.write(f'{name}: {total} archived in total')
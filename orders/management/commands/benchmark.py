@@ -0,0 +1,77 @@
+import json
+import platform
+from unittest import mock
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.runner import DiscoverRunner
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.utils import timezone
+
+from orders.benchmark import compare, generate_data, run_load, run_micro
+
+
+class Command(BaseCommand):
+    help = 'Runs the benchmark suite in a throwaway test database: generates the data, times the ' \
+           'micro-benchmarks and drives the browse, search, add to cart and checkout scenarios with ' \
+           'several threads. Writes p50/p95/p99 and RPS as JSON and compares them with a baseline.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--vitamins', type=int, default=2000)
+        parser.add_argument('--users', type=int, default=20)
+        parser.add_argument('--orders', type=int, default=1000)
+        parser.add_argument('--repeat', type=int, default=50, help='runs of every micro-benchmark')
+        parser.add_argument('--threads', type=int, default=4, help='virtual users of the load run')
+        parser.add_argument('--iterations', type=int, default=10, help='scenario rounds of every virtual user')
+        parser.add_argument('--only', choices=['micro', 'load'])
+        parser.add_argument('--output', help='file for the JSON results, stdout by default')
+        parser.add_argument('--baseline', help='JSON results of an earlier run to compare with')
+        parser.add_argument('--threshold', type=float, default=10, help='allowed regression in percent')
+        parser.add_argument('--fail-on-regression', action='store_true')
+
+    def handle(self, *args, **options):
+        if options['users'] < options['threads']:
+            raise CommandError('Every thread needs its own user, --users must not be less than --threads')
+
+        # DEBUG would log the queries and run the debug toolbar in every request
+        setup_test_environment(debug=False)
+        runner = DiscoverRunner(verbosity=0, interactive=False)
+        databases = runner.setup_databases()
+        try:
+            results = self.run(options)
+        finally:
+            runner.teardown_databases(databases)
+            teardown_test_environment()
+
+        report = json.dumps(results, ensure_ascii=False, indent=2)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as file:
+                file.write(report)
+        else:
+            self.stdout.write(report)
+
+        if options['baseline']:
+            with open(options['baseline'], encoding='utf-8') as file:
+                rows = compare(results, json.load(file), options['threshold'])
+            for section, name, metric, old, new, change, regressed in rows:
+                self.stderr.write(f'{"РЕГРЕССИЯ " if regressed else ""}{section} {name} {metric}: '
+                                  f'{old} → {new} ({change:+}%)')
+            regressions = sum(1 for row in rows if row[-1])
+            if regressions and options['fail_on_regression']:
+                raise CommandError(f'Regressions: {regressions}')
+
+    def run(self, options) -> dict:
+        results = {'meta': {
+            'created_at': timezone.now().isoformat(),
+            'vendor': connection.vendor,
+            'python': platform.python_version(),
+            **{key: options[key] for key in ('vitamins', 'users', 'orders', 'repeat', 'threads', 'iterations')},
+        }}
+        generate_data(options['vitamins'], options['users'], options['orders'])
+        # Emails stay in the outbox instead of being handed to the broker
+        with mock.patch('orders.outbox.schedule_outbox_drain'):
+            if options['only'] in (None, 'micro'):
+                results['micro'] = run_micro(options['repeat'])
+            if options['only'] in (None, 'load'):
+                results['load'] = run_load(options['threads'], options['iterations'])
+        return results
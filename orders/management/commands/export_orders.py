@@ -0,0 +1,31 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+
+from orders.export import EXPORT_FORMATS, EXPORTS, export_lines, filter_orders
+from orders.models import OrderStatus
+
+
+class Command(BaseCommand):
+    help = 'Streams orders or preorders with their items, hot and archived, to a CSV file.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--only', choices=list(EXPORTS), default='orders', help='Export orders or preorders.')
+        parser.add_argument('--start', type=date.fromisoformat, help='The first day, YYYY-MM-DD.')
+        parser.add_argument('--end', type=date.fromisoformat, help='The last day, YYYY-MM-DD.')
+        parser.add_argument('--status', choices=OrderStatus.values, action='append',
+                            help='Export only the orders with this status, can be repeated.')
+        parser.add_argument('--format', choices=list(EXPORT_FORMATS), default='csv',
+                            help='"excel" writes a CSV file Excel opens without import settings.')
+        parser.add_argument('--output', help='The file to write, standard output by default.')
+
+    def handle(self, *args, **options):
+        querysets = [filter_orders(model.objects.all(), options['start'], options['end'], options['status'])
+                     for model in EXPORTS[options['only']]]
+        lines = export_lines(querysets, options['format'])
+        if not options['output']:
+            for line in lines:
+                self.stdout.write(line, ending='')
+            return
+        with open(options['output'], 'w', encoding='utf-8', newline='') as output:
+            output.writelines(lines)
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from orders.reports import update_sales_rollups
+
+
+class Command(BaseCommand):
+    help = 'Rolls up the daily sales of the orders and preorders changed since the previous run.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help='Rebuild the rollups of all days.')
+
+    def handle(self, *args, **options):
+        days = update_sales_rollups(full=options['full'])
+        self.stdout.write(f'Recomputed days: {days}')
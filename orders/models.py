@@ -2,8 +2,10 @@ from django.conf import settings
 from django.core.validators import RegexValidator
 from django.db import models
 from django.urls import reverse
+from django.utils import timezone
 
-from vitamins.models import Vitamin
+from orders.tracking import TrackedFieldsMixin
+from vitamins.models import Brand, Category, Vitamin
 
 
 class OrderStatus(models.TextChoices):
@@ -30,7 +32,7 @@ class PaymentStatus(models.TextChoices):
     PAID = 'paid', 'Оплачен'
 
 
-class Order(models.Model):
+class AbstractOrder(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -47,6 +49,7 @@ class Order(models.Model):
     phone_number = models.CharField(max_length=12, default=0)
 
     class Meta:
+        abstract = True
         ordering = ['-created_at']
 
     def __str__(self):
@@ -57,14 +60,40 @@ class Order(models.Model):
         return reverse('orders:order_detail', kwargs={'order_id': pk})
 
 
-class OrderItem(models.Model):
-    order = models.ForeignKey(Order, related_name='items', on_delete=models.CASCADE)
+class Order(TrackedFieldsMixin, AbstractOrder):
+    class Meta(AbstractOrder.Meta):
+        indexes = [
+            # Keyset pagination of the history, see orders.history
+            models.Index(fields=['user', '-created_at', '-id'], name='order_history_idx'),
+        ]
+
+
+class ArchivedOrder(AbstractOrder):
+    """
+    An order moved out of the hot table by the `archive_orders` command, see `orders.archive`.
+    Keeps the id and the dates of the original.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta(AbstractOrder.Meta):
+        indexes = [
+            models.Index(fields=['user', '-created_at', '-id'], name='archived_order_history_idx'),
+        ]
+
+
+class AbstractOrderItem(models.Model):
     product = models.ForeignKey(Vitamin, on_delete=models.DO_NOTHING)
     quantity = models.IntegerField(default=1)
     price = models.IntegerField(default=0)  # Цена на момент оформления заказа
     sum = models.IntegerField(default=0)
     discount = models.IntegerField(default=0)  # Скидка на момент оформления заказа
 
+    class Meta:
+        abstract = True
+
     def __str__(self):
         return f"{self.quantity} x {self.product}"
 
@@ -72,7 +101,89 @@ class OrderItem(models.Model):
         return self.quantity * self.price - self.discount
 
 
+class OrderItem(AbstractOrderItem):
+    order = models.ForeignKey(Order, related_name='items', on_delete=models.CASCADE)
+
+
+class ArchivedOrderItem(AbstractOrderItem):
+    order = models.ForeignKey(ArchivedOrder, related_name='items', on_delete=models.CASCADE)
+
+
 postal_code_validator = RegexValidator(
     regex=r'^\d{6}$',
     message="Почтовый индекс должен состоять из 6 цифр."
 )
+
+
+class EmailStatus(models.TextChoices):
+    PENDING = 'pending', 'Ожидает отправки'
+    SENT = 'sent', 'Отправлено'
+    FAILED = 'failed', 'Не отправлено'
+
+
+class OutboxEmail(models.Model):
+    """
+    An email written in the same transaction as the change it is about and sent by Celery after commit,
+    see `orders.outbox`.
+    """
+    dedup_key = models.CharField(max_length=255, unique=True)
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    html_body = models.TextField(blank=True)
+    from_email = models.CharField(max_length=255, blank=True)
+    recipients = models.JSONField(default=list)
+    status = models.CharField(max_length=20, choices=EmailStatus.choices, default=EmailStatus.PENDING)
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='outbox_email_due_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.subject} ({self.get_status_display()})'
+
+
+class SalesSource(models.TextChoices):
+    ORDER = 'order', 'Заказ'
+    PREORDER = 'preorder', 'Предзаказ'
+
+
+class DailySales(models.Model):
+    """
+    Sales of a product in a day, summed over the not canceled orders or preorders
+    with the same delivery and payment types, see `orders.reports`.
+    """
+    date = models.DateField()
+    source = models.CharField(max_length=20, choices=SalesSource.choices)
+    product = models.ForeignKey(Vitamin, on_delete=models.DO_NOTHING, db_constraint=False)
+    brand = models.ForeignKey(Brand, on_delete=models.DO_NOTHING, db_constraint=False, null=True)
+    category = models.ForeignKey(Category, on_delete=models.DO_NOTHING, db_constraint=False, null=True)
+    type_delivery = models.CharField(max_length=20, choices=TypeDelivery.choices)
+    type_payment = models.CharField(max_length=20, choices=TypePayment.choices)
+    units = models.IntegerField(default=0)
+    revenue = models.IntegerField(default=0)
+    discount = models.IntegerField(default=0)
+
+    class Meta:
+        ordering = ['-date']
+        verbose_name_plural = 'Daily sales'
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'source', 'product', 'type_delivery', 'type_payment'],
+                                    name='unique_daily_sales'),
+        ]
+
+    def __str__(self):
+        return f'{self.date} {self.product_id}: {self.units}'
+
+
+class SalesRollupState(models.Model):
+    """
+    The single row remembering up to which `updated_at` the orders are rolled up.
+    """
+    processed_until = models.DateTimeField(null=True, blank=True)
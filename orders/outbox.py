@@ -0,0 +1,134 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import transaction
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.html import strip_tags
+
+from orders.models import EmailStatus, OutboxEmail
+
+import logging
+
+
+# We get the Django logger instance that was configured in settings.py
+logger = logging.getLogger('django')
+
+MAX_ATTEMPTS = 5
+# Seconds before the first retry, doubled after every failed attempt
+RETRY_DELAY = 60
+BATCH_SIZE = 100
+
+
+def build_email(dedup_key: str, subject: str, message: str, recipient_list, **context) -> OutboxEmail:
+    """
+    Renders an unsaved outbox email with `email_template.html`.
+    """
+    html_message = render_to_string('email_template.html', {'message': message, **context})
+    return OutboxEmail(
+        dedup_key=dedup_key,
+        subject=subject,
+        body=strip_tags(html_message),
+        html_body=html_message,
+        from_email=settings.EMAIL_HOST_USER or '',
+        recipients=[recipient for recipient in recipient_list if recipient],
+    )
+
+
+def queue_email(dedup_key: str, subject: str, message: str, recipient_list, **context) -> OutboxEmail:
+    """
+    Renders an email with `email_template.html` and writes it to the outbox in the current transaction.
+
+    The email is sent by the `orders.tasks.send_outbox_emails` task scheduled after the transaction commits,
+    so SMTP latency never holds the request or its database locks. An email with an already queued
+    `dedup_key` is not queued again.
+
+    Returns:
+        OutboxEmail: The queued email.
+    """
+    email = build_email(dedup_key, subject, message, recipient_list, **context)
+    email, created = OutboxEmail.objects.get_or_create(dedup_key=dedup_key, defaults={
+        field: getattr(email, field) for field in ('subject', 'body', 'html_body', 'from_email', 'recipients')
+    })
+    if created:
+        transaction.on_commit(schedule_outbox_drain)
+    return email
+
+
+def queue_emails(emails):
+    """
+    Writes several emails built with `build_email` to the outbox with a single INSERT.
+    Emails with already queued dedup keys are skipped.
+    """
+    if emails:
+        OutboxEmail.objects.bulk_create(emails, ignore_conflicts=True)
+        transaction.on_commit(schedule_outbox_drain)
+
+
+def schedule_outbox_drain():
+    from orders.tasks import send_outbox_emails
+
+    try:
+        send_outbox_emails.delay()
+    except Exception as e:
+        # The periodic run of the task will send the email
+        logger.error(f'Не удалось запустить отправку писем: {e}')
+
+
+def _attempt_failed(email: OutboxEmail, error: Exception, now):
+    email.attempts += 1
+    email.last_error = str(error)
+    if email.attempts >= MAX_ATTEMPTS:
+        email.status = EmailStatus.FAILED
+    else:
+        email.next_attempt_at = now + timedelta(seconds=RETRY_DELAY * 2 ** (email.attempts - 1))
+    logger.error(f'Ошибка при отправке письма {email.dedup_key} (попытка {email.attempts}): {error}')
+
+
+def drain_outbox(batch_size: int = BATCH_SIZE) -> int:
+    """
+    Sends the due emails from the outbox over a single SMTP connection.
+
+    Emails are claimed with SELECT ... FOR UPDATE SKIP LOCKED, so several workers can drain the outbox
+    at the same time. A failed email is retried with an exponential backoff up to `MAX_ATTEMPTS` times.
+
+    Returns:
+        int: The number of sent emails.
+    """
+    now = timezone.now()
+    sent = 0
+    with transaction.atomic():
+        emails = list(OutboxEmail.objects.select_for_update(skip_locked=True)
+                      .filter(status=EmailStatus.PENDING, next_attempt_at__lte=now)
+                      .order_by('next_attempt_at')[:batch_size])
+        if not emails:
+            return 0
+
+        connection = get_connection()
+        try:
+            connection.open()
+        except Exception as e:
+            for email in emails:
+                _attempt_failed(email, e, now)
+        else:
+            try:
+                for email in emails:
+                    message = EmailMultiAlternatives(email.subject, email.body, email.from_email or None,
+                                                     email.recipients, connection=connection)
+                    if email.html_body:
+                        message.attach_alternative(email.html_body, 'text/html')
+                    try:
+                        message.send()
+                    except Exception as e:
+                        _attempt_failed(email, e, now)
+                    else:
+                        email.attempts += 1
+                        email.status = EmailStatus.SENT
+                        email.sent_at = timezone.now()
+                        sent += 1
+            finally:
+                connection.close()
+
+        OutboxEmail.objects.bulk_update(emails, ['status', 'attempts', 'last_error', 'next_attempt_at', 'sent_at'])
+    return sent
@@ -0,0 +1,159 @@
+import csv
+from collections import defaultdict
+from datetime import timedelta
+from itertools import chain
+from uuid import uuid4
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from orders.models import ArchivedOrder, ArchivedOrderItem, DailySales, Order, OrderItem, OrderStatus, \
+    SalesRollupState, SalesSource, TypeDelivery, TypePayment
+from preorders.models import ArchivedPreOrder, ArchivedPreOrderItem, PreOrder, PreOrderItem
+
+# Orders committed a bit later than they were updated are picked up by the next run
+ROLLUP_OVERLAP = timedelta(minutes=10)
+REPORTS_VERSION_CACHE_KEY = 'reports_version'
+DASHBOARD_CACHE_TIMEOUT = 60 * 60
+
+# The hot and archived order and item models of every source, see orders.archive
+SOURCES = {
+    SalesSource.ORDER: ((Order, OrderItem), (ArchivedOrder, ArchivedOrderItem)),
+    SalesSource.PREORDER: ((PreOrder, PreOrderItem), (ArchivedPreOrder, ArchivedPreOrderItem)),
+}
+
+# The dimensions the sales can be grouped by: the DailySales field and how its values are displayed
+DIMENSIONS = {
+    'date': ('date', None),
+    'vitamin': ('product__title', None),
+    'brand': ('brand__name', None),
+    'category': ('category__name', None),
+    'delivery': ('type_delivery', dict(TypeDelivery.choices)),
+    'payment': ('type_payment', dict(TypePayment.choices)),
+    'source': ('source', dict(SalesSource.choices)),
+}
+
+
+def get_reports_version() -> str:
+    """
+    Returns the version of the sales rollups, an opaque token stored in the cache.
+    It changes every time the rollups are updated, so cached reports are never stale.
+    """
+    return cache.get_or_set(REPORTS_VERSION_CACHE_KEY, lambda: uuid4().hex, None)
+
+
+def bump_reports_version() -> str:
+    version = uuid4().hex
+    cache.set(REPORTS_VERSION_CACHE_KEY, version, None)
+    return version
+
+
+def changed_days(since=None) -> set:
+    """
+    Returns the days of the orders and preorders updated after `since`, or of all of them.
+    """
+    days = set()
+    for model, _ in chain.from_iterable(SOURCES.values()):
+        orders = model.objects.all()
+        if since is not None:
+            orders = orders.filter(updated_at__gt=since)
+        days.update(orders.order_by().annotate(day=TruncDate('created_at')).values_list('day', flat=True).distinct())
+    return days
+
+
+def daily_sales(item_model, days):
+    """
+    Returns the sales of the not canceled orders created on the days, grouped by the DailySales dimensions.
+    """
+    return item_model.objects.filter(order__created_at__date__in=days) \
+        .exclude(order__status=OrderStatus.CANCELED).order_by() \
+        .values('product_id', date=TruncDate('order__created_at'),
+                brand_id=F('product__brand_id'), category_id=F('product__cat_id'),
+                type_delivery=F('order__type_delivery'), type_payment=F('order__type_payment')) \
+        .annotate(units=Sum('quantity'), revenue=Sum('sum'), discount=Sum(F('quantity') * F('price') - F('sum')))
+
+
+def rollup_days(days) -> int:
+    """
+    Recomputes the daily sales of the days with one GROUP BY query per source and table
+    (hot and archived) and replaces their rows in a single transaction.
+
+    Returns:
+        int: The number of written rows.
+    """
+    days = sorted(days)
+    if not days:
+        return 0
+
+    # The sales of a day may be split between the hot and the archived tables
+    totals = defaultdict(lambda: {'units': 0, 'revenue': 0, 'discount': 0})
+    for source, tables in SOURCES.items():
+        for _, item_model in tables:
+            for values in daily_sales(item_model, days):
+                measures = {name: values.pop(name) for name in ('units', 'revenue', 'discount')}
+                row = totals[(source, *values.items())]
+                for name, value in measures.items():
+                    row[name] += value or 0
+    rows = [DailySales(source=key[0], **dict(key[1:]), **measures) for key, measures in totals.items()]
+
+    with transaction.atomic():
+        DailySales.objects.filter(date__in=days).delete()
+        DailySales.objects.bulk_create(rows, batch_size=1000)
+    return len(rows)
+
+
+def update_sales_rollups(full: bool = False) -> int:
+    """
+    Rolls up the days with orders or preorders created or changed since the previous run.
+
+    Returns:
+        int: The number of recomputed days.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        state, _ = SalesRollupState.objects.select_for_update().get_or_create(pk=1)
+        since = None if full or state.processed_until is None else state.processed_until - ROLLUP_OVERLAP
+        days = changed_days(since)
+        if full:
+            DailySales.objects.all().delete()
+        rollup_days(days)
+        state.processed_until = now
+        state.save()
+    if days:
+        transaction.on_commit(bump_reports_version)
+    return len(days)
+
+
+def sales_report(group_by: str, start=None, end=None, source: str | None = None) -> list:
+    """
+    Returns the units, revenue and discount between the dates grouped by one of the `DIMENSIONS`,
+    read from the rollups and cached until they are updated.
+    """
+    field, labels = DIMENSIONS[group_by]
+
+    def load():
+        sales = DailySales.objects.all()
+        if start:
+            sales = sales.filter(date__gte=start)
+        if end:
+            sales = sales.filter(date__lte=end)
+        if source:
+            sales = sales.filter(source=source)
+        rows = sales.order_by().values(field).annotate(units=Sum('units'), revenue=Sum('revenue'),
+                                                        discount=Sum('discount')).order_by('-revenue', field)
+        return [{'label': labels.get(row[field], row[field]) if labels else row[field],
+                 'units': row['units'], 'revenue': row['revenue'], 'discount': row['discount']}
+                for row in rows]
+
+    key = f'sales_report:{get_reports_version()}:{group_by}:{start}:{end}:{source or ""}'
+    return cache.get_or_set(key, load, DASHBOARD_CACHE_TIMEOUT)
+
+
+def write_sales_csv(rows, file):
+    writer = csv.writer(file)
+    writer.writerow(['Группа', 'Штук', 'Выручка', 'Скидка'])
+    for row in rows:
+        writer.writerow([row['label'], row['units'], row['revenue'], row['discount']])
@@ -1,33 +1,52 @@
-from django.db.models.signals import pre_save
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
-from django.core.mail import send_mail
-from django.template.loader import render_to_string
-from django.utils.html import strip_tags, format_html
+from django.utils.html import format_html
 
 from internet_store import settings
+from orders.history import bump_history_version
+from orders.outbox import build_email, queue_emails
 from orders.models import Order
 
 
+def email_version(order) -> float:
+    """
+    Returns the time of the previous change of the order, tracked by TrackedFieldsMixin.
+    It makes the email key unique for every change, but not for retries of it.
+    """
+    previous_update = order.previous('updated_at')
+    return previous_update.timestamp() if previous_update else 0
+
+
+def status_email(order: Order, version: float):
+    """
+    Builds the email about the new status of the order.
+    """
+    order_link = format_html('<a href="{}">#{}<a/>', order.get_absolute_url(), order.pk)
+    status_message = order.get_status_display()
+    message = format_html('Статус вашего заказа {} изменился на "{}"', order_link, status_message)
+
+    subject = f'Изменение статуса заказа #{order.pk}'
+    return build_email(f'order-status:{order.pk}:{order.status}:{version}', subject, message,
+                       [order.email, settings.MY_EMAIL], order=order)
+
+
 @receiver(pre_save, sender=Order)
 def order_status_changed(sender, instance, **kwargs):
-    if instance.pk:
-        prev_instance = sender.objects.get(pk=instance.pk)
-
-        email_from = settings.EMAIL_HOST_USER
+    """
+    Builds the email about the changed status or payment status while the previous values are known.
+    It is queued by `queue_status_emails` only once the row is saved.
+    """
+    instance._status_emails = []
+    if instance.pk and not instance._state.adding:
+        # The previous values are tracked by TrackedFieldsMixin, so the row is not read again.
+        version = email_version(instance)
 
-        if instance.status != prev_instance.status:
+        if instance.has_changed('status'):
             # Статус заказа изменился
-            order_link = format_html('<a href="{}">#{}<a/>', instance.get_absolute_url(), instance.pk)
-            status_message = instance.get_status_display()
-            message = format_html('Статус вашего заказа {} изменился на "{}"', order_link, status_message)
-
-            subject = f'Изменение статуса заказа #{instance.pk}'
-            html_message = render_to_string('email_template.html', {'order': instance, 'message': message})
-            plain_message = strip_tags(html_message)
-            recipient_list = [instance.email, settings.MY_EMAIL]
-            send_mail(subject, plain_message, email_from, recipient_list, html_message=html_message)
+            instance._status_emails = [status_email(instance, version)]
 
-        elif instance.payment_status != prev_instance.payment_status:
+        elif instance.has_changed('payment_status'):
             # Статус оплаты изменился
             order_link = format_html('<a href="{}">#{}<a/>', instance.get_absolute_url(), instance.pk)
             payment_status_message = instance.get_payment_status_display()
@@ -35,7 +54,19 @@ def order_status_changed(sender, instance, **kwargs):
                                   payment_status_message)
 
             subject = f'Изменение статуса оплаты заказа #{instance.pk}'
-            html_message = render_to_string('email_template.html', {'order': instance, 'message': message})
-            plain_message = strip_tags(html_message)
-            recipient_list = [instance.email, settings.MY_EMAIL]
-            send_mail(subject, plain_message, email_from, recipient_list, html_message=html_message)
\ No newline at end of file
+            dedup_key = f'order-payment-status:{instance.pk}:{instance.payment_status}:{version}'
+            instance._status_emails = [build_email(dedup_key, subject, message, [instance.email, settings.MY_EMAIL],
+                                                   order=instance)]
+
+
+@receiver(post_save, sender=Order)
+def queue_status_emails(sender, instance, **kwargs):
+    # A failed save never gets here, so no email is queued for it
+    queue_emails(instance.__dict__.pop('_status_emails', []))
+
+
+@receiver(post_save, sender=Order)
+@receiver(post_delete, sender=Order)
+def order_history_changed(sender, instance, **kwargs):
+    # The cached history page is invalidated once the change is visible to other requests
+    transaction.on_commit(lambda: bump_history_version(instance.user_id))
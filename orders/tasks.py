@@ -1,16 +1,30 @@
-
 from celery import shared_task
-from django.core.mail import send_mail
 import logging
 
+from orders.outbox import drain_outbox
+from orders.reports import update_sales_rollups
+
 
 # Получаем экземпляр логгера Django, который был настроен в settings.py
 logger = logging.getLogger('django')
 
 
+@shared_task
+def send_outbox_emails():
+    """
+    Sends the due emails from the outbox. Scheduled after every queued email and periodically for retries.
+    """
+    logger.info('Отправка писем...')
+    sent = drain_outbox()
+    logger.info(f'Писем отправлено: {sent}')
+    return sent
+
 
 @shared_task
-def send_email_task(subject, message, email_from, recipient_list):
-    logger.info('Отправка письма...')
-    send_mail(subject, message, email_from, recipient_list)
-    logger.info('Письмо отправлено.')
\ No newline at end of file
+def rollup_daily_sales():
+    """
+    Rolls up the daily sales of the orders and preorders changed since the previous run.
+    """
+    days = update_sales_rollups()
+    logger.info(f'Пересчитано дней продаж: {days}')
+    return days
@@ -3,7 +3,8 @@ from django.urls import reverse
 
 from users.models import User
 from .models import Vitamin, Order, OrderItem, OrderStatus
-from vitamins.models import ExchangeRate, DeliveryCost, Category, Brand
+from vitamins.models import ExchangeRate, DeliveryCost, Category, Brand, Percent
+from cart.checkout import CheckoutDraft
 from cart.models import Cart, PromoCod
 from django.contrib.messages import get_messages
 
@@ -21,6 +22,7 @@ class OrderTestCase(TestCase):
 
         self.exchange_rate = ExchangeRate.objects.create(rate=1.0)
         self.delivery_cost = DeliveryCost.objects.create(cost_per_kg=1.0)
+        self.percent = Percent.objects.create(percent=30)
         self.vitamin = Vitamin.objects.create(
                         title="Vitamin A",
                         price=100,
@@ -35,21 +37,28 @@ class OrderTestCase(TestCase):
                     )
         Cart.objects.create(user=self.user, product=self.vitamin, quantity=2)
         self.promo_code = PromoCod.objects.create(code="DISCOUNT10", discount=10, is_active=True, min_sum=50)
+        self.save_checkout_draft()
 
-        # Set session data for delivery option and address
+    def save_checkout_draft(self):
+        # Set the checkout draft with delivery option and address
         session = self.client.session
-        session['delivery_option'] = 'mail'
-        session['last_name'] = 'test'
-        session['first_name'] = 'test'
-        session['middle_name'] = 'test'
-        session['phone_number'] = 'test'
-        session['region'] = 'test'
-        session['city'] = 'test'
-        session['address'] = 'test'
-        session['postal_code'] = 'test'
-        session['comment'] = 'Test comment'
-        session['type_payment'] = 'cash'
         session['promo_code'] = 'DISCOUNT10'
+        draft = CheckoutDraft()
+        draft.set_delivery_option('mail')
+        draft.set_customer({
+            'lastname': 'test',
+            'firstname': 'test',
+            'middle_name': 'test',
+            'email': 'test@test.com',
+            'phone': 'test',
+            'region': 'test',
+            'city': 'test',
+            'street': 'test',
+            'zip': 'test',
+            'comment': 'Test comment',
+        })
+        draft.set_type_payment('cash')
+        draft.save(session)
         session.save()
 
     def test_create_order_success(self):
@@ -148,3 +157,663 @@ class OrderCancellationTestCase(TestCase):
 
         # Verify redirection to the orders history page
         self.assertRedirects(response, reverse('orders:orders_history'))
+
+
+class OrderPromoCodeTestCase(OrderTestCase):
+    def test_limited_promo_code_is_redeemed_once(self):
+        self.promo_code.usage_limit = 1
+        self.promo_code.save()
+
+        self.client.post(reverse('orders:create_order'))
+        self.promo_code.refresh_from_db()
+        self.assertEqual(self.promo_code.used_count, 1)
+
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+
+class OrderPlacementTestCase(OrderTestCase):
+    def add_products(self, number):
+        for i in range(number):
+            vitamin = Vitamin.objects.create(title=f"Vitamin {i}", price=100, count=10, cat=self.category,
+                                             brand=self.brand, product_code=f"VIT{i}", packaging=1, unit='bottle')
+            Cart.objects.create(user=self.user, product=vitamin, quantity=1)
+
+    def place_order(self):
+        self.save_checkout_draft()
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(reverse('orders:create_order'))
+        return len(queries)
+
+    def test_stock_and_sold_counts_are_updated(self):
+        self.place_order()
+        self.vitamin.refresh_from_db()
+        self.assertEqual(self.vitamin.count, 8)
+        self.assertEqual(self.vitamin.total_sold, 2)
+
+    def test_statement_count_does_not_grow_with_cart(self):
+        self.place_order()  # warms up the pricing and promo code caches
+        Cart.objects.create(user=self.user, product=self.vitamin, quantity=1)
+        one_line = self.place_order()
+        Cart.objects.create(user=self.user, product=self.vitamin, quantity=1)
+        self.add_products(5)
+        self.assertEqual(self.place_order(), one_line)
+        self.assertEqual(Order.objects.count(), 3)
+        self.assertEqual(OrderItem.objects.count(), 8)
+
+    def test_short_line_rolls_back_the_order(self):
+        self.add_products(1)
+        # Build the checkout draft, then let another checkout take the stock
+        self.client.get(reverse('cart:checkout4'))
+        Vitamin.objects.filter(pk=self.vitamin.pk).update(count=1)
+
+        response = self.client.post(reverse('orders:create_order'), follow=True)
+        self.assertEqual(Order.objects.count(), 0)
+        self.assertEqual(Vitamin.objects.get(title="Vitamin 0").count, 10)
+        self.assertEqual(Cart.objects.filter(user=self.user).count(), 2)
+        messages = [m.message for m in get_messages(response.wsgi_request)]
+        self.assertIn('Произошла ошибка при создании заказа: Недостаточно товара на складе для Vitamin A', messages)
+
+
+from unittest import mock, skipUnless
+
+from django.test import override_settings
+from cart.promo import RedisPromoCounter, get_promo_rule
+from cart.storage import RedisCartStorage
+from cart.tests import redis_available
+
+
+@skipUnless(redis_available(), 'Redis is not available')
+@override_settings(CART_STORAGE_BACKEND='cart.storage.RedisCartStorage')
+class RedisCartOrderTestCase(OrderTestCase):
+    def setUp(self):
+        super().setUp()
+        self.storage = RedisCartStorage(self.user)
+        self.storage.redis.delete(self.storage.key)
+        self.storage.redis.srem(RedisCartStorage.DIRTY_SET, self.storage.key)
+        self.addCleanup(self.storage.redis.delete, self.storage.key)
+        # Loads the cart into Redis, as browsing the shop does
+        self.assertEqual(self.storage.items(), {self.vitamin.id: 2})
+
+    def test_order_empties_the_redis_cart(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('orders:create_order'))
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(self.storage.items(), {})
+
+        # The ordered lines are not written back by the next change or flush
+        self.storage.add(self.vitamin.id)
+        self.storage.flush()
+        self.assertEqual(Cart.objects.get().quantity, 1)
+
+    @override_settings(PROMO_COUNTER_BACKEND='cart.promo.RedisPromoCounter')
+    def test_failure_after_the_order_keeps_the_promo_code_and_cart(self):
+        self.promo_code.usage_limit = 1
+        self.promo_code.save()
+        counter = RedisPromoCounter()
+        counter_key = counter.key(self.promo_code.id)
+        self.storage.redis.delete(counter_key)
+        self.addCleanup(self.storage.redis.delete, counter_key)
+
+        with mock.patch('orders.views.queue_email', side_effect=RuntimeError('SMTP is down')), \
+                self.captureOnCommitCallbacks(execute=True), self.assertRaises(RuntimeError):
+            self.client.post(reverse('orders:create_order'))
+        self.assertEqual(Order.objects.count(), 0)
+        self.assertEqual(counter.usage(get_promo_rule('DISCOUNT10'), self.user.pk), (0, 0))
+        self.assertEqual(self.storage.items(), {self.vitamin.id: 2})
+
+    def test_failed_order_keeps_the_redis_cart(self):
+        # Build the checkout draft, then let another checkout take the stock
+        self.client.get(reverse('cart:checkout4'))
+        Vitamin.objects.filter(pk=self.vitamin.pk).update(count=1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('orders:create_order'))
+        self.assertEqual(Order.objects.count(), 0)
+        self.assertEqual(self.storage.items(), {self.vitamin.id: 2})
+        self.assertEqual(Cart.objects.get().quantity, 2)
+
+
+from smtplib import SMTPException
+
+from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend
+from django.test import override_settings
+from .models import EmailStatus, OutboxEmail
+from .outbox import MAX_ATTEMPTS, RETRY_DELAY, drain_outbox, queue_email, schedule_outbox_drain
+
+
+class CountingEmailBackend(EmailBackend):
+    opened = 0
+
+    def open(self):
+        CountingEmailBackend.opened += 1
+        return super().open()
+
+
+class FailingEmailBackend(EmailBackend):
+    def send_messages(self, messages):
+        raise SMTPException('Сервер недоступен')
+
+
+class OutboxTestCase(TestCase):
+    def queue(self, key='test:1'):
+        return queue_email(key, 'Тема', 'Сообщение', ['test@test.com', None])
+
+    def test_email_is_queued_and_sent_after_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            email = self.queue()
+            self.queue()
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(OutboxEmail.objects.count(), 1)
+        self.assertEqual(email.recipients, ['test@test.com'])
+        self.assertEqual(len(mail.outbox), 0)
+
+        self.assertEqual(drain_outbox(), 1)
+        self.assertEqual(mail.outbox[0].subject, 'Тема')
+        self.assertEqual(mail.outbox[0].alternatives[0][1], 'text/html')
+        self.assertEqual(OutboxEmail.objects.get().status, EmailStatus.SENT)
+        self.assertEqual(drain_outbox(), 0)
+
+    @override_settings(EMAIL_BACKEND='orders.tests.CountingEmailBackend')
+    def test_connection_is_reused(self):
+        CountingEmailBackend.opened = 0
+        for i in range(3):
+            self.queue(f'test:{i}')
+        self.assertEqual(drain_outbox(), 3)
+        self.assertEqual(CountingEmailBackend.opened, 1)
+
+    @override_settings(EMAIL_BACKEND='orders.tests.FailingEmailBackend')
+    def test_failed_email_is_retried_with_backoff(self):
+        email = self.queue()
+        self.assertEqual(drain_outbox(), 0)
+        email.refresh_from_db()
+        self.assertEqual(email.status, EmailStatus.PENDING)
+        self.assertEqual(email.attempts, 1)
+        self.assertGreaterEqual((email.next_attempt_at - email.created_at).total_seconds(), RETRY_DELAY)
+        # Not due yet
+        self.assertEqual(drain_outbox(), 0)
+        self.assertEqual(OutboxEmail.objects.get().attempts, 1)
+
+        OutboxEmail.objects.update(attempts=MAX_ATTEMPTS - 1, next_attempt_at=email.created_at)
+        drain_outbox()
+        self.assertEqual(OutboxEmail.objects.get().status, EmailStatus.FAILED)
+
+    def test_order_status_change_is_queued(self):
+        user = User.objects.create_user(username='testuser', password='testpass')
+        order = Order.objects.create(user=user, email='test@test.com', phone_number='1')
+        with self.captureOnCommitCallbacks() as callbacks:
+            order.status = OrderStatus.PROCESSING
+            order.save()
+        self.assertIn(schedule_outbox_drain, callbacks)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertTrue(OutboxEmail.objects.filter(dedup_key__startswith=f'order-status:{order.pk}:').exists())
+
+
+from django.db import DatabaseError
+from django.test import TransactionTestCase
+
+
+class OutboxAutocommitTestCase(TransactionTestCase):
+    def test_failed_status_change_is_not_queued(self):
+        user = User.objects.create_user(username='testuser', password='testpass')
+        order = Order.objects.create(user=user, email='test@test.com', phone_number='1')
+        order.status = OrderStatus.PROCESSING
+        with mock.patch('orders.outbox.schedule_outbox_drain') as schedule:
+            with mock.patch.object(Order, '_do_update', side_effect=DatabaseError), self.assertRaises(DatabaseError):
+                order.save()
+            self.assertFalse(OutboxEmail.objects.exists())
+            schedule.assert_not_called()
+
+            order.save()
+            self.assertTrue(OutboxEmail.objects.filter(dedup_key__startswith=f'order-status:{order.pk}:').exists())
+            schedule.assert_called_once()
+
+
+class TrackedFieldsTestCase(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username='testuser', password='testpass')
+        Order.objects.create(user=user, email='test@test.com', phone_number='1')
+
+    def test_changes_are_detected_without_a_query(self):
+        order = Order.objects.get()
+        self.assertEqual(order.changed_fields, {})
+        order.status = OrderStatus.PROCESSING
+        with self.assertNumQueries(0):
+            self.assertTrue(order.has_changed('status'))
+            self.assertFalse(order.has_changed('payment_status'))
+            self.assertEqual(order.previous('status'), OrderStatus.NEW)
+        self.assertEqual(order.changed_fields, {'status': (OrderStatus.NEW, OrderStatus.PROCESSING)})
+
+    def test_save_updates_only_changed_fields(self):
+        order = Order.objects.get()
+        Order.objects.update(comment='Изменено в другом месте')
+        order.status = OrderStatus.PROCESSING
+        with CaptureQueriesContext(connection) as queries:
+            order.save()
+        # No SELECT of the previous row, only the UPDATE and the queued email
+        self.assertFalse(any(query['sql'].startswith('SELECT "orders_order"') for query in queries.captured_queries))
+        self.assertFalse(order.has_changed('status'))
+
+        order.refresh_from_db()
+        self.assertEqual(order.status, OrderStatus.PROCESSING)
+        self.assertEqual(order.comment, 'Изменено в другом месте')
+        self.assertEqual(order.changed_fields, {})
+
+
+from .cancellation import cancel_orders
+
+
+class OrderBulkCancellationTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.client = Client()
+        self.client.login(username='testuser', password='testpass')
+        category = Category.objects.create(name='Supplements', slug='supplements')
+        brand = Brand.objects.create(name='Nature Made', slug='nature-made')
+        self.vitamins = [Vitamin.objects.create(title=f"Vitamin {i}", price=100, count=10, cat=category, brand=brand,
+                                                product_code=f"VIT{i}", packaging=1, unit='bottle')
+                         for i in range(3)]
+
+    def create_order(self, quantity=1, user=None):
+        order = Order.objects.create(user=user or self.user, email='test@test.com', phone_number='1')
+        for vitamin in self.vitamins:
+            OrderItem.objects.create(order=order, product=vitamin, quantity=quantity)
+        return order
+
+    def test_statement_count_does_not_grow_with_orders(self):
+        self.create_order()
+        with CaptureQueriesContext(connection) as one_order:
+            cancel_orders(Order.objects.all())
+        for quantity in range(1, 6):
+            self.create_order(quantity)
+        with CaptureQueriesContext(connection) as five_orders:
+            self.assertEqual(cancel_orders(Order.objects.all()), 5)
+        self.assertEqual(len(one_order), len(five_orders))
+
+        for vitamin in self.vitamins:
+            vitamin.refresh_from_db()
+            self.assertEqual(vitamin.count, 10 + 1 + 15)
+        self.assertFalse(Order.objects.exclude(status=OrderStatus.CANCELED).exists())
+        self.assertEqual(OutboxEmail.objects.filter(dedup_key__startswith='order-status:').count(), 6)
+
+    def test_canceled_order_is_not_restocked_twice(self):
+        order = self.create_order(2)
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            cancel_orders(Order.objects.filter(pk=order.pk))
+        # The outbox drain and the history invalidation
+        self.assertEqual(len(callbacks), 2)
+        self.assertEqual(cancel_orders(Order.objects.filter(pk=order.pk)), 0)
+        self.vitamins[0].refresh_from_db()
+        self.assertEqual(self.vitamins[0].count, 12)
+
+    def test_user_cancels_only_own_orders(self):
+        other = User.objects.create_user(username='other', password='testpass')
+        order = self.create_order(user=other)
+        response = self.client.get(reverse('orders:canceling_order', kwargs={'order_id': order.pk}))
+        self.assertRedirects(response, reverse('orders:orders_history'))
+        order.refresh_from_db()
+        self.assertEqual(order.status, OrderStatus.NEW)
+
+        order = self.create_order()
+        self.client.get(reverse('orders:canceling_order', kwargs={'order_id': order.pk}))
+        order.refresh_from_db()
+        self.assertEqual(order.status, OrderStatus.CANCELED)
+
+
+from django.core.cache import cache
+from .history import history_page
+
+
+class OrderHistoryTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.client = Client()
+        self.client.login(username='testuser', password='testpass')
+        category = Category.objects.create(name='Supplements', slug='supplements')
+        brand = Brand.objects.create(name='Nature Made', slug='nature-made')
+        self.vitamin = Vitamin.objects.create(title="Vitamin A", price=100, count=10, cat=category, brand=brand,
+                                              product_code="VIT100", packaging=1, unit='bottle')
+        for i in range(25):
+            order = Order.objects.create(user=self.user, email='test@test.com', phone_number='1',
+                                         status=OrderStatus.CANCELED if i % 5 == 0 else OrderStatus.NEW)
+            OrderItem.objects.create(order=order, product=self.vitamin, quantity=1)
+            OrderItem.objects.create(order=order, product=self.vitamin, quantity=2)
+
+    def test_pages_are_selected_by_cursor(self):
+        with self.assertNumQueries(1):
+            first, cursor = history_page(Order, OrderItem, self.user)
+        self.assertEqual(len(first), 20)
+        self.assertEqual(first[0].items_count, 2)
+        with self.assertNumQueries(1):
+            second, next_cursor = history_page(Order, OrderItem, self.user, cursor=cursor)
+        self.assertIsNone(next_cursor)
+        self.assertEqual([order.pk for order in first + second],
+                         list(Order.objects.order_by('-created_at', '-pk').values_list('pk', flat=True)))
+
+    def test_status_filter(self):
+        orders, cursor = history_page(Order, OrderItem, self.user, status=OrderStatus.CANCELED)
+        self.assertEqual(len(orders), 5)
+        self.assertIsNone(cursor)
+        response = self.client.get(reverse('orders:orders_history'), {'status': OrderStatus.CANCELED})
+        self.assertEqual(len(response.context['orders']), 5)
+
+    def test_first_page_is_cached_until_an_order_is_saved(self):
+        self.client.get(reverse('orders:orders_history'))
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('orders:orders_history'))
+        self.assertFalse(any('"orders_order"' in query['sql'] for query in queries.captured_queries))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Order.objects.create(user=self.user, email='test@test.com', phone_number='1')
+        response = self.client.get(reverse('orders:orders_history'))
+        self.assertEqual(response.context['orders'][0].pk, Order.objects.order_by('-pk').first().pk)
+
+
+from datetime import timedelta
+
+from django.utils import timezone
+from preorders.models import PreOrder, PreOrderItem
+from .models import DailySales, SalesSource, TypeDelivery
+from .reports import sales_report, update_sales_rollups
+
+
+class SalesRollupTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        category = Category.objects.create(name='Supplements', slug='supplements')
+        self.brands = [Brand.objects.create(name=f'Brand {i}', slug=f'brand-{i}') for i in range(2)]
+        self.vitamins = [Vitamin.objects.create(title=f"Vitamin {i}", price=100, count=10, cat=category, brand=brand,
+                                                product_code=f"VIT{i}", packaging=1, unit='bottle')
+                         for i, brand in enumerate(self.brands)]
+        self.yesterday = timezone.now() - timedelta(days=1)
+
+    def create_order(self, vitamin, quantity, created_at=None, model=Order, item_model=OrderItem, **kwargs):
+        order = model.objects.create(user=self.user, email='test@test.com', phone_number='1', **kwargs)
+        item_model.objects.create(order=order, product=vitamin, quantity=quantity, price=100, sum=90 * quantity)
+        if created_at:
+            model.objects.filter(pk=order.pk).update(created_at=created_at)
+        return order
+
+    def test_rollups_are_grouped_and_incremental(self):
+        self.create_order(self.vitamins[0], 2, self.yesterday)
+        self.create_order(self.vitamins[0], 1, type_delivery=TypeDelivery.POST)
+        self.create_order(self.vitamins[1], 3)
+        self.create_order(self.vitamins[1], 5, model=PreOrder, item_model=PreOrderItem)
+
+        self.assertEqual(update_sales_rollups(), 2)
+        self.assertEqual(DailySales.objects.count(), 4)
+        report = {row['label']: row for row in sales_report('brand')}
+        self.assertEqual(report['Brand 0']['units'], 3)
+        self.assertEqual(report['Brand 0']['revenue'], 270)
+        self.assertEqual(report['Brand 0']['discount'], 30)
+        self.assertEqual(report['Brand 1']['units'], 8)
+        self.assertEqual({row['label']: row['units'] for row in sales_report('source')},
+                         {'Заказ': 6, 'Предзаказ': 5})
+
+        # Nothing has changed since the overlap with the previous run, so no day is recomputed
+        for model in (Order, PreOrder):
+            model.objects.update(updated_at=self.yesterday)
+        self.assertEqual(update_sales_rollups(), 0)
+
+        order = self.create_order(self.vitamins[1], 4)
+        order.status = OrderStatus.CANCELED
+        order.save()
+        self.assertEqual(update_sales_rollups(), 1)
+        self.assertEqual({row['label']: row['units'] for row in sales_report('brand')}, {'Brand 0': 3, 'Brand 1': 8})
+        self.assertEqual(sum(row['units'] for row in sales_report('date', start=timezone.now().date())), 9)
+
+    def test_dashboard_csv_export(self):
+        self.create_order(self.vitamins[0], 2)
+        update_sales_rollups()
+        admin_user = User.objects.create_superuser(username='admin', password='adminpass', email='admin@test.com')
+        self.client.force_login(admin_user)
+        response = self.client.get(reverse('admin:orders_dailysales_dashboard'),
+                                   {'group_by': 'vitamin', 'source': SalesSource.ORDER, 'export': 'csv'})
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertIn('Vitamin 0,2,180,20', response.content.decode())
+
+        response = self.client.get(reverse('admin:orders_dailysales_dashboard'), {'group_by': 'payment'})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(reverse('admin:orders_dailysales_changelist'))
+        self.assertContains(response, reverse('admin:orders_dailysales_dashboard'))
+
+
+from django.db import IntegrityError
+from .archive import archive_orders
+from .models import ArchivedOrder, ArchivedOrderItem
+
+
+class OrderArchiveTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.client = Client()
+        self.client.login(username='testuser', password='testpass')
+        category = Category.objects.create(name='Supplements', slug='supplements')
+        brand = Brand.objects.create(name='Nature Made', slug='nature-made')
+        self.vitamin = Vitamin.objects.create(title="Vitamin A", price=100, count=10, cat=category, brand=brand,
+                                              product_code="VIT100", packaging=1, unit='bottle')
+        self.old = timezone.now() - timedelta(days=400)
+        self.orders = []
+        for i, status in enumerate([OrderStatus.EXECUTED, OrderStatus.CANCELED, OrderStatus.NEW, OrderStatus.EXECUTED]):
+            order = Order.objects.create(user=self.user, email='test@test.com', phone_number='1', status=status)
+            OrderItem.objects.create(order=order, product=self.vitamin, quantity=i + 1, price=100, sum=100 * (i + 1))
+            if i < 3:
+                Order.objects.filter(pk=order.pk).update(created_at=self.old + timedelta(minutes=i))
+            self.orders.append(order)
+
+    def test_old_final_orders_are_moved_in_batches(self):
+        batches = list(archive_orders(timezone.now() - timedelta(days=365), batch_size=1, names=['orders']))
+        self.assertEqual(batches, [('orders', 1), ('orders', 1)])
+        self.assertEqual(set(ArchivedOrder.objects.values_list('pk', flat=True)),
+                         {self.orders[0].pk, self.orders[1].pk})
+        self.assertEqual(ArchivedOrderItem.objects.get(order_id=self.orders[1].pk).quantity, 2)
+        self.assertEqual(ArchivedOrder.objects.get(pk=self.orders[0].pk).created_at, self.old)
+        self.assertEqual(set(Order.objects.values_list('pk', flat=True)), {self.orders[2].pk, self.orders[3].pk})
+
+    def test_conflicting_archive_row_keeps_the_batch(self):
+        ArchivedOrder.objects.create(pk=self.orders[0].pk, user=self.user, email='other@test.com',
+                                     phone_number='2', status=OrderStatus.EXECUTED, created_at=self.old,
+                                     updated_at=self.old)
+        with self.assertRaises(IntegrityError):
+            list(archive_orders(timezone.now() - timedelta(days=365), names=['orders']))
+        self.assertEqual(Order.objects.count(), 4)
+        self.assertEqual(OrderItem.objects.count(), 4)
+        self.assertEqual(ArchivedOrder.objects.get().email, 'other@test.com')
+        self.assertFalse(ArchivedOrderItem.objects.exists())
+
+    def test_archived_orders_are_read_transparently(self):
+        list(archive_orders(timezone.now() - timedelta(days=365)))
+        response = self.client.get(reverse('orders:orders_history'))
+        self.assertEqual([order.pk for order in response.context['orders']],
+                         [order.pk for order in reversed(self.orders)])
+        self.assertEqual(response.context['orders'][-1].items_count, 1)
+
+        response = self.client.get(reverse('orders:order_detail', kwargs={'order_id': self.orders[0].pk}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item.quantity for item in response.context['order_items']], [1])
+
+        update_sales_rollups(full=True)
+        self.assertEqual(sum(row['units'] for row in sales_report('date')), 1 + 3 + 4)
+
+    def test_archived_orders_in_admin(self):
+        list(archive_orders(timezone.now() - timedelta(days=365)))
+        admin_user = User.objects.create_superuser(username='admin', password='adminpass', email='admin@test.com')
+        self.client.force_login(admin_user)
+        response = self.client.get(reverse('admin:orders_archivedorder_changelist'))
+        self.assertContains(response, f'>{self.orders[0].pk}<')
+        response = self.client.get(reverse('admin:orders_archivedorder_change', args=[self.orders[0].pk]))
+        self.assertEqual(response.status_code, 200)
+
+        pk = self.orders[0].pk
+        ArchivedOrder.objects.update(phone_number='')
+        ArchivedOrder.objects.create(pk=int(f'{pk}{pk}'), user=self.user, email='other@test.com', phone_number='',
+                                     status=OrderStatus.EXECUTED, created_at=self.old, updated_at=self.old)
+        response = self.client.get(reverse('admin:orders_archivedorder_changelist'), {'q': str(pk)})
+        self.assertEqual([order.pk for order in response.context['cl'].result_list], [pk])
+        response = self.client.get(reverse('admin:orders_archivedorder_changelist'), {'q': 'other@'})
+        self.assertEqual([order.pk for order in response.context['cl'].result_list], [int(f'{pk}{pk}')])
+
+
+import csv
+from io import StringIO
+
+from django.contrib.admin import helpers
+from django.core.management import call_command
+
+
+class OrderExportTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        category = Category.objects.create(name='Supplements', slug='supplements')
+        brand = Brand.objects.create(name='Nature Made', slug='nature-made')
+        self.vitamins = [Vitamin.objects.create(title=f"Vitamin {i}", price=100, count=10, cat=category, brand=brand,
+                                                product_code=f"VIT{i}", packaging=1, unit='bottle')
+                         for i in range(2)]
+        self.orders = []
+        for i, status in enumerate([OrderStatus.EXECUTED, OrderStatus.NEW, OrderStatus.EXECUTED]):
+            order = Order.objects.create(user=self.user, email='test@test.com', phone_number='1', status=status)
+            for vitamin in self.vitamins:
+                OrderItem.objects.create(order=order, product=vitamin, quantity=i + 1, price=100, sum=100 * (i + 1))
+            Order.objects.filter(pk=order.pk).update(created_at=timezone.now() - timedelta(days=400 - i * 100))
+            self.orders.append(order)
+
+    def export(self, *args) -> list:
+        output = StringIO()
+        call_command('export_orders', *args, stdout=output)
+        return list(csv.reader(StringIO(output.getvalue())))
+
+    def test_command_filters_by_date_and_status(self):
+        rows = self.export()
+        self.assertEqual(len(rows), 1 + 3 * 2)
+        self.assertEqual(rows[1][12:15], ['VIT0', 'Vitamin 0', '1'])
+
+        start = (timezone.now() - timedelta(days=350)).date().isoformat()
+        rows = self.export('--start', start, '--status', OrderStatus.EXECUTED)
+        self.assertEqual({row[0] for row in rows[1:]}, {str(self.orders[2].pk)})
+
+    def test_command_reads_archived_orders(self):
+        list(archive_orders(timezone.now() - timedelta(days=365)))
+        self.assertEqual(ArchivedOrder.objects.count(), 1)
+        rows = self.export()
+        self.assertEqual(sorted({int(row[0]) for row in rows[1:]}), [order.pk for order in self.orders])
+
+    def test_admin_action_streams_in_constant_queries(self):
+        admin_user = User.objects.create_superuser(username='admin', password='adminpass', email='admin@test.com')
+        self.client.force_login(admin_user)
+        data = {'action': 'export_excel', helpers.ACTION_CHECKBOX_NAME: [order.pk for order in self.orders]}
+        response = self.client.post(reverse('admin:orders_order_changelist'), data)
+        self.assertTrue(response.streaming)
+        with CaptureQueriesContext(connection) as queries:
+            content = b''.join(response.streaming_content).decode()
+        # The orders with their users, then the items and the products of the chunk
+        self.assertEqual(len(queries), 3)
+        self.assertTrue(content.startswith('\ufeff'))
+        rows = list(csv.reader(StringIO(content.lstrip('\ufeff')), delimiter=';'))
+        self.assertEqual(len(rows), 1 + 3 * 2)
+
+
+from vitamins.models import VitaminImage
+
+
+class OrderAdminQueriesTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.category = Category.objects.create(name='Supplements', slug='supplements')
+        self.order = Order.objects.create(user=self.user, email='test@test.com', phone_number='1')
+        admin_user = User.objects.create_superuser(username='admin', password='adminpass', email='admin@test.com')
+        self.client.force_login(admin_user)
+
+    def add_items(self, number: int):
+        for i in range(OrderItem.objects.count(), OrderItem.objects.count() + number):
+            vitamin = Vitamin.objects.create(title=f"Vitamin {i}", price=100, cat=self.category,
+                                             product_code=f"VIT{i}", packaging=1, unit='bottle')
+            VitaminImage.objects.create(vitamin=vitamin, image=f'vitamins_images/{i}.jpg')
+            OrderItem.objects.create(order=self.order, product=vitamin, quantity=1, price=100, sum=100)
+
+    def page_queries(self, url: str) -> int:
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_order_and_items_pages_queries_do_not_grow_with_items(self):
+        order_url = reverse('admin:orders_order_change', args=[self.order.pk])
+        items_url = reverse('admin:orders_orderitem_changelist')
+        self.add_items(1)
+        # The first request fills the content type cache
+        self.client.get(order_url)
+        queries = self.page_queries(order_url), self.page_queries(items_url)
+        self.add_items(49)
+        self.assertContains(self.client.get(order_url), "src='/media/vitamins_images/49.jpg'")
+        self.assertEqual((self.page_queries(order_url), self.page_queries(items_url)), queries)
+
+
+class OrderAdminLookupTestCase(TestCase):
+    def setUp(self):
+        self.admin_user = User.objects.create_superuser(username='admin', password='adminpass', email='admin@test.com')
+        self.client.force_login(self.admin_user)
+        self.buyer = User.objects.create_user(username='buyer', password='testpass', email='buyer@test.com')
+        self.order = Order.objects.create(user=self.buyer, email='buyer@test.com', phone_number='1')
+        Order.objects.create(user=self.admin_user, email='admin@test.com', phone_number='1')
+
+    def changelist_queries(self, **params) -> tuple:
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('admin:orders_order_changelist'), params)
+        return response, len(queries)
+
+    def test_user_filter_does_not_list_users(self):
+        response, queries = self.changelist_queries()
+        User.objects.bulk_create([User(username=f'user{i}', email=f'user{i}@test.com') for i in range(30)])
+        response, more_users_queries = self.changelist_queries()
+        self.assertEqual(more_users_queries, queries)
+        self.assertNotContains(response, 'user29')
+
+        response, _ = self.changelist_queries(user='buy')
+        self.assertEqual(list(response.context['cl'].result_list), [self.order])
+        self.assertContains(response, 'value="buy"')
+
+    def test_user_autocomplete_searches_by_prefix(self):
+        response = self.client.get(reverse('admin:autocomplete'), {
+            'app_label': 'orders', 'model_name': 'order', 'field_name': 'user', 'term': 'buyer@',
+        })
+        self.assertEqual([result['text'] for result in response.json()['results']], ['buyer'])
+        response = self.client.get(reverse('admin:orders_order_change', args=[self.order.pk]))
+        self.assertContains(response, 'admin-autocomplete')
+
+
+from .benchmark import compare, generate_data, percentile, run_load, run_micro, summarize
+
+
+class BenchmarkTestCase(TestCase):
+    def test_summary_and_baseline_comparison(self):
+        samples = list(range(1, 101))
+        self.assertEqual((percentile(samples, 50), percentile(samples, 95), percentile(samples, 99)), (50, 95, 99))
+        summary = summarize(samples, elapsed=2)
+        self.assertEqual((summary['count'], summary['mean'], summary['rps']), (100, 50.5, 50))
+
+        baseline = {'micro': {'pricing': {'p50': 10, 'p95': 20, 'p99': 30, 'rps': 100}}}
+        results = {'micro': {'pricing': {'p50': 10.5, 'p95': 30, 'p99': 30, 'rps': 80}, 'new': {'p50': 1}}}
+        regressed = {(metric, change) for _, _, metric, _, _, change, worse in compare(results, baseline, 10) if worse}
+        self.assertEqual(regressed, {('p95', 50.0), ('rps', -20.0)})
+
+    def test_micro_benchmarks(self):
+        generate_data(vitamins=30, users=2, orders=5)
+        results = run_micro(2)
+        self.assertEqual(results['create_order_from_cart']['count'], 2)
+        self.assertIn('shop_queryset[tag]', results)
+        # The orders were rolled back
+        self.assertEqual(Order.objects.count(), 5)
+
+
+class BenchmarkLoadTestCase(TransactionTestCase):
+    def test_scenarios_run_without_errors(self):
+        generate_data(vitamins=30, users=2, orders=5)
+        with mock.patch('orders.outbox.schedule_outbox_drain'):
+            results = run_load(threads=1, iterations=2)
+        self.assertEqual(results['create_order']['count'], 2)
+        self.assertEqual(results['total']['errors'], 0, results['total']['error_samples'])
+        self.assertEqual(Order.objects.count(), 7)
@@ -0,0 +1,87 @@
+from django.db import models
+
+
+class TrackedFieldsMixin(models.Model):
+    """
+    Remembers the values of the model fields as they were loaded from the database.
+
+    Lets signals and views tell which fields have changed without querying the previous row:
+
+        order.has_changed('status'), order.previous('status'), order.changed_fields
+
+    Saving an instance loaded from the database writes only the changed fields
+    (plus `auto_now` fields) with `update_fields`, unless `update_fields` is given.
+    """
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._take_snapshot()
+        return instance
+
+    def _take_snapshot(self):
+        # Deferred fields are not in __dict__, they are not tracked until loaded
+        self._loaded_values = {field.attname: self.__dict__[field.attname]
+                               for field in self._meta.concrete_fields if field.attname in self.__dict__}
+
+    def _get_loaded_values(self) -> dict:
+        loaded_values = getattr(self, '_loaded_values', None)
+        if loaded_values is None:
+            # The instance was not loaded from the database, read the saved row once
+            attnames = [field.attname for field in self._meta.concrete_fields]
+            loaded_values = {}
+            if self.pk is not None and not self._state.adding:
+                loaded_values = type(self)._base_manager.filter(pk=self.pk).values(*attnames).first() or {}
+            self._loaded_values = loaded_values
+        return loaded_values
+
+    def previous(self, field_name: str):
+        """
+        Returns the value of the field as it was loaded from the database.
+        """
+        return self._get_loaded_values().get(self._meta.get_field(field_name).attname)
+
+    def has_changed(self, field_name: str) -> bool:
+        return field_name in self.changed_fields
+
+    @property
+    def changed_fields(self) -> dict:
+        """
+        Returns the changed fields as a dict of field names to (previous value, current value).
+        A new instance has no changed fields.
+        """
+        if self._state.adding:
+            return {}
+        loaded_values = self._get_loaded_values()
+        changed = {}
+        for field in self._meta.concrete_fields:
+            if field.attname not in self.__dict__:
+                continue
+            value = self.__dict__[field.attname]
+            if field.attname not in loaded_values or loaded_values[field.attname] != value:
+                changed[field.name] = (loaded_values.get(field.attname), value)
+        return changed
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get('update_fields') is None and \
+                getattr(self, '_loaded_values', None) is not None and \
+                not kwargs.get('force_insert') and not (args and args[0]):
+            changed = list(self.changed_fields)
+            if changed:
+                auto_now = [field.name for field in self._meta.concrete_fields if getattr(field, 'auto_now', False)]
+                kwargs['update_fields'] = set(changed + auto_now)
+        super().save(*args, **kwargs)
+        self._take_snapshot()
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super().refresh_from_db(using, fields, **kwargs)
+        if fields is None or getattr(self, '_loaded_values', None) is None:
+            self._take_snapshot()
+        else:
+            # Other fields may have unsaved changes, so only the refreshed fields are taken
+            for field_name in fields:
+                attname = self._meta.get_field(field_name).attname
+                self._loaded_values[attname] = self.__dict__.get(attname)
@@ -1,15 +1,23 @@
 from django.contrib.auth.decorators import login_required
-from django.core.mail import send_mail
-from django.shortcuts import render, get_object_or_404
+from django.http import Http404
+from django.shortcuts import render
 from django.db import transaction
 from django.shortcuts import redirect
 from django.contrib import messages
-from django.template.loader import render_to_string
-from django.utils.html import strip_tags, format_html
+from django.utils.html import format_html
 
-from cart.views import calculator_cart
+from cart.models import Cart
+from cart.promo import PromoRedemption, get_promo_rule
+from cart.storage import get_cart_storage
+from cart.views import get_cart_checkout_draft
 from internet_store import settings
-from orders.models import OrderItem, Order, TypeDelivery, TypePayment, OrderStatus
+from orders.cancellation import cancel_orders
+from orders.archive import get_order_or_archived
+from orders.history import history_page
+from orders.models import ArchivedOrder, ArchivedOrderItem, OrderItem, Order, TypeDelivery, TypePayment, \
+    OrderStatus
+from orders.outbox import queue_email
+from vitamins.stock import take_stock
 
 import logging
 
@@ -19,106 +27,112 @@ logger = logging.getLogger('django')
 
 
 @login_required
-def create_order_from_cart(request, shipping_address: str):
+def create_order_from_cart(request, shipping_address: str, redemption: PromoRedemption | None = None):
     """
     Creates an order from the items in the user's cart.
 
-    Retrieves cart items, total price, total price without discount, discount, and promo code from the session.
-    Checks the availability of all products in the cart before creating the order.
+    Takes cart lines, prices, discount and promo code from the checkout draft, which is
+    recalculated only if the cart or pricing has changed since the checkout started.
+    Takes the products from the stock with a single conditional UPDATE, so the order is not created
+    if any product is short, even when several users check out at the same time.
     Adds shipping cost if the selected delivery option is 'mail'.
     Creates an order with the provided shipping address, user details, and payment type.
-    Creates order items for each product in the cart, updating their quantities and sold counts.
-    Empties the cart and clears the promo code from the session after creating the order.
+    Creates order items for all products in the cart with a single INSERT.
+    Counts a redemption of the promo code if it has usage limits. A caller that wraps the order in its own
+    transaction passes a `PromoRedemption` wrapping that transaction, so the redemption is released
+    if anything fails before it commits.
+    Empties the cart and clears the promo code and the checkout draft from the session after creating the order.
 
     Returns:
         Order: The created order instance.
     """
+    draft = get_cart_checkout_draft(request)
+    cart_items = draft.apply_to(list(Cart.objects.filter(user=request.user).select_related('product')))
 
-    cart_items, total_price, total_price_without_discount, discount, code_name = calculator_cart(request)
-    # Check availability of all products before creating an order
-    for item in cart_items:
-        if item.product.count < item.quantity:
-            raise ValueError(f"Недостаточно товара на складе для {item.product.title}")
+    rule = get_promo_rule(draft.code_name) if draft.code_name else None
+    customer = draft.customer
+    with redemption or PromoRedemption() as redemption, transaction.atomic():
+        if rule is not None and rule.has_limits and not redemption.redeem(rule, request.user.pk):
+            raise ValueError(f"Промокод {rule.code} больше не действует")
 
-    if request.session['delivery_option'] == 'mail':
-        # add shipping cost
-        total_price += 200
-
-    with transaction.atomic():
         order = Order.objects.create(user=request.user,
-                                     comment=request.session['comment'] if 'comment' in request.session else '',
-                                     type_delivery=TypeDelivery.PICKUP if request.session['delivery_option'] == 'pickup' else TypeDelivery.POST,
-                                     total_price=total_price,
-                                     without_discount=total_price_without_discount,
-                                     discount_sum=discount,
+                                     comment=customer.get('comment') or '',
+                                     type_delivery=TypeDelivery.PICKUP if draft.delivery_option == 'pickup' else TypeDelivery.POST,
+                                     total_price=draft.total_price,
+                                     without_discount=draft.total_price_without_discount,
+                                     discount_sum=draft.discount,
                                      shipping_address=shipping_address,
-                                     type_payment=TypePayment.CASH if request.session['type_payment'] == 'cash' else TypePayment.BY_CARD,
-                                     email=request.session['email'],
-                                     phone_number=request.session['phone_number'])
+                                     type_payment=TypePayment.CASH if draft.type_payment == 'cash' else TypePayment.BY_CARD,
+                                     email=customer['email'],
+                                     phone_number=customer['phone_number'])
+
+        # Fails and rolls everything back if any product is short
+        take_stock([(order.pk, item.product_id, item.quantity) for item in cart_items])
 
-        for item in cart_items:
-            OrderItem.objects.create(
+        OrderItem.objects.bulk_create([
+            OrderItem(
                 order=order,
                 product=item.product,
                 quantity=item.quantity,
                 price=item.product.final_price,
                 sum=item.product.sum,
                 discount=item.product.discount
-            )
-            # Reducing the quantity of products in stock
-            item.product.decrease_count(item.quantity)
-            item.product.adding_sold(item.quantity)
+            ) for item in cart_items
+        ])
 
-        # Empty cart after creating order
-        cart_items.delete()
+        # Empty cart after creating order, through the storage so a Redis cart is emptied too.
+        # The Redis cart is emptied only once the outermost transaction commits
+        get_cart_storage(request).clear()
         request.session['promo_code'] = None
+        draft.clear(request.session)
     return order
 
 
 @login_required
 def create_order(request):
     """
-    Creates an order based on the user's session data and cart items.
+    Creates an order based on the checkout draft and cart items.
 
     Attempts to create an order within a database transaction. If successful, sends a confirmation email to the user
     and redirects them to the orders history page. If an error occurs during the creation of the order, logs the error,
     displays an error message to the user, and redirects them back to the checkout page.
     """
     try:
-        with transaction.atomic():
+        # Releases the promo code redemption if anything fails before the commit, the email included
+        with PromoRedemption() as redemption, transaction.atomic():
+            draft = get_cart_checkout_draft(request)
+            customer = draft.customer
+            if not draft.delivery_option or not customer:
+                raise ValueError('Не заполнены данные для оформления заказа')
             shipping_address = '\n'.join([
-                request.session['last_name'],
-                request.session['first_name'],
-                request.session['email'],
-                request.session['phone_number']
-            ] if request.session['delivery_option'] == 'pickup' else [
-                request.session['last_name'],
-                request.session['first_name'],
-                request.session['middle_name'],
-                request.session['email'],
-                request.session['phone_number'],
-                request.session['region'],
-                request.session['city'],
-                request.session['address'],
-                request.session['postal_code'],
-                request.session['comment']
+                customer['last_name'],
+                customer['first_name'],
+                customer['email'],
+                customer['phone_number']
+            ] if draft.delivery_option == 'pickup' else [
+                customer['last_name'],
+                customer['first_name'],
+                customer['middle_name'],
+                customer['email'],
+                customer['phone_number'],
+                customer['region'],
+                customer['city'],
+                customer['address'],
+                customer['postal_code'],
+                customer['comment']
             ])
             # Create order
-            order = create_order_from_cart(request, shipping_address)
+            order = create_order_from_cart(request, shipping_address, redemption)
 
             messages.success(request, f'Поздравляем, ваш заказ создан успешно!')
 
-            # Sending a confirmation email to the user
+            # Queueing a confirmation email to the user, it is sent after the transaction commits
             subject = f'Ваш заказ #{order.id} успешно оформлен'
             # Forming an HTML link
             order_link = format_html('<a href="{}">#{}<a/>', order.get_absolute_url(), order.pk)
             message = format_html('Ваш заказ {} оформлен!!! В ближайшее время наш менеджер свяжется '
                                   'с вами для подтверждения заказа и уточнения деталей доставки.', order_link)
-            html_message = render_to_string('email_template.html', {'order': order, 'message': message})
-            plain_message = strip_tags(html_message)
-            email_from = settings.EMAIL_HOST_USER
-            recipient_list = [order.email, settings.MY_EMAIL]
-            send_mail(subject, plain_message, email_from, recipient_list, html_message=html_message)
+            queue_email(f'order-created:{order.pk}', subject, message, [order.email, settings.MY_EMAIL], order=order)
             logger.debug(f'Заказ {order.id} успешно создан для пользователя {request.user.username}')
 
             return redirect('orders:orders_history')
@@ -127,7 +141,7 @@ def create_order(request):
         logger.error(f'Ошибка при создании заказа: {e}', exc_info=True)
         # Returning the user back to the cart with an error message
         messages.error(request, f'Произошла ошибка при создании заказа: {e}')
-        return redirect('checkout4')
+        return redirect('cart:checkout4')
 
 
 @login_required
@@ -135,12 +149,22 @@ def orders_history(request):
     """
     Displays the order history for the authenticated user.
 
-    Retrieves the orders associated with the current user and renders them in the orders history page.
+    Renders a page of the user's orders, optionally filtered by status, with the number of items
+    and the first item image of every order. The next page is selected by the `after` cursor,
+    see `orders.history.history_page`.
     """
-    orders = Order.objects.filter(user=request.user)
+    status = request.GET.get('status')
+    if status not in OrderStatus.values:
+        status = None
+    orders, next_cursor = history_page(Order, OrderItem, request.user, status, request.GET.get('after'),
+                                       archive=(ArchivedOrder, ArchivedOrderItem))
     context = {
         'title': 'История заказов',
-        'orders': orders
+        'orders': orders,
+        'statuses': OrderStatus.choices,
+        'current_status': status,
+        'next_cursor': next_cursor,
+        'is_first_page': not request.GET.get('after'),
     }
     return render(request, 'orders/orders_history.html', context)
 
@@ -150,11 +174,12 @@ def order_detail(request, order_id: int):
     """
     Displays the details of a specific order.
 
-    Retrieves the order details and associated order items for the specified order ID.
+    Retrieves the order details and associated order items for the specified order ID, from the archive
+    if the order has been archived.
     Renders the order details page with the order information and its items.
     """
-    order = get_object_or_404(Order, pk=order_id)
-    order_items = OrderItem.objects.filter(order__pk=order_id).select_related('product__brand')
+    order = get_order_or_archived(Order, ArchivedOrder, pk=order_id)
+    order_items = order.items.select_related('product__brand')
     context = {
         'order': order,
         'order_items': order_items,
@@ -167,20 +192,17 @@ def order_detail(request, order_id: int):
 @login_required
 def canceling_order(request, order_id: int):
     """
-    Cancels a specific order.
+    Cancels a specific order of the user.
 
-    Cancels the order identified by the given order ID. It updates the order status to "CANCELED"
-    and restores the quantity of each product in the order back to the stock.
+    Cancels the order identified by the given order ID with the bulk cancellation service, see `orders.cancellation`.
+    It updates the order status to "CANCELED" and restores the quantity of each product in the order back to the stock.
     """
     try:
-        with transaction.atomic():
-            order = get_object_or_404(Order, pk=order_id)
-            order_items = order.items.all()
-            order.status = OrderStatus.CANCELED
-            for item in order_items:
-                item.product.adding_count(item.quantity)
-            order.save()
-            return redirect('orders:orders_history')
+        orders = Order.objects.filter(pk=order_id, user=request.user)
+        if not orders.exists():
+            raise Http404('Заказ не найден')
+        cancel_orders(orders)
+        return redirect('orders:orders_history')
     except Exception as e:
         messages.error(request, 'Произошла ошибка при отмене заказа: {}'.format(e))
         return redirect('orders:orders_history')
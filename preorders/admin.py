@@ -1,8 +1,14 @@
 from django.contrib import admin
-from django.db import transaction
-from django.utils.safestring import mark_safe
+from django.http import HttpResponse, HttpResponseRedirect
+from django.template.response import TemplateResponse
+from django.urls import path
 
-from preorders.models import PreOrder, OrderStatus, PreOrderItem
+from orders.admin import export_csv, export_excel
+from preorders.cancellation import cancel_preorders
+from preorders.demand import preorder_count_drift, preorder_demand, reconcile_preorder_counts, write_demand_csv
+from preorders.models import ArchivedPreOrder, ArchivedPreOrderItem, PreOrder, PreOrderItem
+from users.admin import UserLookupFilter
+from vitamins.admin import thumbnail, with_main_image
 
 
 class PreOrderItemInline(admin.TabularInline):
@@ -10,11 +16,12 @@ class PreOrderItemInline(admin.TabularInline):
     extra = 0  # Prevents extra empty forms
     readonly_fields = ('vitamin_photo', 'product', 'quantity', 'price', 'discount', 'sum')
 
+    def get_queryset(self, request):
+        return with_main_image(super().get_queryset(request).select_related('product'), 'product')
+
     @admin.display(description='Photo')
     def vitamin_photo(self, instance):
-        if instance.product.images.exists():
-            return mark_safe(f'<img src="{instance.product.images.first().image.url}" width="75" />')
-        return ""
+        return thumbnail(getattr(instance, 'main_image', None), instance.product.title)
 
 
 @admin.register(PreOrder)
@@ -25,27 +32,92 @@ class PreOrderAdmin(admin.ModelAdmin):
     fields = ['user', 'created_at', 'type_delivery', 'type_payment', 'payment_status', 'status',
               'total_price', 'without_discount', 'discount_sum', 'shipping_address', 'comment', 'email', 'phone_number']
     readonly_fields = ('created_at',)
-    actions = ('canceling_preorder',)
-    list_filter = ('status', 'type_payment', 'type_delivery', 'payment_status', 'user')
+    actions = ('canceling_preorder', export_csv, export_excel)
+    list_filter = ('status', 'type_payment', 'type_delivery', 'payment_status', UserLookupFilter)
+    autocomplete_fields = ('user',)
+    search_fields = ('=id', 'email', 'phone_number')
+    list_select_related = ('user',)
+    date_hierarchy = 'created_at'
+    change_list_template = 'admin/preorders/preorder/change_list.html'
 
     @admin.action(description='Отменить выбранные предзаказы')
     def canceling_preorder(self, request, queryset):
-        with transaction.atomic():
-            for order in queryset:
-                for item in order.items.all():
-                    item.product.decrease_preorder_count(item.quantity)
-                order.status = OrderStatus.CANCELED
-                order.save()
+        canceled = cancel_preorders(queryset)
+        self.message_user(request, f'Отменено предзаказов: {canceled}')
+
+    def get_urls(self):
+        return [
+            path('demand/', self.admin_site.admin_view(self.demand_view), name='preorders_preorder_demand'),
+        ] + super().get_urls()
+
+    def demand_view(self, request):
+        """
+        Shows the outstanding preordered quantities of the products for purchase planning.
+        With `export=csv` the list is downloaded as a CSV file, a POST sets the preorder counts
+        of the products to the outstanding quantities.
+        """
+        if request.method == 'POST' and self.has_change_permission(request):
+            drift = reconcile_preorder_counts()
+            self.message_user(request, f'Исправлено счетчиков предзаказов: {len(drift)}')
+            return HttpResponseRedirect(request.path)
+
+        rows = preorder_demand()
+        if request.GET.get('export') == 'csv':
+            response = HttpResponse(content_type='text/csv; charset=utf-8')
+            response['Content-Disposition'] = 'attachment; filename="preorder_demand.csv"'
+            write_demand_csv(rows, response)
+            return response
+
+        context = {
+            **self.admin_site.each_context(request),
+            'title': 'Спрос по предзаказам',
+            'opts': self.model._meta,
+            'rows': rows,
+            'total': {key: sum(row[key] for row in rows) for key in ('quantity', 'value', 'to_purchase')},
+            'drift': preorder_count_drift(),
+            'can_reconcile': self.has_change_permission(request),
+        }
+        return TemplateResponse(request, 'admin/preorders/preorder/demand.html', context)
 
 
 @admin.register(PreOrderItem)
 class OrderItemAdmin(admin.ModelAdmin):
     list_display = ('id', 'order', 'vitamin_photo', 'product', 'quantity', 'price', 'sum', 'discount')
     readonly_fields = ('vitamin_photo',)
+    list_select_related = ('order', 'product')
+    autocomplete_fields = ('order', 'product')
+
+    def get_queryset(self, request):
+        return with_main_image(super().get_queryset(request), 'product')
 
     @admin.display(description='vitamin_photo')
     def vitamin_photo(self, order_item: PreOrderItem):
-        return mark_safe(
-            f"<a href='{order_item.product.images.first().image.url if order_item.product.images.first() else order_item.product.pk}'>"
-            f"<img src='{order_item.product.images.first().image.url if order_item.product.images.first() else order_item.product.pk}'"
-            f" alt='{order_item.product.title}' width='75'></a>")
+        return thumbnail(getattr(order_item, 'main_image', None), order_item.product.title)
+
+
+class ArchivedPreOrderItemInline(PreOrderItemInline):
+    model = ArchivedPreOrderItem
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(ArchivedPreOrder)
+class ArchivedPreOrderAdmin(admin.ModelAdmin):
+    """
+    Read-only access to the archived preorders, see `orders.archive`.
+    """
+    list_display = PreOrderAdmin.list_display + ('archived_at',)
+    inlines = [ArchivedPreOrderItemInline]
+    fields = PreOrderAdmin.fields + ['updated_at', 'archived_at']
+    list_filter = ('status', 'type_payment', 'type_delivery', 'payment_status', UserLookupFilter)
+    list_select_related = ('user',)
+    date_hierarchy = 'created_at'
+    actions = (export_csv, export_excel)
+    search_fields = ('=id', 'email', 'phone_number')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
@@ -0,0 +1,106 @@
+from collections import defaultdict
+
+from django.db import transaction
+from django.utils import timezone
+
+from orders.history import bump_history_version
+from orders.outbox import queue_emails
+from orders.signals import email_version
+from preorders.demand import CLOSED_STATUSES, bump_demand_version
+from preorders.models import OrderStatus, PreOrder, PreOrderItem
+from preorders.signals import status_email
+from vitamins.models import MovementSource, StockField, Vitamin
+from vitamins.stock import change_stock, lock_products, negate
+
+
+def allocate(available: dict, orders, items) -> tuple:
+    """
+    Allocates the available quantities of the products to the preorders in the given order.
+
+    A preorder is allocated only if all its lines are covered, a preorder waiting for other
+    products too is skipped and the later preorders get the quantities.
+
+    Returns:
+        tuple: The allocated preorders and their (preorder id, product id, quantity) lines.
+    """
+    lines_by_order = defaultdict(list)
+    for line in items:
+        lines_by_order[line[0]].append(line)
+    available = dict(available)
+    allocated, allocated_lines = [], []
+    for order in orders:
+        lines = lines_by_order[order.pk]
+        needed = defaultdict(int)
+        for _, product_id, quantity in lines:
+            needed[product_id] += quantity
+        if not lines or any(available.get(product_id, 0) < quantity for product_id, quantity in needed.items()):
+            continue
+        for product_id, quantity in needed.items():
+            available[product_id] -= quantity
+        allocated.append(order)
+        allocated_lines.extend(lines)
+    return allocated, allocated_lines
+
+
+def process_arrival(received: dict) -> int:
+    """
+    Processes a supplier shipment, a map of product ids to received quantities, with a fixed number of statements:
+
+        - the outstanding preorders waiting for the received products are locked and read, oldest first,
+          with their lines, then all their products are locked;
+        - the stock of the products with the received quantities added is allocated to the preorders FIFO,
+          see `allocate`, so a preorder waiting for several products is ready once the last of them arrives;
+        - the allocated preorders are moved to "ready for issue" with one UPDATE;
+        - the counters are changed with one UPDATE: the stock grows by the received quantities less
+          the allocated ones, the preorder counts decrease by the allocated quantities and the quantities
+          ordered from the supplier decrease by the received ones;
+        - the status emails are written to the outbox with one INSERT and sent in batches after the commit.
+
+    Returns:
+        int: The number of preorders ready for issue.
+    """
+    received = {int(product_id): quantity for product_id, quantity in received.items() if quantity > 0}
+    if not received:
+        return 0
+
+    with transaction.atomic():
+        waiting = PreOrderItem.objects.filter(product_id__in=received).values('order_id')
+        orders = list(PreOrder.objects.filter(pk__in=waiting).exclude(status__in=CLOSED_STATUSES)
+                      .select_for_update().order_by('created_at', 'pk')
+                      .only('pk', 'user', 'email', 'status', 'created_at', 'updated_at'))
+        items = list(PreOrderItem.objects.filter(order_id__in=[order.pk for order in orders]).order_by()
+                     .values_list('order_id', 'product_id', 'quantity'))
+
+        product_ids = set(received) | {product_id for _, product_id, _ in items}
+        lock_products(product_ids)
+        stock = {pk: (count, ordered) for pk, count, ordered in
+                 Vitamin.objects.filter(pk__in=product_ids).values_list('pk', 'count', 'ordered')}
+        available = {pk: count + received.get(pk, 0) for pk, (count, _) in stock.items()}
+        ready, lines = allocate(available, orders, items)
+
+        allocated = defaultdict(int)
+        for _, product_id, quantity in lines:
+            allocated[product_id] += quantity
+        change_stock({
+            StockField.PREORDER_COUNT: negate(lines),
+            StockField.COUNT: [(None, product_id, received.get(product_id, 0) - allocated[product_id])
+                               for product_id in product_ids],
+            StockField.ORDERED: [(None, product_id, -min(quantity, stock[product_id][1]))
+                                 for product_id, quantity in received.items() if product_id in stock],
+        }, MovementSource.ARRIVAL)
+
+        if ready:
+            # The status is updated without save(), so the emails are built here instead of the pre_save signal
+            PreOrder.objects.filter(pk__in=[order.pk for order in ready]) \
+                .update(status=OrderStatus.READY, updated_at=timezone.now())
+            emails = []
+            for order in ready:
+                version = email_version(order)
+                order.status = OrderStatus.READY
+                emails.append(status_email(order, version))
+            queue_emails(emails)
+
+            user_ids = {order.user_id for order in ready}
+            transaction.on_commit(lambda: bump_history_version(*user_ids))
+        transaction.on_commit(bump_demand_version)
+    return len(ready)
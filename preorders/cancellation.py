@@ -0,0 +1,31 @@
+from django.db import transaction
+
+from orders.cancellation import bulk_cancel
+from preorders.demand import bump_demand_version
+from preorders.models import OrderStatus, PreOrderItem
+from preorders.signals import status_email
+from vitamins.models import MovementSource
+from vitamins.stock import release_preorders, return_stock
+
+# Preorders in these statuses have been allocated the stock of their products by `preorders.arrival.process_arrival`
+ALLOCATED_STATUSES = (OrderStatus.READY, OrderStatus.EXECUTED)
+
+
+def restock_preorders(lines, statuses: dict):
+    """
+    Decreases the preordered quantities of the preorders still waiting for the supplier
+    and returns the quantities allocated to the ready ones to the stock.
+    """
+    allocated = [line for line in lines if statuses[line[0]] in ALLOCATED_STATUSES]
+    release_preorders([line for line in lines if statuses[line[0]] not in ALLOCATED_STATUSES])
+    return_stock(allocated, MovementSource.PREORDER)
+
+
+def cancel_preorders(queryset) -> int:
+    """
+    Cancels the preorders and restocks their products, see `restock_preorders` and `bulk_cancel`.
+    """
+    canceled = bulk_cancel(queryset, PreOrderItem, restock_preorders, status_email)
+    if canceled:
+        transaction.on_commit(bump_demand_version)
+    return canceled
@@ -1,8 +1,6 @@
+from cart.storage import get_cart_storage
 from .models import PreOrderCart
 
 
 def preorder_cart_processor(request):
-    if request.user.is_authenticated:
-        cart_items_count = PreOrderCart.objects.filter(user=request.user).count()
-        return {'preorder_cart_items_count': cart_items_count}
-    return {'preorder_cart_items_count': 0}
+    return {'preorder_cart_items_count': get_cart_storage(request, PreOrderCart).count()}
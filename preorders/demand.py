@@ -0,0 +1,98 @@
+import csv
+from uuid import uuid4
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Min, Q, Sum
+
+from preorders.models import OrderStatus, PreOrderItem
+from vitamins.models import MovementSource, StockField, Vitamin
+from vitamins.stock import change_stock, lock_products
+
+# Preorders in these statuses no longer wait for the supplier
+CLOSED_STATUSES = (OrderStatus.READY, OrderStatus.EXECUTED, OrderStatus.CANCELED)
+DEMAND_VERSION_CACHE_KEY = 'preorder_demand_version'
+# The stock columns are not invalidated, so they are at most this old
+DEMAND_CACHE_TIMEOUT = 5 * 60
+
+
+def get_demand_version() -> str:
+    """
+    Returns the version of the preorder demand, an opaque token stored in the cache.
+    It changes every time a preorder is saved, deleted or canceled, see `bump_demand_version`.
+    """
+    return cache.get_or_set(DEMAND_VERSION_CACHE_KEY, lambda: uuid4().hex, None)
+
+
+def bump_demand_version() -> str:
+    version = uuid4().hex
+    cache.set(DEMAND_VERSION_CACHE_KEY, version, None)
+    return version
+
+
+def outstanding_items():
+    return PreOrderItem.objects.exclude(order__status__in=CLOSED_STATUSES).order_by()
+
+
+def preorder_demand() -> list:
+    """
+    Returns the outstanding preordered quantity, value, number of preorders and the date of the oldest
+    preorder of every product, oldest first, computed by one GROUP BY and cached until a preorder changes.
+
+    Every row also has the stock of the product and `to_purchase`, the quantity still missing
+    after the products in stock and already ordered from the supplier.
+    """
+    def load():
+        rows = list(outstanding_items()
+                    .values('product_id', 'product__title', 'product__product_code', 'product__brand__name',
+                            'product__count', 'product__ordered', 'product__preorder_count')
+                    .annotate(quantity=Sum('quantity'), value=Sum('sum'), preorders=Count('order', distinct=True),
+                              oldest=Min('order__created_at'))
+                    .order_by('oldest', 'product_id'))
+        for row in rows:
+            row['to_purchase'] = max(row['quantity'] - row['product__count'] - row['product__ordered'], 0)
+        return rows
+
+    return cache.get_or_set(f'preorder_demand:{get_demand_version()}', load, DEMAND_CACHE_TIMEOUT)
+
+
+def write_demand_csv(rows, file):
+    writer = csv.writer(file)
+    writer.writerow(['Артикул', 'Товар', 'Бренд', 'Предзаказано', 'Сумма', 'Предзаказов', 'Самый ранний',
+                     'На складе', 'Заказано', 'Докупить'])
+    for row in rows:
+        writer.writerow([row['product__product_code'], row['product__title'], row['product__brand__name'],
+                         row['quantity'], row['value'], row['preorders'], row['oldest'].date(),
+                         row['product__count'], row['product__ordered'], row['to_purchase']])
+
+
+def preorder_count_drift() -> list:
+    """
+    Compares `Vitamin.preorder_count` with the outstanding preordered quantities.
+
+    Returns:
+        list: (product id, preorder count, outstanding quantity) tuples of the products that differ.
+    """
+    outstanding = dict(outstanding_items().values('product_id').annotate(quantity=Sum('quantity'))
+                       .values_list('product_id', 'quantity'))
+    counts = dict(Vitamin.objects.filter(~Q(preorder_count=0) | Q(pk__in=outstanding))
+                  .values_list('pk', 'preorder_count'))
+    return [(pk, count, outstanding.get(pk, 0)) for pk, count in sorted(counts.items())
+            if count != outstanding.get(pk, 0)]
+
+
+def reconcile_preorder_counts() -> list:
+    """
+    Sets the preorder counts that differ to the outstanding quantities with one UPDATE,
+    recording the differences in the stock ledger.
+
+    Returns:
+        list: The differences found by `preorder_count_drift`.
+    """
+    with transaction.atomic():
+        lock_products([pk for pk, _, _ in preorder_count_drift()])
+        # Read again under the locks, so concurrent preorders are not overwritten
+        drift = preorder_count_drift()
+        change_stock({StockField.PREORDER_COUNT: [(None, pk, quantity - count) for pk, count, quantity in drift]},
+                     MovementSource.ADJUSTMENT)
+    return drift
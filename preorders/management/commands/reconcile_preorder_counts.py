@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from preorders.demand import preorder_count_drift, reconcile_preorder_counts
+
+
+class Command(BaseCommand):
+    help = 'Compares the preorder counts of the products with the quantities of their outstanding preorders.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true',
+                            help='Set the preorder counts to the outstanding quantities.')
+
+    def handle(self, *args, **options):
+        drift = reconcile_preorder_counts() if options['fix'] else preorder_count_drift()
+        for product_id, count, quantity in drift:
+            self.stdout.write(f'Vitamin {product_id}: preorder_count = {count}, outstanding = {quantity}')
+        self.stdout.write(f'Counters with drift: {len(drift)}')
+        if drift and options['fix']:
+            self.stdout.write('Preorder counts fixed')
@@ -2,6 +2,7 @@ from django.db import models
 from django.urls import reverse
 
 from internet_store import settings
+from orders.tracking import TrackedFieldsMixin
 from vitamins.models import Vitamin
 
 
@@ -39,6 +40,9 @@ class PreOrderCart(models.Model):
 
     class Meta:
         ordering = ['time_added']
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'product'], name='unique_preorder_cart_user_product'),
+        ]
 
     def __str__(self):
         return f"{self.quantity} x {self.product}"
@@ -47,7 +51,7 @@ class PreOrderCart(models.Model):
         return reverse("cart:cart_detail")
 
 
-class PreOrder(models.Model):
+class AbstractPreOrder(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -64,6 +68,7 @@ class PreOrder(models.Model):
     phone_number = models.CharField(max_length=12, default=0)
 
     class Meta:
+        abstract = True
         ordering = ['-created_at']
 
     def __str__(self):
@@ -74,14 +79,47 @@ class PreOrder(models.Model):
         return reverse('preorders:preorder_detail', kwargs={'order_id': pk})
 
 
-class PreOrderItem(models.Model):
-    order = models.ForeignKey(PreOrder, related_name='items', on_delete=models.CASCADE)
+class PreOrder(TrackedFieldsMixin, AbstractPreOrder):
+    class Meta(AbstractPreOrder.Meta):
+        indexes = [
+            # Keyset pagination of the history, see orders.history
+            models.Index(fields=['user', '-created_at', '-id'], name='preorder_history_idx'),
+        ]
+
+
+class ArchivedPreOrder(AbstractPreOrder):
+    """
+    A preorder moved out of the hot table by the `archive_orders` command, see `orders.archive`.
+    Keeps the id and the dates of the original.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta(AbstractPreOrder.Meta):
+        indexes = [
+            models.Index(fields=['user', '-created_at', '-id'], name='archived_preorder_history_idx'),
+        ]
+
+
+class AbstractPreOrderItem(models.Model):
     product = models.ForeignKey(Vitamin, on_delete=models.DO_NOTHING)
     quantity = models.IntegerField(default=1)
     price = models.IntegerField(default=0)  # Цена на момент оформления заказа
     sum = models.IntegerField(default=0)
     discount = models.IntegerField(default=0)  # Скидка на момент оформления заказа
 
+    class Meta:
+        abstract = True
+
     def __str__(self):
         return f"{self.quantity} x {self.product}"
 
+
+class PreOrderItem(AbstractPreOrderItem):
+    order = models.ForeignKey(PreOrder, related_name='items', on_delete=models.CASCADE)
+
+
+class ArchivedPreOrderItem(AbstractPreOrderItem):
+    order = models.ForeignKey(ArchivedPreOrder, related_name='items', on_delete=models.CASCADE)
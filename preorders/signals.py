@@ -1,33 +1,42 @@
-from django.db.models.signals import pre_save
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
-from django.core.mail import send_mail
-from django.template.loader import render_to_string
-from django.utils.html import strip_tags, format_html
+from django.utils.html import format_html
 
 from internet_store import settings
+from orders.history import bump_history_version
+from orders.outbox import build_email, queue_emails
+from orders.signals import email_version
+from preorders.demand import bump_demand_version
 from preorders.models import PreOrder
 
 
+def status_email(order: PreOrder, version: float):
+    """
+    Builds the email about the new status of the preorder.
+    """
+    order_link = format_html('<a href="{}">#{}<a/>', order.get_absolute_url(), order.pk)
+    status_message = order.get_status_display()
+    message = format_html('Статус вашего предзаказа {} изменился на "{}"', order_link, status_message)
+
+    subject = f'Изменение статуса предзаказа #{order.pk}'
+    return build_email(f'preorder-status:{order.pk}:{order.status}:{version}', subject, message,
+                       [order.email, settings.MY_EMAIL])
+
+
 @receiver(pre_save, sender=PreOrder)
 def preorder_status_changed(sender, instance, **kwargs):
-    if instance.pk:
-        prev_instance = sender.objects.get(pk=instance.pk)
+    # The email is queued by `queue_status_emails` once the row is saved, see `orders.signals`
+    instance._status_emails = []
+    if instance.pk and not instance._state.adding:
+        # The previous values are tracked by TrackedFieldsMixin, so the row is not read again.
+        version = email_version(instance)
 
-        email_from = settings.EMAIL_HOST_USER
-
-        if instance.status != prev_instance.status:
+        if instance.has_changed('status'):
             # Статус заказа изменился
-            order_link = format_html('<a href="{}">#{}<a/>', instance.get_absolute_url(), instance.pk)
-            status_message = instance.get_status_display()
-            message = format_html('Статус вашего предзаказа {} изменился на "{}"', order_link, status_message)
+            instance._status_emails = [status_email(instance, version)]
 
-            subject = f'Изменение статуса предзаказа #{instance.pk}'
-            html_message = render_to_string('email_template.html', {'message': message})
-            plain_message = strip_tags(html_message)
-            recipient_list = [instance.email, settings.MY_EMAIL]
-            send_mail(subject, plain_message, email_from, recipient_list, html_message=html_message)
-
-        elif instance.payment_status != prev_instance.payment_status:
+        elif instance.has_changed('payment_status'):
             # Статус оплаты изменился
             order_link = format_html('<a href="{}">#{}<a/>', instance.get_absolute_url(), instance.pk)
             payment_status_message = instance.get_payment_status_display()
@@ -35,7 +44,19 @@ def preorder_status_changed(sender, instance, **kwargs):
                                   payment_status_message)
 
             subject = f'Изменение статуса оплаты предзаказа #{instance.pk}'
-            html_message = render_to_string('email_template.html', {'message': message})
-            plain_message = strip_tags(html_message)
-            recipient_list = [instance.email, settings.MY_EMAIL]
-            send_mail(subject, plain_message, email_from, recipient_list, html_message=html_message)
\ No newline at end of file
+            dedup_key = f'preorder-payment-status:{instance.pk}:{instance.payment_status}:{version}'
+            instance._status_emails = [build_email(dedup_key, subject, message, [instance.email, settings.MY_EMAIL])]
+
+
+@receiver(post_save, sender=PreOrder)
+def queue_status_emails(sender, instance, **kwargs):
+    # A failed save never gets here, so no email is queued for it
+    queue_emails(instance.__dict__.pop('_status_emails', []))
+
+
+@receiver(post_save, sender=PreOrder)
+@receiver(post_delete, sender=PreOrder)
+def preorder_history_changed(sender, instance, **kwargs):
+    # The cached history page is invalidated once the change is visible to other requests
+    transaction.on_commit(lambda: bump_history_version(instance.user_id))
+    transaction.on_commit(bump_demand_version)
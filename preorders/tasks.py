@@ -0,0 +1,18 @@
+from celery import shared_task
+import logging
+
+from preorders.arrival import process_arrival
+
+
+# Получаем экземпляр логгера Django, который был настроен в settings.py
+logger = logging.getLogger('django')
+
+
+@shared_task
+def process_shipment(received: dict):
+    """
+    Allocates a received supplier shipment, a map of product ids to quantities, to the waiting preorders.
+    """
+    ready = process_arrival(received)
+    logger.info(f'Готово к выдаче предзаказов: {ready}')
+    return ready
@@ -1,3 +1,160 @@
 from django.test import TestCase
 
-# Create your tests here.
+from orders.models import OutboxEmail
+from users.models import User
+from vitamins.models import Brand, Category, Vitamin
+from .cancellation import cancel_preorders
+from .models import OrderStatus, PreOrder, PreOrderItem
+
+
+class PreOrderBulkCancellationTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        category = Category.objects.create(name='Supplements', slug='supplements')
+        brand = Brand.objects.create(name='Nature Made', slug='nature-made')
+        self.vitamin = Vitamin.objects.create(title="Vitamin A", price=100, count=0, preorder_count=5, cat=category,
+                                              brand=brand, product_code="VIT100", packaging=1, unit='bottle')
+
+    def test_preordered_counts_are_decreased(self):
+        for quantity in (1, 3):
+            order = PreOrder.objects.create(user=self.user, email='test@test.com', phone_number='1')
+            PreOrderItem.objects.create(order=order, product=self.vitamin, quantity=quantity)
+
+        self.assertEqual(cancel_preorders(PreOrder.objects.all()), 2)
+        self.vitamin.refresh_from_db()
+        self.assertEqual(self.vitamin.preorder_count, 1)
+        self.assertEqual(PreOrder.objects.filter(status=OrderStatus.CANCELED).count(), 2)
+        self.assertEqual(OutboxEmail.objects.filter(dedup_key__startswith='preorder-status:').count(), 2)
+
+
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from vitamins.models import StockMovement
+from .demand import preorder_count_drift, preorder_demand, reconcile_preorder_counts
+
+
+class PreOrderDemandTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        category = Category.objects.create(name='Supplements', slug='supplements')
+        brand = Brand.objects.create(name='Nature Made', slug='nature-made')
+        self.vitamins = [Vitamin.objects.create(title=f"Vitamin {i}", price=100, count=0, preorder_count=10,
+                                                ordered=1, cat=category, brand=brand, product_code=f"VIT{i}",
+                                                packaging=1, unit='bottle')
+                         for i in range(2)]
+        for status, quantity in [(OrderStatus.NEW, 2), (OrderStatus.ORDERING, 3), (OrderStatus.CANCELED, 4),
+                                 (OrderStatus.EXECUTED, 5)]:
+            order = PreOrder.objects.create(user=self.user, email='test@test.com', phone_number='1', status=status)
+            PreOrderItem.objects.create(order=order, product=self.vitamins[0], quantity=quantity, sum=100 * quantity)
+
+    def test_demand_is_grouped_and_cached(self):
+        with self.assertNumQueries(1):
+            rows = preorder_demand()
+        self.assertEqual(len(rows), 1)
+        self.assertEqual((rows[0]['product_id'], rows[0]['quantity'], rows[0]['value'], rows[0]['preorders']),
+                         (self.vitamins[0].pk, 5, 500, 2))
+        self.assertEqual(rows[0]['to_purchase'], 4)
+        with CaptureQueriesContext(connection) as queries:
+            preorder_demand()
+        self.assertEqual([query for query in queries if 'preorderitem' in query['sql']], [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            order = PreOrder.objects.create(user=self.user, email='test@test.com', phone_number='1')
+            PreOrderItem.objects.create(order=order, product=self.vitamins[1], quantity=1, sum=100)
+        self.assertEqual(len(preorder_demand()), 2)
+
+    def test_preorder_counts_are_reconciled(self):
+        self.assertEqual(preorder_count_drift(), [(self.vitamins[0].pk, 10, 5), (self.vitamins[1].pk, 10, 0)])
+        reconcile_preorder_counts()
+        self.assertEqual(preorder_count_drift(), [])
+        self.assertEqual(list(Vitamin.objects.order_by('pk').values_list('preorder_count', flat=True)), [5, 0])
+        self.assertEqual(StockMovement.objects.filter(field='preorder_count').count(), 2)
+
+    def test_demand_admin_page(self):
+        admin_user = User.objects.create_superuser(username='admin', password='adminpass', email='admin@test.com')
+        self.client.force_login(admin_user)
+        url = reverse('admin:preorders_preorder_demand')
+        response = self.client.get(url)
+        self.assertContains(response, 'VIT0')
+        response = self.client.get(url, {'export': 'csv'})
+        self.assertEqual(response.content.decode().splitlines()[1].split(',')[:4], ['VIT0', 'Vitamin 0',
+                                                                                   'Nature Made', '5'])
+        response = self.client.post(url)
+        self.assertRedirects(response, url)
+        self.assertEqual(preorder_count_drift(), [])
+
+
+from django.contrib.admin import helpers
+from .arrival import process_arrival
+
+
+class PreOrderArrivalTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        category = Category.objects.create(name='Supplements', slug='supplements')
+        brand = Brand.objects.create(name='Nature Made', slug='nature-made')
+        self.vitamins = [Vitamin.objects.create(title=f"Vitamin {i}", price=100, count=0, ordered=10, cat=category,
+                                                brand=brand, product_code=f"VIT{i}", packaging=1, unit='bottle')
+                         for i in range(2)]
+        # Oldest first: 3 of A, 2 of A and 1 of B, 4 of A, and a canceled preorder
+        self.preorders = []
+        for lines, status in [([(0, 3)], OrderStatus.NEW), ([(0, 2), (1, 1)], OrderStatus.ORDERING),
+                              ([(0, 4)], OrderStatus.NEW), ([(0, 1)], OrderStatus.CANCELED)]:
+            order = PreOrder.objects.create(user=self.user, email='test@test.com', phone_number='1', status=status)
+            for index, quantity in lines:
+                PreOrderItem.objects.create(order=order, product=self.vitamins[index], quantity=quantity)
+            self.preorders.append(order)
+        Vitamin.objects.filter(pk=self.vitamins[0].pk).update(preorder_count=9)
+        Vitamin.objects.filter(pk=self.vitamins[1].pk).update(preorder_count=1)
+
+    def test_shipment_is_allocated_fifo(self):
+        # The second preorder waits for product B, so the third one gets its units of A
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(process_arrival({self.vitamins[0].pk: 8}), 2)
+        self.assertEqual(set(PreOrder.objects.filter(status=OrderStatus.READY).values_list('pk', flat=True)),
+                         {self.preorders[0].pk, self.preorders[2].pk})
+        self.assertEqual(Vitamin.objects.values_list('count', 'preorder_count', 'ordered').get(pk=self.vitamins[0].pk),
+                         (1, 2, 2))
+        self.assertEqual(OutboxEmail.objects.filter(dedup_key__startswith='preorder-status:').count(), 2)
+
+        # The unit of A left in stock and the next unit of A complete it with the units of B
+        self.assertEqual(process_arrival({self.vitamins[1].pk: 5}), 0)
+        self.assertEqual(process_arrival({self.vitamins[0].pk: 1}), 1)
+        self.assertEqual(PreOrder.objects.get(pk=self.preorders[1].pk).status, OrderStatus.READY)
+        self.assertEqual(Vitamin.objects.values_list('count', 'preorder_count').get(pk=self.vitamins[0].pk), (0, 0))
+        self.assertEqual(Vitamin.objects.values_list('count', 'preorder_count').get(pk=self.vitamins[1].pk), (4, 0))
+        self.assertEqual(preorder_count_drift(), [])
+
+    def test_canceling_a_ready_preorder_returns_its_stock(self):
+        process_arrival({self.vitamins[0].pk: 3})
+        self.assertEqual(PreOrder.objects.get(pk=self.preorders[0].pk).status, OrderStatus.READY)
+        self.assertEqual(Vitamin.objects.values_list('count', 'preorder_count').get(pk=self.vitamins[0].pk), (0, 6))
+
+        self.assertEqual(cancel_preorders(PreOrder.objects.filter(pk__in=[self.preorders[0].pk,
+                                                                           self.preorders[2].pk])), 2)
+        # The allocated units go back to the stock, only the waiting preorder is released
+        self.assertEqual(Vitamin.objects.values_list('count', 'preorder_count').get(pk=self.vitamins[0].pk), (3, 2))
+        self.assertEqual(preorder_count_drift(), [])
+
+    def test_statements_do_not_grow_with_preorders(self):
+        for _ in range(20):
+            order = PreOrder.objects.create(user=self.user, email='test@test.com', phone_number='1')
+            PreOrderItem.objects.create(order=order, product=self.vitamins[0], quantity=1)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(process_arrival({self.vitamins[0].pk: 100}), 22)
+        self.assertLessEqual(len(queries), 12)
+
+    def test_admin_action_processes_shipment(self):
+        admin_user = User.objects.create_superuser(username='admin', password='adminpass', email='admin@test.com')
+        self.client.force_login(admin_user)
+        url = reverse('admin:vitamins_vitamin_changelist')
+        data = {'action': 'receive_shipment', helpers.ACTION_CHECKBOX_NAME: [self.vitamins[0].pk]}
+        response = self.client.post(url, data)
+        self.assertContains(response, f'name="received-{self.vitamins[0].pk}" value="10"')
+        response = self.client.post(url, {**data, 'apply': 'Принять', f'received-{self.vitamins[0].pk}': '3'})
+        self.assertRedirects(response, url)
+        self.assertEqual(PreOrder.objects.get(pk=self.preorders[0].pk).status, OrderStatus.READY)
@@ -7,6 +7,8 @@ urlpatterns = [
     path('preorder_cart_detail', views.preorder_cart_detail, name='preorder_cart_detail'),
     path("add/<int:product_id>/", views.add_to_preorder_cart, name="add_to_preorder_cart"),
     path("remove/<int:cart_item_id>/", views.remove_from_preorder_cart, name="remove_from_preorder_cart"),
+    path("remove_product/<int:product_id>/", views.remove_product_from_preorder_cart,
+         name="remove_product_from_preorder_cart"),
     path("minus/<int:product_id>/", views.minus_from_preorder_cart, name="minus_from_preorder_cart"),
     path("preorder_checkout1/", views.checkout1, name="preorder_checkout1"),
     path("preorder_checkout2/", views.checkout2, name="preorder_checkout2"),
@@ -1,30 +1,36 @@
 from django.contrib.auth.decorators import login_required
-from django.core.mail import send_mail
 from django.db import transaction
+from django.http import Http404
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib import messages
-from django.template.loader import render_to_string
-from django.utils.html import format_html, strip_tags
+from django.utils.html import format_html
 
+from cart.checkout import CheckoutDraft, get_checkout_draft
+from cart.storage import get_cart_storage
 from internet_store import settings
-from preorders.models import PreOrderCart, PreOrder, TypeDelivery, PreOrderItem, OrderStatus
-from vitamins.models import Vitamin, ExchangeRate, DeliveryCost
+from orders.archive import get_order_or_archived
+from orders.history import history_page
+from orders.outbox import queue_email
+from preorders.cancellation import cancel_preorders
+from preorders.models import ArchivedPreOrder, ArchivedPreOrderItem, PreOrderCart, PreOrder, TypeDelivery, \
+    PreOrderItem, OrderStatus
+from vitamins.stock import reserve_preorders
 from vitamins.views import calculate_price
 import logging
 
 # We get the Django logger instance that was configured in settings.py
 logger = logging.getLogger('django')
 
+PREORDER_CHECKOUT_DRAFT_KEY = 'preorder_checkout_draft'
+
 
 def calculator_preorder_cart(request):
     """
     Calculates the total price of the preorders cart items.
     """
-    cart_items = PreOrderCart.objects.filter(user=request.user).select_related('product__brand')
-    exchange_rate = ExchangeRate.objects.all().first().rate
-    delivery_cost = DeliveryCost.objects.all().first().cost_per_kg
+    cart_items = get_cart_storage(request, PreOrderCart).cart_items()
     for item in cart_items:
-        item.product = calculate_price(item.product, exchange_rate, delivery_cost)
+        item.product = calculate_price(item.product)
         item.product.sum = (item.product.sale_price if item.product.discount else item.product.final_price) * item.quantity
 
     total_price = sum(item.product.sum for item in cart_items)
@@ -33,20 +39,16 @@ def calculator_preorder_cart(request):
     return cart_items, total_price, total_price_without_discount, discount
 
 
-@login_required
 def add_to_preorder_cart(request, product_id: int):
     """
     Adds a product to the user's preorders cart.
     """
-    cart_item = PreOrderCart.objects.filter(user=request.user, product=product_id).first()
-    product = Vitamin.objects.get(pk=product_id)
-    if cart_item:
-        cart_item.quantity += 1
-        cart_item.save()
+    quantity = get_cart_storage(request, PreOrderCart).add(product_id)
+    if quantity is None:
+        raise Http404('Продукт не найден')
+    if quantity > 1:
         messages.success(request, "Количество товара увеличено.")
-
     else:
-        PreOrderCart.objects.create(user=request.user, product=product)
         messages.success(request, "Продукт добавлен в корзину предзаказа.")
 
     return redirect(request.META.get('HTTP_REFERER', 'home'))
@@ -55,26 +57,32 @@ def add_to_preorder_cart(request, product_id: int):
 @login_required
 def remove_from_preorder_cart(request, cart_item_id: int):
     """
-    Removes a product from the user's preorders cart.
+    Removes a preorders cart line of the user by its id.
     """
     cart_item = get_object_or_404(PreOrderCart, id=cart_item_id)
 
     if cart_item.user == request.user:
-        cart_item.delete()
+        get_cart_storage(request, PreOrderCart).remove(cart_item.product_id)
         messages.success(request, "1 Продукт удален из корзины предзаказа.")
 
     return redirect("preorders:preorder_cart_detail")
 
 
-@login_required
+def remove_product_from_preorder_cart(request, product_id: int):
+    """
+    Removes a product from the user's preorders cart.
+    """
+    get_cart_storage(request, PreOrderCart).remove(product_id)
+    messages.success(request, "1 Продукт удален из корзины предзаказа.")
+
+    return redirect("preorders:preorder_cart_detail")
+
+
 def minus_from_preorder_cart(request, product_id: int):
     """
     Decreases the quantity of a product in the user's preorders cart by 1.
     """
-    cart_item = PreOrderCart.objects.filter(user=request.user, product=product_id).first()
-    if cart_item.quantity > 1:
-        cart_item.quantity -= 1
-        cart_item.save()
+    if get_cart_storage(request, PreOrderCart).subtract(product_id):
         messages.success(request, "Количество товара уменьшено.")
     else:
         messages.error(request, "Количество товара в корине предзаказа не может быть меньше 1!!!.")
@@ -82,7 +90,6 @@ def minus_from_preorder_cart(request, product_id: int):
     return redirect(request.META.get('HTTP_REFERER', 'home'))
 
 
-@login_required
 def preorder_cart_detail(request):
     """
     Renders the preorders cart detail page displaying preorders cart items, calculates total price, discount,
@@ -103,21 +110,28 @@ def preorder_cart_detail(request):
     return render(request, "preorders/cart_detail.html", context)
 
 
+def get_preorder_checkout_draft(request) -> CheckoutDraft:
+    """
+    Returns the checkout draft of the user's preorders cart, recalculating it only if the cart or pricing has changed.
+    """
+    get_cart_storage(request, PreOrderCart).flush()
+    return get_checkout_draft(request, PreOrderCart.objects.filter(user=request.user),
+                              lambda request: (*calculator_preorder_cart(request), ''),
+                              session_key=PREORDER_CHECKOUT_DRAFT_KEY)
+
+
 @login_required
 def checkout1(request):
     """
     Displays the checkout page with a choice of delivery method.
     Displays order value amounts, discounts and promotional codes if there is one.
     """
-    cart_items, total_price, total_price_without_discount, discount = calculator_preorder_cart(request)
-    request.session['total_price'] = total_price
-    request.session['total_price_without_discount'] = total_price_without_discount
-    request.session['discount'] = discount
+    draft = get_preorder_checkout_draft(request)
+    draft.set_delivery_option(None)
+    draft.save(request.session)
     context = {
         'title': 'Выбор способа получения заказа',
-        "total_price": total_price,
-        "total_price_without_discount": total_price_without_discount,
-        'discount': discount,
+        **draft.context(),
     }
     return render(request, "preorders/checkout1.html", context)
 
@@ -128,16 +142,15 @@ def checkout2(request):
     Displays the recipient data entry page depending on the delivery method.
     Adds shipping costs if sent by mail.
     """
+    draft = get_preorder_checkout_draft(request)
     if request.method == 'POST':
-        request.session['delivery_option'] = request.POST.get('delivery')
-    if request.session['delivery_option'] == 'mail':
-        request.session['total_price'] += 200
+        draft.set_delivery_option(request.POST.get('delivery'))
+        draft.save(request.session)
+    if not draft.delivery_option:
+        return redirect('preorders:preorder_checkout1')
     context = {
         'title': 'Внесение данных к предзаказу',
-        "total_price": request.session['total_price'],
-        "total_price_without_discount": request.session['total_price_without_discount'],
-        'discount': request.session['discount'],
-        'delivery_option': request.session['delivery_option']
+        **draft.context(),
     }
     return render(request, "preorders/checkout2.html", context)
 
@@ -145,28 +158,19 @@ def checkout2(request):
 @login_required
 def checkout3(request):
     """
-    Saves the recipient's data in the session.
+    Saves the recipient's data in the checkout draft.
     Displays the payment method selection page.
     """
+    draft = get_preorder_checkout_draft(request)
+    if not draft.delivery_option:
+        return redirect('preorders:preorder_checkout1')
     if request.method == 'POST':
-        request.session['last_name'] = request.POST.get('lastname')
-        request.session['first_name'] = request.POST.get('firstname')
-        request.session['email'] = request.POST.get('email')
-        request.session['phone_number'] = request.POST.get('phone')
-        request.session['comment'] = request.POST.get('comment')
-        if request.session['delivery_option'] == 'mail':
-            request.session['middle_name'] = request.POST.get('middle_name')
-            request.session['region'] = request.POST.get('region')
-            request.session['city'] = request.POST.get('city')
-            request.session['address'] = request.POST.get('street')
-            request.session['postal_code'] = request.POST.get('zip')
+        draft.set_customer(request.POST)
+        draft.save(request.session)
 
     context = {
         'title': 'Способ оплаты',
-        "total_price": request.session['total_price'],
-        "total_price_without_discount": request.session['total_price_without_discount'],
-        'discount': request.session['discount'],
-        'delivery_option': request.session['delivery_option'],
+        **draft.context(),
     }
 
     return render(request, "preorders/checkout3.html", context)
@@ -178,17 +182,18 @@ def checkout4(request):
     Saves the payment method.
     Displays the preorders cart details check page.
     """
-    request.session['type_payment'] = request.POST.get('payment')
-    cart_items, total_price, total_price_without_discount, discount = calculator_preorder_cart(request)
-    if request.session['delivery_option'] == 'mail':
-        total_price += 200
+    draft = get_preorder_checkout_draft(request)
+    if not draft.delivery_option:
+        return redirect('preorders:preorder_checkout1')
+    if request.method == 'POST':
+        draft.set_type_payment(request.POST.get('payment'))
+        draft.save(request.session)
+    cart_items = draft.apply_to(PreOrderCart.objects.filter(user=request.user).select_related('product__brand')
+                                .prefetch_related('product__images'))
     context = {
         "cart_items": cart_items,
-        "total_price": total_price,
-        "total_price_without_discount": total_price_without_discount,
-        'discount': discount,
         'title': 'Проверка предзаказа перед оформлением',
-        'delivery_option': request.session['delivery_option']
+        **draft.context(),
     }
 
     return render(request, "preorders/checkout4.html", context)
@@ -199,31 +204,30 @@ def create_order_from_cart(request, shipping_address: str):
     """
     Creates an preorder from the items in the user's cart.
 
-    Retrieves preorders cart items, total price, total price without discount, discount from the session.
+    Takes preorders cart lines, prices and discount from the checkout draft, which is
+    recalculated only if the cart or pricing has changed since the checkout started.
     Adds shipping cost if the selected delivery option is 'mail'.
     Creates an order with the provided shipping address, user details, and payment type.
     Creates order items for each product in the cart.
-    Empties the preorders cart after creating the order.
+    Empties the preorders cart and clears the checkout draft after creating the order.
 
     Returns:
         PreOrder: The created order instance.
     """
-    cart_items, total_price, total_price_without_discount, discount = calculator_preorder_cart(request)
-    if request.session['delivery_option'] == 'mail':
-        # add shipping cost
-        total_price += 200
+    draft = get_preorder_checkout_draft(request)
+    cart_items = draft.apply_to(PreOrderCart.objects.filter(user=request.user).select_related('product'))
+    customer = draft.customer
 
     with transaction.atomic():
         order = PreOrder.objects.create(user=request.user,
-                                        comment=request.session['comment'],
-                                        type_delivery=TypeDelivery.PICKUP if request.session[
-                                                                                 'delivery_option'] == 'pickup' else TypeDelivery.POST,
-                                        total_price=total_price,
-                                        without_discount=total_price_without_discount,
-                                        discount_sum=discount,
+                                        comment=customer.get('comment') or '',
+                                        type_delivery=TypeDelivery.PICKUP if draft.delivery_option == 'pickup' else TypeDelivery.POST,
+                                        total_price=draft.total_price,
+                                        without_discount=draft.total_price_without_discount,
+                                        discount_sum=draft.discount,
                                         shipping_address=shipping_address,
-                                        email=request.session['email'],
-                                        phone_number=request.session['phone_number']
+                                        email=customer['email'],
+                                        phone_number=customer['phone_number']
                                         )
         for item in cart_items:
             PreOrderItem.objects.create(
@@ -234,18 +238,18 @@ def create_order_from_cart(request, shipping_address: str):
                 sum=item.product.sum,
                 discount=item.product.discount
             )
-            # Reducing the quantity of products in stock
-            item.product.adding_preorder_count(item.quantity)
-            item.product.adding_sold(item.quantity)
-        # Empty preorders cart after creating preorder
-        cart_items.delete()
+        # Adding the products to the preordered and sold counts
+        reserve_preorders([(order.pk, item.product_id, item.quantity) for item in cart_items])
+        # Empty preorders cart after creating preorder, through the storage so a Redis cart is emptied too
+        get_cart_storage(request, PreOrderCart).clear()
+        draft.clear(request.session)
     return order
 
 
 @login_required
 def create_preorder(request):
     """
-    Creates an preorder based on the user's session data and cart items.
+    Creates an preorder based on the checkout draft and cart items.
 
     Attempts to create an preorder within a database transaction. If successful, sends a confirmation email to the user
     and redirects them to the preorders history page. If an error occurs during the creation of the preorder,
@@ -253,41 +257,41 @@ def create_preorder(request):
     """
     try:
         with transaction.atomic():
+            draft = get_preorder_checkout_draft(request)
+            customer = draft.customer
+            if not draft.delivery_option or not customer:
+                raise ValueError('Не заполнены данные для оформления предзаказа')
             shipping_address = '\n'.join([
-                                             request.session['last_name'],
-                                             request.session['first_name'],
-                                             request.session['email'],
-                                             request.session['phone_number'],
-                                             request.session['comment']
-                                         ] if request.session['delivery_option'] == 'pickup' else [
-                request.session['last_name'],
-                request.session['first_name'],
-                request.session['middle_name'],
-                request.session['email'],
-                request.session['phone_number'],
-                request.session['region'],
-                request.session['city'],
-                request.session['address'],
-                request.session['postal_code'],
-                request.session['comment']
+                                             customer['last_name'],
+                                             customer['first_name'],
+                                             customer['email'],
+                                             customer['phone_number'],
+                                             customer['comment']
+                                         ] if draft.delivery_option == 'pickup' else [
+                customer['last_name'],
+                customer['first_name'],
+                customer['middle_name'],
+                customer['email'],
+                customer['phone_number'],
+                customer['region'],
+                customer['city'],
+                customer['address'],
+                customer['postal_code'],
+                customer['comment']
             ])
             # Create preorder
             order = create_order_from_cart(request, shipping_address)
 
             messages.success(request, f'Поздравляем, ваш предзаказ успешно создан!')
 
-            # Sending a confirmation email to the user
+            # Queueing a confirmation email to the user, it is sent after the transaction commits
             subject = f'Ваш предзаказ #{order.id} успешно оформлен'
             # Forming an HTML link
             order_link = format_html('<a href="{}">#{}<a/>', order.get_absolute_url(), order.pk)
             message = format_html(
                 'Ваш предзаказ {} оформлен!!! В ближайшее время наш менеджер свяжется с вами для подтверждения пердзаказа и уточнения деталей доставки.',
                 order_link)
-            html_message = render_to_string('email_template.html', {'message': message})
-            plain_message = strip_tags(html_message)
-            email_from = settings.EMAIL_HOST_USER
-            recipient_list = [order.email, settings.MY_EMAIL]
-            send_mail(subject, plain_message, email_from, recipient_list, html_message=html_message)
+            queue_email(f'preorder-created:{order.pk}', subject, message, [order.email, settings.MY_EMAIL])
 
             return redirect('preorders:preorders_history')
 
@@ -296,7 +300,7 @@ def create_preorder(request):
         logger.error(f'Ошибка при создании заказа: {e}', exc_info=True)
         # Returning the user back to the cart with an error message
         messages.error(request, 'Произошла ошибка при создании предзаказа: {}'.format(e))
-        return redirect('checkout4')
+        return redirect('preorders:preorder_checkout4')
 
 
 @login_required
@@ -304,13 +308,22 @@ def preorders_history(request):
     """
     Displays the preorder history for the authenticated user.
 
-    Retrieves the preorders associated with the current user and renders them in the preorders history page.
+    Renders a page of the user's preorders, optionally filtered by status, with the number of items
+    and the first item image of every preorder. The next page is selected by the `after` cursor,
+    see `orders.history.history_page`.
     """
-    orders = PreOrder.objects.filter(user=request.user)
-
+    status = request.GET.get('status')
+    if status not in OrderStatus.values:
+        status = None
+    orders, next_cursor = history_page(PreOrder, PreOrderItem, request.user, status, request.GET.get('after'),
+                                       archive=(ArchivedPreOrder, ArchivedPreOrderItem))
     context = {
         'title': 'История предзаказов',
-        'orders': orders
+        'orders': orders,
+        'statuses': OrderStatus.choices,
+        'current_status': status,
+        'next_cursor': next_cursor,
+        'is_first_page': not request.GET.get('after'),
     }
     return render(request, 'preorders/preorders_history.html', context)
 
@@ -320,11 +333,12 @@ def preorder_detail(request, order_id: int):
     """
     Displays the details of a specific preorder.
 
-    Retrieves the preorder details and associated order items for the specified preorder ID.
+    Retrieves the preorder details and associated order items for the specified preorder ID, from the archive
+    if the preorder has been archived.
     Renders the order details page with the order information and its items.
     """
-    order = get_object_or_404(PreOrder, pk=order_id)
-    order_items = PreOrderItem.objects.filter(order__pk=order_id).select_related('product__brand')
+    order = get_order_or_archived(PreOrder, ArchivedPreOrder, pk=order_id)
+    order_items = order.items.select_related('product__brand')
     context = {
         'order': order,
         'order_items': order_items,
@@ -337,20 +351,17 @@ def preorder_detail(request, order_id: int):
 @login_required
 def canceling_preorder(request, order_id: int):
     """
-    Cancels a specific preorder.
+    Cancels a specific preorder of the user.
 
-    Cancels the preorder identified by the given preorder ID. It updates the order status to "CANCELED"
-    and restores the quantity of each product in the order back to the stock.
+    Cancels the preorder identified by the given preorder ID with the bulk cancellation service,
+    see `preorders.cancellation`. It updates the preorder status to "CANCELED" and decreases the preordered quantity of each product.
     """
     try:
-        with transaction.atomic():
-            order = get_object_or_404(PreOrder, pk=order_id)
-            order_items = order.items.all()
-            order.status = OrderStatus.CANCELED
-            for item in order_items:
-                item.product.decrease_preorder_count(item.quantity)
-            order.save()
-            return redirect('preorders:preorders_history')
+        orders = PreOrder.objects.filter(pk=order_id, user=request.user)
+        if not orders.exists():
+            raise Http404('Заказ не найден')
+        cancel_preorders(orders)
+        return redirect('preorders:preorders_history')
     except Exception as e:
         messages.error(request, 'Произошла ошибка при отмене предзаказа: {}'.format(e))
         return redirect('preorders:preorders_history')
@@ -0,0 +1,82 @@
+// ------------------------------------------------------- //
+//   Cart actions without a full page reload
+//   Links and forms with a data-cart-json attribute are sent to the JSON
+//   cart endpoints; without JavaScript their regular href/action is used.
+// ------------------------------------------------------ //
+(function () {
+    function getCookie(name) {
+        const match = document.cookie.match('(^|;)\\s*' + name + '=([^;]*)');
+        return match ? decodeURIComponent(match[2]) : null;
+    }
+
+    function showMessages(items) {
+        const container = document.querySelector('[data-cart-messages]');
+        if (!container) {
+            return;
+        }
+        container.innerHTML = '';
+        items.forEach(function (item) {
+            const alert = document.createElement('div');
+            alert.className = 'alert alert-' + (item.level === 'error' ? 'danger' : 'success');
+            alert.textContent = item.text;
+            container.appendChild(alert);
+        });
+    }
+
+    function update(data) {
+        document.querySelectorAll('[data-cart-count]').forEach(function (el) {
+            el.textContent = '(' + data.cart_items_count + ')';
+        });
+        document.querySelectorAll('[data-preorder-cart-count]').forEach(function (el) {
+            el.textContent = ' (' + data.preorder_cart_items_count + ')';
+        });
+        if (data.fragments) {
+            document.getElementById('cart-lines').innerHTML = data.fragments.lines;
+            document.getElementById('cart-totals').innerHTML = data.fragments.totals;
+            const checkout = document.getElementById('cart-checkout');
+            if (checkout) {
+                checkout.classList.toggle('disabled', !data.cart_items_count);
+            }
+        }
+        showMessages(data.messages || []);
+    }
+
+    function send(url, body) {
+        if (document.getElementById('cart-lines')) {
+            url += (url.indexOf('?') === -1 ? '?' : '&') + 'fragments=1';
+        }
+        return fetch(url, {
+            method: 'POST',
+            body: body,
+            credentials: 'same-origin',
+            headers: {'X-CSRFToken': getCookie('csrftoken'), 'X-Requested-With': 'XMLHttpRequest'},
+        }).then(function (response) {
+            if (!response.headers.get('Content-Type').startsWith('application/json')) {
+                throw new Error(response.statusText);
+            }
+            return response.json();
+        }).then(update);
+    }
+
+    document.addEventListener('click', function (event) {
+        const link = event.target.closest('a[data-cart-json]');
+        if (!link || !link.dataset.cartJson) {
+            return;
+        }
+        event.preventDefault();
+        send(link.dataset.cartJson).catch(function () {
+            window.location = link.href;
+        });
+    });
+
+    document.addEventListener('submit', function (event) {
+        const form = event.target.closest('form[data-cart-json]');
+        if (!form) {
+            return;
+        }
+        event.preventDefault();
+        send(form.dataset.cartJson, new FormData(form)).catch(function () {
+            form.submit();
+        });
+    });
+})();
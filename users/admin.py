@@ -1,11 +1,59 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
+from django.db.models import Q
+from django.db.models.functions import Lower
+from django.db.models.lookups import StartsWith
 from users.models import User
 
 
+def search_users(queryset, term: str, prefix: str = ''):
+    """
+    Filters the queryset by users whose username or email starts with the term, whatever the case.
+
+    The lower-cased columns are compared by prefix, which the indexes of `User.Meta` serve,
+    unlike `icontains`, which scans the whole table.
+    """
+    term = term.strip().lower()
+    return queryset.filter(Q(StartsWith(Lower(f'{prefix}username'), term)) |
+                           Q(StartsWith(Lower(f'{prefix}email'), term)))
+
+
+class UserLookupFilter(admin.SimpleListFilter):
+    """
+    Filters orders by a username or email typed in, instead of listing every user in the sidebar.
+    """
+    title = 'Покупатель'
+    parameter_name = 'user'
+    template = 'admin/users/user_lookup_filter.html'
+
+    def lookups(self, request, model_admin):
+        return [(self.value(), self.value())] if self.value() else []
+
+    def has_output(self):
+        return True
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return search_users(queryset, self.value(), 'user__')
+        return queryset
+
+    def choices(self, changelist):
+        yield {
+            'value': self.value() or '',
+            'parameter_name': self.parameter_name,
+            # The other filters are kept when searching
+            'params': [(key, value) for key, value in changelist.get_filters_params().items()
+                       if key != self.parameter_name],
+            'clear_query_string': changelist.get_query_string(remove=[self.parameter_name]),
+        }
+
+
 class UserAdmin(BaseUserAdmin):
     # Добавляем дополнительные поля в список полей, которые будут отображаться на странице списка пользователей
     list_display = BaseUserAdmin.list_display + ('phone_number',)
+    search_fields = ('username', 'first_name', 'last_name', 'email')
+    # Searched by prefix with `search_users`, which the autocomplete of the order forms uses too
+    prefix_search_fields = ('username', 'email')
 
     # Добавляем дополнительные поля в форму редактирования пользователя
     fieldsets = BaseUserAdmin.fieldsets + (
@@ -17,5 +65,15 @@ class UserAdmin(BaseUserAdmin):
         ('Additional Info', {'fields': ('phone_number',)}),
     )
 
+    def get_search_fields(self, request):
+        return [field for field in super().get_search_fields(request) if field not in self.prefix_search_fields]
+
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term.strip():
+            return queryset, False
+        # The names are searched the default way
+        by_name, may_have_duplicates = super().get_search_results(request, queryset, search_term)
+        return search_users(queryset, search_term) | by_name, may_have_duplicates
+
 
 admin.site.register(User, UserAdmin)
@@ -1,17 +1,53 @@
-from django.contrib.auth import get_user_model
+import logging
+
+from django.contrib import auth
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, get_user_model
 from django.contrib.auth.backends import BaseBackend
+from django.contrib.auth.middleware import AuthenticationMiddleware as BaseAuthenticationMiddleware
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.functions import Lower
+from django.db.models.lookups import Exact
+from django.utils.functional import SimpleLazyObject
+
+# Получаем экземпляр логгера Django, который был настроен в settings.py
+logger = logging.getLogger('django')
+
+# Seconds a verified session user is reused, see `get_session_user`
+USER_CACHE_TIMEOUT = 60
+# The user fields cached for the sessions, the other ones are loaded from the database when accessed
+SESSION_USER_FIELDS = ('id', 'username', 'email', 'first_name', 'last_name', 'phone_number', 'is_active',
+                       'is_staff', 'is_superuser')
+
+
+def user_cache_key(user_id, session_hash: str) -> str:
+    return f'auth_user:{user_id}:{session_hash}'
+
+
+def email_matches(email: str):
+    """
+    Returns a case-insensitive email filter served by the unique index on lower(email).
+    """
+    return Exact(Lower('email'), email.lower())
 
 
 class EmailAuthBackend(BaseBackend):
     def authenticate(self, request, username=None, password=None, **kwargs):
+        if not username or password is None:
+            return None
         user_model = get_user_model()
         try:
-            user = user_model.objects.get(email=username)
-            if user.check_password(password):
-                return user
+            user = user_model.objects.get(email_matches(username))
+        except user_model.DoesNotExist:
+            # Runs the hasher anyway, so the response time does not tell whether the email is registered
+            user_model().set_password(password)
             return None
-        except (user_model.DoesNotExist, user_model.MultipleObjectsReturned):
+        except user_model.MultipleObjectsReturned:
+            logger.error(f'Несколько пользователей с email {username}, см. команду find_duplicate_emails')
             return None
+        if user.check_password(password):
+            return user
+        return None
 
     def get_user(self, user_id):
         user_model = get_user_model()
@@ -19,3 +55,53 @@ class EmailAuthBackend(BaseBackend):
             return user_model.objects.get(pk=user_id)
         except user_model.DoesNotExist:
             return None
+
+
+def get_session_user(request):
+    """
+    Returns the user of the session like `django.contrib.auth.get_user`.
+
+    Once Django has verified the session auth hash against the password of the user, the fields
+    in `SESSION_USER_FIELDS` are cached for `USER_CACHE_TIMEOUT` seconds under the user id and that hash,
+    so a changed password misses the cache and logs the other sessions out. The entries are deleted
+    when the user is saved or deleted, see `users.signals`. The password is never cached, the users
+    built from the cache load it and the other fields from the database when they are accessed.
+    """
+    user_id = request.session.get(auth.SESSION_KEY)
+    session_hash = request.session.get(HASH_SESSION_KEY)
+    if user_id is None or not session_hash or \
+            request.session.get(BACKEND_SESSION_KEY) not in settings.AUTHENTICATION_BACKENDS:
+        return auth.get_user(request)
+
+    user_model = get_user_model()
+    key = user_cache_key(user_id, session_hash)
+    values = cache.get(key)
+    if values is not None:
+        return user_model.from_db('default', cached_field_names(user_model), values)
+
+    user = auth.get_user(request)
+    # The hash is updated by get_user when the session was verified with a fallback secret
+    if user.is_authenticated and request.session.get(HASH_SESSION_KEY) == session_hash:
+        cache.set(key, [getattr(user, name) for name in cached_field_names(user_model)], USER_CACHE_TIMEOUT)
+    return user
+
+
+def cached_field_names(user_model) -> list:
+    # In the order of the model fields, as `Model.from_db` expects them
+    return [field.attname for field in user_model._meta.concrete_fields if field.attname in SESSION_USER_FIELDS]
+
+
+class AuthenticationMiddleware(BaseAuthenticationMiddleware):
+    """
+    Django's authentication middleware with the session user taken from `get_session_user`.
+    """
+
+    def process_request(self, request):
+        super().process_request(request)
+        request.user = SimpleLazyObject(lambda: get_request_user(request))
+
+
+def get_request_user(request):
+    if not hasattr(request, '_cached_user'):
+        request._cached_user = get_session_user(request)
+    return request._cached_user
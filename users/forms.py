@@ -2,6 +2,8 @@ from django import forms
 from django.contrib.auth import get_user_model
 from django.contrib.auth.forms import AuthenticationForm, UserCreationForm, PasswordChangeForm
 
+from users.authentication import email_matches
+
 
 class LoginUserForm(AuthenticationForm):
     username = forms.CharField(label='Логин или E-mail', widget=forms.TextInput(attrs={'class': "form-control"}))
@@ -32,8 +34,7 @@ class RegisterUserForm(UserCreationForm):
 
     def clean_email(self):
         email = self.cleaned_data['email']
-        user = get_user_model().objects.filter(email=email)
-        if user.exists():
+        if email and get_user_model().objects.filter(email_matches(email)).exists():
             raise forms.ValidationError('Пользователь с таким E-mail уже существует!')
         return email
 
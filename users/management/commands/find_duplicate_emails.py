@@ -0,0 +1,23 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+from django.db.models.functions import Lower
+
+
+class Command(BaseCommand):
+    help = 'Reports the users whose emails differ only in case. The unique index on lower(email) ' \
+           'can not be created until they are merged or changed, so run it before migrating.'
+
+    def handle(self, *args, **options):
+        user_model = get_user_model()
+        duplicates = list(user_model.objects.exclude(email='').order_by()
+                          .values(email_lower=Lower('email')).annotate(users=Count('pk'))
+                          .filter(users__gt=1).values_list('email_lower', flat=True))
+        users = user_model.objects.exclude(email='').annotate(email_lower=Lower('email')) \
+            .filter(email_lower__in=duplicates).order_by('email_lower', 'pk')
+        for user in users:
+            self.stdout.write(f'{user.email_lower}: #{user.pk} {user.username} <{user.email}> '
+                              f'last login {user.last_login or "never"}')
+        if duplicates:
+            raise CommandError(f'Duplicate emails: {len(duplicates)}')
+        self.stdout.write('No duplicate emails')
@@ -1,6 +1,40 @@
 from django.contrib.auth.models import AbstractUser
 from django.db import models
+from django.db.models import Q
+from django.db.models.functions import Lower
+from django.utils.translation import gettext_lazy as _
+
+
+class LowerPrefixIndex(models.Index):
+    """
+    An index of lower-cased columns for case-insensitive prefix lookups, see `users.admin.search_users`.
+
+    On PostgreSQL the columns are indexed with the varchar_pattern_ops operator class,
+    so LIKE 'term%' can use the index whatever the collation of the database.
+    """
+
+    def create_sql(self, model, schema_editor, using='', **kwargs):
+        if schema_editor.connection.vendor != 'postgresql':
+            return super().create_sql(model, schema_editor, using, **kwargs)
+        from django.contrib.postgres.indexes import OpClass
+
+        _, _, options = self.deconstruct()
+        index = models.Index(*[OpClass(expression, name='varchar_pattern_ops') for expression in self.expressions],
+                             **options)
+        return index.create_sql(model, schema_editor, using, **kwargs)
 
 
 class User(AbstractUser):
+    email = models.EmailField(_('email address'), blank=True)
     phone_number = models.CharField(blank=True, default=0, max_length=12)
+
+    class Meta(AbstractUser.Meta):
+        constraints = [
+            # Emails are compared case-insensitively, users without an email are allowed
+            models.UniqueConstraint(Lower('email'), condition=~Q(email=''), name='unique_user_email_ci'),
+        ]
+        indexes = [
+            # The admin search by username or email prefix
+            LowerPrefixIndex(Lower('username'), name='user_username_lower_idx'),
+            LowerPrefixIndex(Lower('email'), name='user_email_lower_idx'),
+        ]
@@ -0,0 +1,32 @@
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from users.authentication import user_cache_key
+from users.models import User
+
+
+@receiver(pre_save, sender=User)
+def remember_session_hash(sender, instance, update_fields=None, raw=False, **kwargs):
+    """
+    Remembers the session auth hash of the stored password, so the cached session user is dropped
+    by `user_changed` even when the password is changed.
+    """
+    if raw or instance.pk is None:
+        return
+    if update_fields is not None and 'password' not in update_fields:
+        instance._stored_session_hash = instance.get_session_auth_hash()
+        return
+    password = User.objects.filter(pk=instance.pk).values_list('password', flat=True).first()
+    instance._stored_session_hash = User(password=password).get_session_auth_hash() if password else None
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, **kwargs):
+    keys = {user_cache_key(instance.pk, session_hash)
+            for session_hash in (getattr(instance, '_stored_session_hash', None), instance.get_session_auth_hash())
+            if session_hash}
+    # The cached users of the sessions are dropped once the change is visible to other requests
+    transaction.on_commit(lambda: cache.delete_many(keys))
@@ -1,3 +1,97 @@
+from io import StringIO
+
+from django.contrib.auth import HASH_SESSION_KEY
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError, transaction
 from django.test import TestCase
 
-# Create your tests here.
+from .authentication import SESSION_USER_FIELDS, EmailAuthBackend, cached_field_names, user_cache_key
+from .models import User
+
+
+class EmailAuthBackendTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='buyer', password='testpass', email='Buyer@Test.com')
+        self.backend = EmailAuthBackend()
+
+    def test_email_is_matched_case_insensitively(self):
+        self.assertEqual(self.backend.authenticate(None, username='buyer@test.COM', password='testpass'), self.user)
+        self.assertIsNone(self.backend.authenticate(None, username='buyer@test.com', password='wrong'))
+        self.assertIsNone(self.backend.authenticate(None, username='nobody@test.com', password='testpass'))
+
+    def test_emails_are_unique_case_insensitively(self):
+        User.objects.create_user(username='no-email-1', password='testpass')
+        User.objects.create_user(username='no-email-2', password='testpass')
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            User.objects.create_user(username='other', password='testpass', email='BUYER@test.com')
+
+    def test_session_user_is_cached_until_the_user_is_saved(self):
+        self.client.force_login(self.user)
+        self.client.get('/users/profile/')
+        session_hash = self.client.session[HASH_SESSION_KEY]
+        cached = dict(zip(cached_field_names(User), cache.get(user_cache_key(self.user.pk, session_hash))))
+        self.assertEqual(cached['username'], 'buyer')
+        # Only the fields of SESSION_USER_FIELDS, never the password hash
+        self.assertEqual(set(cached), set(SESSION_USER_FIELDS))
+
+        request = self.client.get('/users/profile/').wsgi_request
+        with self.assertNumQueries(0):
+            self.assertEqual(request.user.username, 'buyer')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.first_name = 'Ivan'
+            self.user.save()
+        self.assertIsNone(cache.get(user_cache_key(self.user.pk, session_hash)))
+        self.assertEqual(self.client.get('/users/profile/').wsgi_request.user.first_name, 'Ivan')
+
+    def test_password_change_and_deactivation_end_the_cached_sessions(self):
+        self.client.force_login(self.user)
+        self.client.get('/users/profile/')
+        with self.captureOnCommitCallbacks(execute=True):
+            user = User.objects.get(pk=self.user.pk)
+            user.set_password('newpass')
+            user.save()
+        self.assertFalse(self.client.get('/users/profile/').wsgi_request.user.is_authenticated)
+
+        self.client.force_login(self.user, backend='django.contrib.auth.backends.ModelBackend')
+        self.client.get('/users/profile/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_active = False
+            self.user.save(update_fields=['is_active'])
+        self.assertFalse(self.client.get('/users/profile/').wsgi_request.user.is_authenticated)
+
+    def test_login_by_email_and_session_user(self):
+        response = self.client.post('/users/login/', {'username': 'BUYER@test.com', 'password': 'testpass'})
+        self.assertEqual(response.status_code, 302)
+        response = self.client.get('/users/profile/')
+        self.assertEqual(response.wsgi_request.user, self.user)
+
+    def test_duplicate_emails_are_reported(self):
+        output = StringIO()
+        call_command('find_duplicate_emails', stdout=output)
+        self.assertIn('No duplicate emails', output.getvalue())
+
+
+from django.urls import reverse
+from .admin import search_users
+
+
+class UserSearchTestCase(TestCase):
+    def setUp(self):
+        self.buyer = User.objects.create_user(username='Buyer', password='testpass', email='Buyer@Test.com',
+                                              first_name='Ivan', last_name='Petrov')
+        User.objects.create_user(username='other', password='testpass', email='other@test.com')
+
+    def test_prefix_search_ignores_case(self):
+        for term in ('buy', 'BUYER', 'buyer@t', ' Buyer@Test.com '):
+            self.assertEqual(list(search_users(User.objects.all(), term)), [self.buyer], term)
+        self.assertFalse(search_users(User.objects.all(), 'uyer').exists())
+
+    def test_admin_searches_names_too(self):
+        admin_user = User.objects.create_superuser(username='admin', password='adminpass', email='admin@test.com')
+        self.client.force_login(admin_user)
+        for term in ('buyer@test', 'Petrov', 'ivan'):
+            response = self.client.get(reverse('admin:users_user_changelist'), {'q': term})
+            self.assertEqual(list(response.context['cl'].result_list), [self.buyer], term)
@@ -1,7 +1,50 @@
-from django.contrib import admin
+import io
+import tempfile
+
+from django.contrib import admin, messages
+from django.contrib.admin import helpers
+from django.core.exceptions import PermissionDenied
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db.models import OuterRef, Subquery
+from django.template.response import TemplateResponse
+from django.urls import path
+from django.utils import timezone
+from django.utils.html import format_html
 from django.utils.safestring import mark_safe
 
-from .models import Vitamin, Brand, Category, Tag, ExchangeRate, DeliveryCost, VitaminImage, Percent, DeliveryRequest
+from preorders.tasks import process_shipment
+
+from .models import Vitamin, Brand, Category, Tag, ExchangeRate, DeliveryCost, VitaminImage, Percent, DeliveryRequest, \
+    MovementSource, StockField, StockMovement
+from .forms import SupplierImportForm
+from .stock import adjust_stock, record_balances
+from .supplier_import import ImportReport, import_supplier_file
+
+import logging
+
+
+# Получаем экземпляр логгера Django, который был настроен в settings.py
+logger = logging.getLogger('django')
+
+
+def with_main_image(queryset, vitamin: str = 'pk'):
+    """
+    Annotates the rows with `main_image`, the file name of the main image of the product
+    referenced by the `vitamin` field (the first image if none is main), selected by a subquery in the same SELECT.
+    """
+    return queryset.annotate(main_image=Subquery(VitaminImage.objects.filter(vitamin=OuterRef(vitamin))
+                                                 .values('image')[:1]))
+
+
+def thumbnail(image_name: str | None, alt: str = '', width: int = 75) -> str:
+    """
+    Renders a linked thumbnail of an image annotated by `with_main_image`, without reading the images again.
+    """
+    if not image_name:
+        return ''
+    url = VitaminImage._meta.get_field('image').storage.url(image_name)
+    return format_html("<a href='{}'><img src='{}' alt='{}' width='{}'></a>", url, url, alt, width)
 
 
 @admin.register(Category)
@@ -53,19 +96,125 @@ class VitaminAdmin(admin.ModelAdmin):
               'weight', 'packaging', 'unit', 'product_code', 'total_sold', 'vitamin_photo',
               'analog', 'slug', 'short_content', 'content']
     ordering = ['time_create', 'title']
-    filter_horizontal = ('tags', 'analog')
+    filter_horizontal = ('tags',)
+    autocomplete_fields = ('analog',)
     list_per_page = 7
     list_filter = ['discount', 'cat__name', 'brand__name']
-    search_fields = ['title', 'brand__name', 'cat__name']
+    search_fields = ['title', 'product_code', 'brand__name', 'cat__name']
     readonly_fields = ['slug', 'vitamin_photo']
     save_on_top = True
+    actions = ('receive_shipment',)
+    list_select_related = ('brand', 'cat')
+    change_list_template = 'admin/vitamins/vitamin/change_list.html'
+
+    def get_queryset(self, request):
+        return with_main_image(super().get_queryset(request))
+
+    def get_urls(self):
+        return [
+            path('import/', self.admin_site.admin_view(self.import_view), name='vitamins_vitamin_import'),
+        ] + super().get_urls()
+
+    def import_view(self, request):
+        """
+        Imports a supplier file uploaded by staff, see `vitamins.supplier_import`, and saves
+        the report of the changed, unknown and invalid rows to the media storage.
+        """
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        form = SupplierImportForm(request.POST or None, request.FILES or None)
+        report, report_url = None, None
+        if form.is_valid():
+            upload = form.cleaned_data['file']
+            file_format = 'csv' if upload.name.lower().endswith('.csv') else 'json'
+            with tempfile.TemporaryFile() as report_file:
+                report_text = io.TextIOWrapper(report_file, encoding='utf-8-sig', newline='')
+                report = import_supplier_file(io.TextIOWrapper(upload, encoding='utf-8-sig', newline=''),
+                                              file_format, ImportReport(report_text), form.cleaned_data['dry_run'])
+                report_text.flush()
+                report_file.seek(0)
+                name = default_storage.save(f'imports/supplier_{timezone.now():%Y%m%d_%H%M%S}.csv', File(report_file))
+                report_url = default_storage.url(name)
+            prefix = 'Проверка без изменений. ' if form.cleaned_data['dry_run'] else ''
+            self.message_user(request, f'{prefix}Обновлено товаров: {report.counts["updated"]}, '
+                                       f'ошибок: {report.counts["invalid"]}, не найдено: {report.counts["unknown"]}')
+
+        context = {
+            **self.admin_site.each_context(request),
+            'title': 'Импорт от поставщика',
+            'opts': self.model._meta,
+            'form': form,
+            'report': report,
+            'report_url': report_url,
+        }
+        return TemplateResponse(request, 'admin/vitamins/vitamin/import.html', context)
+
+    def formfield_for_dbfield(self, db_field, request, **kwargs):
+        if db_field.name in StockField.values:
+            # The form posts the value it was opened with, so the change can be applied as a difference
+            kwargs['show_hidden_initial'] = True
+        return super().formfield_for_dbfield(db_field, request, **kwargs)
+
+    @staticmethod
+    def opened_value(form, field: str) -> int:
+        value = form.data.get(form.add_initial_prefix(field))
+        if value is None:
+            return form.initial.get(field) or 0
+        return form.fields[field].to_python(value) or 0
+
+    def save_model(self, request, obj, form, change):
+        if not change:
+            super().save_model(request, obj, form, change)
+            record_balances([obj], MovementSource.ADMIN)
+            return
+
+        deltas = {field: (form.cleaned_data[field] or 0) - self.opened_value(form, field)
+                  for field in StockField.values if field in form.changed_data}
+        if not deltas:
+            super().save_model(request, obj, form, change)
+            return
+        # The counters are changed by the differences with F() increments, so orders placed
+        # while the form was open are not overwritten
+        obj.save(update_fields=[field.name for field in obj._meta.concrete_fields
+                                if not field.primary_key and field.name not in StockField.values])
+        adjust_stock(obj.pk, deltas, MovementSource.ADMIN)
+        obj.refresh_from_db(fields=list(deltas))
+
+    @admin.action(description='Принять поставку')
+    def receive_shipment(self, request, queryset):
+        """
+        Asks for the received quantities of the selected products, the ordered ones by default,
+        and queues the allocation of the shipment to the waiting preorders.
+        """
+        products = list(queryset.select_related(None).order_by('title').only('pk', 'title', 'product_code', 'ordered', 'preorder_count'))
+        if 'apply' in request.POST:
+            try:
+                quantities = {product.pk: int(request.POST.get(f'received-{product.pk}') or 0) for product in products}
+            except ValueError:
+                self.message_user(request, 'Количество должно быть целым числом', messages.ERROR)
+                return None
+            received = {pk: quantity for pk, quantity in quantities.items() if quantity > 0}
+            try:
+                process_shipment.delay(received)
+            except Exception as e:
+                # Without the broker the shipment is processed in the request
+                logger.error(f'Не удалось запустить обработку поставки: {e}')
+                process_shipment(received)
+            self.message_user(request, f'Поставка принята, товаров: {len(received)}')
+            return None
+
+        context = {
+            **self.admin_site.each_context(request),
+            'title': 'Принять поставку',
+            'opts': self.model._meta,
+            'products': products,
+            'action_checkbox_name': helpers.ACTION_CHECKBOX_NAME,
+        }
+        return TemplateResponse(request, 'admin/vitamins/vitamin/receive_shipment.html', context)
 
     @admin.display(description='Added image')
     def vitamin_photo(self, vitamin: Vitamin):
-        return mark_safe(
-            f"<a href='{vitamin.images.first().image.url if vitamin.images.first() else vitamin.pk}'>"
-            f"<img src='{vitamin.images.first().image.url if vitamin.images.first() else vitamin.pk}'"
-            f" alt='{vitamin.title}' width='75'></a>")
+        return thumbnail(getattr(vitamin, 'main_image', None), vitamin.title)
 
 
 @admin.register(Tag)
@@ -79,3 +228,21 @@ class DeliveryRequestAdmin(admin.ModelAdmin):
     list_display = ('id', 'name', 'email', 'title', 'url')
     list_display_links = ('id', 'name')
     fields = ('name', 'email', 'title', 'url', 'comment')
+
+
+@admin.register(StockMovement)
+class StockMovementAdmin(admin.ModelAdmin):
+    list_display = ('id', 'created_at', 'product', 'field', 'delta', 'source', 'reference_id')
+    list_filter = ('source', 'field')
+    list_select_related = ('product',)
+    search_fields = ('product__title', 'product__product_code')
+
+    # The ledger is append-only, movements are recorded by vitamins.stock
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class InternetStoreMainConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'vitamins'
+
+    def ready(self):
+        import vitamins.signals
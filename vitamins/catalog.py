@@ -0,0 +1,216 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from django.db import transaction
+
+from .images import prepare_image
+from .models import Brand, Category, MovementSource, Tag, Vitamin, VitaminImage
+from .stock import record_balances
+
+BATCH_SIZE = 500
+
+# The manifest keys copied to the new products as they are
+VITAMIN_FIELDS = ('title', 'price', 'count', 'ordered', 'discount', 'percent', 'weight', 'packaging', 'unit',
+                  'content', 'short_content')
+REQUIRED_FIELDS = ('product_code', 'title', 'category', 'packaging', 'unit')
+
+
+class SlugAllocator:
+    """
+    Makes unique slugs for new rows of a model the way its AutoSlugField does,
+    checking them against the slugs read once instead of a query per row.
+    """
+
+    def __init__(self, model):
+        self.field = model._meta.get_field('slug')
+        self.taken = set(model.objects.values_list('slug', flat=True))
+
+    def allocate(self, text: str) -> str:
+        base = self.field.slugify_function(text)[:self.field.max_length].strip('-') or 'item'
+        slug, number = base, 2
+        while slug in self.taken:
+            suffix = f'-{number}'
+            slug = f'{base[:self.field.max_length - len(suffix)].strip("-")}{suffix}'
+            number += 1
+        self.taken.add(slug)
+        return slug
+
+
+class CatalogReport:
+    def __init__(self):
+        self.counts = dict.fromkeys(('vitamins', 'skipped', 'brands', 'categories', 'tags', 'analogs', 'images'), 0)
+        self.errors = []
+
+    def error(self, line: int, message: str):
+        self.errors.append((line, message))
+
+
+def create_named(model, names, slugs: SlugAllocator, report: CatalogReport, counter: str) -> dict:
+    """
+    Returns the ids of the rows of a model with a `name` and a slug by name, creating the missing ones with one INSERT.
+    """
+    names = set(names)
+    if not names:
+        return {}
+    existing = dict(model.objects.filter(name__in=names).values_list('name', 'pk'))
+    missing = sorted(names - set(existing))
+    model.objects.bulk_create([model(name=name, slug=slugs.allocate(name)) for name in missing])
+    report.counts[counter] += len(missing)
+    existing.update(model.objects.filter(name__in=missing).values_list('name', 'pk'))
+    return existing
+
+
+def read_manifest(file, report: CatalogReport):
+    """
+    Yields the (line number, row) pairs of the valid rows of a JSONL manifest.
+    """
+    for line_number, line in enumerate(file, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            report.error(line_number, 'неверный JSON')
+            continue
+        missing = [field for field in REQUIRED_FIELDS if not isinstance(row, dict) or row.get(field) in (None, '')]
+        if missing:
+            report.error(line_number, f'нет полей: {", ".join(missing)}')
+            continue
+        row['product_code'] = str(row['product_code'])
+        yield line_number, row
+
+
+class CatalogLoader:
+    """
+    Creates the products of a JSONL manifest with their brands, categories, tags, analogs and images
+    with a fixed number of statements per batch of rows.
+
+    Products whose `product_code` already exists are skipped, so loading a manifest again creates nothing.
+    """
+
+    def __init__(self, image_dir: str | None = None, workers: int | None = None, batch_size: int = BATCH_SIZE):
+        self.image_dir = image_dir
+        self.workers = workers
+        self.batch_size = batch_size
+        self.report = CatalogReport()
+        self.slugs = {model: SlugAllocator(model) for model in (Brand, Category, Tag, Vitamin)}
+        self.analogs = []  # (vitamin id, analog product codes)
+        self.images = []  # (manifest line, vitamin id, slug, image file names)
+
+    def load(self, file) -> CatalogReport:
+        rows = read_manifest(file, self.report)
+        while batch := list(islice(rows, self.batch_size)):
+            with transaction.atomic():
+                self.load_batch(batch)
+        with transaction.atomic():
+            self.link_analogs()
+        self.load_images()
+        return self.report
+
+    def load_batch(self, batch):
+        codes = [row['product_code'] for _, row in batch]
+        existing = set(Vitamin.objects.filter(product_code__in=codes).values_list('product_code', flat=True))
+        rows, lines = {}, {}
+        for line, row in batch:
+            if row['product_code'] in existing or row['product_code'] in rows:
+                self.report.counts['skipped'] += 1
+            else:
+                rows[row['product_code']] = row
+                lines[row['product_code']] = line
+        if not rows:
+            return
+
+        brands = create_named(Brand, {row['brand'] for row in rows.values() if row.get('brand')},
+                              self.slugs[Brand], self.report, 'brands')
+        categories = create_named(Category, {row['category'] for row in rows.values()},
+                                  self.slugs[Category], self.report, 'categories')
+        tags = create_named(Tag, {tag for row in rows.values() for tag in row.get('tags') or ()},
+                            self.slugs[Tag], self.report, 'tags')
+
+        Vitamin.objects.bulk_create([
+            Vitamin(product_code=code, slug=self.slugs[Vitamin].allocate(row['title']),
+                    brand_id=brands.get(row.get('brand')), cat_id=categories[row['category']],
+                    **{field: row[field] for field in VITAMIN_FIELDS if row.get(field) is not None})
+            for code, row in rows.items()
+        ], batch_size=self.batch_size)
+        vitamins = {vitamin.product_code: vitamin for vitamin in
+                    Vitamin.objects.filter(product_code__in=rows).only('pk', 'product_code', 'slug', 'count',
+                                                                       'ordered', 'preorder_count', 'total_sold')}
+        self.report.counts['vitamins'] += len(vitamins)
+        record_balances(vitamins.values(), MovementSource.IMPORT)
+
+        Vitamin.tags.through.objects.bulk_create([
+            Vitamin.tags.through(vitamin_id=vitamins[code].pk, tag_id=tags[tag])
+            for code, row in rows.items() for tag in set(row.get('tags') or ())
+        ], batch_size=self.batch_size, ignore_conflicts=True)
+
+        for code, row in rows.items():
+            vitamin = vitamins[code]
+            if row.get('analogs'):
+                self.analogs.append((vitamin.pk, [str(analog) for analog in row['analogs']]))
+            if row.get('images'):
+                self.images.append((lines[code], vitamin.pk, vitamin.slug, row['images']))
+
+    def link_analogs(self):
+        """
+        Links the analogs once all products exist, so a product may refer to one later in the manifest.
+        """
+        codes = {code for _, analog_codes in self.analogs for code in analog_codes}
+        ids = {}
+        for chunk in batched(sorted(codes), self.batch_size):
+            ids.update(Vitamin.objects.filter(product_code__in=chunk).values_list('product_code', 'pk'))
+        links = [Vitamin.analog.through(from_vitamin_id=pk, to_vitamin_id=ids[code])
+                 for pk, analog_codes in self.analogs for code in set(analog_codes) if code in ids and ids[code] != pk]
+        Vitamin.analog.through.objects.bulk_create(links, batch_size=self.batch_size, ignore_conflicts=True)
+        self.report.counts['analogs'] += len(links)
+
+    def load_images(self):
+        """
+        Scales the images of the new products in a process pool, see `vitamins.images`,
+        and creates their rows with one INSERT per batch, the first image of a product being the main one.
+        """
+        if not self.image_dir or not self.images:
+            return
+        storage = VitaminImage._meta.get_field('image').storage
+        upload_to = VitaminImage._meta.get_field('image').upload_to
+        jobs = []
+        for line, vitamin_id, slug, names in self.images:
+            for index, name in enumerate(names):
+                jobs.append((line, VitaminImage(vitamin_id=vitamin_id, is_main=index == 0,
+                                                image=storage.get_available_name(f'{upload_to}{slug}-{index + 1}.jpg')),
+                             os.path.join(self.image_dir, name)))
+        paths = [(source, storage.path(image.image.name)) for _, image, source in jobs]
+
+        if self.workers == 0:
+            errors = [call(prepare_image, *path) for path in paths]
+        else:
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                errors = [future.exception() for future in [pool.submit(prepare_image, *path) for path in paths]]
+
+        images = []
+        for (line, image, source), error in zip(jobs, errors):
+            if error:
+                self.report.error(line, f'{source}: {error}')
+            else:
+                images.append(image)
+        VitaminImage.objects.bulk_create(images, batch_size=self.batch_size)
+        self.report.counts['images'] += len(images)
+
+
+def call(function, *args):
+    """
+    Calls the function and returns the exception it raised, or None.
+    """
+    try:
+        function(*args)
+    except Exception as e:
+        return e
+    return None
+
+
+def batched(items, size: int):
+    iterator = iter(items)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
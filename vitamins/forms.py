@@ -40,3 +40,15 @@ class RequestForDeliveryForm(forms.ModelForm):
     class Meta:
         model = DeliveryRequest
         fields = ['name', 'email', 'title', 'url', 'comment']
+
+
+class SupplierImportForm(forms.Form):
+    file = forms.FileField(label='Файл поставщика', help_text='CSV с заголовком или JSON, строки по артикулу '
+                                                                '(product_code, price, count, ordered, arrival_date, weight)')
+    dry_run = forms.BooleanField(label='Только проверить', required=False)
+
+    def clean_file(self):
+        file = self.cleaned_data['file']
+        if not file.name.lower().endswith(('.csv', '.json', '.jsonl')):
+            raise forms.ValidationError('Загрузите файл CSV или JSON')
+        return file
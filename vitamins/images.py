@@ -0,0 +1,25 @@
+import os
+
+from PIL import Image, ImageOps
+
+# The longest side of the stored product images
+MAX_IMAGE_SIZE = 1200
+
+
+def prepare_image(source: str, target: str) -> str:
+    """
+    Rotates an image by its EXIF orientation, scales it down to `MAX_IMAGE_SIZE` and saves it as JPEG.
+
+    Uses nothing but Pillow and the file system, so it can run in a worker process.
+
+    Returns:
+        str: The target path.
+    """
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        image.thumbnail((MAX_IMAGE_SIZE, MAX_IMAGE_SIZE))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        image.save(target, 'JPEG', quality=85, optimize=True)
+    return target
@@ -0,0 +1,17 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from vitamins.stock import compact_movements
+
+
+class Command(BaseCommand):
+    help = 'Replaces old stock movements with one balance movement per product and counter.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=90, help='Compact the movements older than this.')
+
+    def handle(self, *args, **options):
+        deleted = compact_movements(timezone.now() - timedelta(days=options['days']))
+        self.stdout.write(f'Compacted movements: {deleted}')
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from vitamins.supplier_import import ImportReport, import_supplier_file
+
+
+class Command(BaseCommand):
+    help = 'Imports prices, stock, arrival dates and weights of the products from a supplier CSV or JSON file ' \
+           'keyed by product_code.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=['csv', 'json'],
+                            help='The file format, guessed from the extension by default.')
+        parser.add_argument('--dry-run', action='store_true', help='Compare the file with the products only.')
+        parser.add_argument('--report', help='Write the changed, unknown and invalid rows to this CSV file.')
+
+    def handle(self, *args, **options):
+        file_format = options['format'] or ('csv' if options['path'].lower().endswith('.csv') else 'json')
+        report_file = open(options['report'], 'w', encoding='utf-8', newline='') if options['report'] else None
+        try:
+            with open(options['path'], encoding='utf-8-sig', newline='') as file:
+                report = import_supplier_file(file, file_format, ImportReport(report_file), options['dry_run'])
+        finally:
+            if report_file:
+                report_file.close()
+        for status, count in report.counts.items():
+            self.stdout.write(f'{status}: {count}')
+        if options['dry_run']:
+            self.stdout.write('Dry run, nothing was changed')
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from vitamins.catalog import BATCH_SIZE, CatalogLoader
+
+
+class Command(BaseCommand):
+    help = 'Creates products with their brands, categories, tags, analogs and images from a JSONL manifest. ' \
+           'Products whose product_code already exists are skipped.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('manifest', help='One product per line: product_code, title, category, packaging, unit, '
+                                             'brand, tags, analogs (product codes), images (file names) '
+                                             'and the other product fields.')
+        parser.add_argument('--images', help='The directory of the image files named in the manifest.')
+        parser.add_argument('--workers', type=int,
+                            help='Image processes, the number of CPUs by default, 0 to process them in this one.')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        loader = CatalogLoader(options['images'], options['workers'], options['batch_size'])
+        with open(options['manifest'], encoding='utf-8') as file:
+            report = loader.load(file)
+        for line, message in report.errors:
+            self.stderr.write(f'Line {line}: {message}')
+        for name, count in report.counts.items():
+            self.stdout.write(f'{name}: {count}')
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from vitamins.stock import record_adjustments, restore_counters, stock_drift
+
+
+class Command(BaseCommand):
+    help = 'Compares the stock counters of the products with the sums of their movements in the stock ledger. ' \
+           'Run it with --fix-ledger once after deploying the ledger to record the opening balances.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix-ledger', action='store_true',
+                            help='Record adjustment movements, so the ledger matches the counters.')
+        parser.add_argument('--fix-counters', action='store_true',
+                            help='Set the counters to the sums of their movements.')
+
+    def handle(self, *args, **options):
+        if options['fix_ledger'] and options['fix_counters']:
+            raise CommandError('Use either --fix-ledger or --fix-counters')
+
+        drift = stock_drift()
+        for product_id, field, counter, total in drift:
+            self.stdout.write(f'Vitamin {product_id}: {field} = {counter}, ledger = {total}')
+        self.stdout.write(f'Counters with drift: {len(drift)}')
+
+        if drift and options['fix_ledger']:
+            record_adjustments(drift)
+            self.stdout.write('Adjustment movements recorded')
+        elif drift and options['fix_counters']:
+            restore_counters(drift)
+            self.stdout.write('Counters restored from the ledger')
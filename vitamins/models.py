@@ -8,7 +8,7 @@ from users.models import User
 
 class Tag(models.Model):
     name = models.CharField(max_length=100, unique=True)
-    slug = AutoSlugField(populate_from='name', unique=True, max_length=200)
+    slug = AutoSlugField(populate_from='name', unique=True, max_length=200, overwrite_on_add=False)
 
     def __str__(self):
         return self.name
@@ -23,7 +23,8 @@ class Vitamin(models.Model):
     time_update = models.DateTimeField(auto_now=True)
     discount = models.IntegerField(default=0)
     cat = models.ForeignKey('Category', on_delete=models.PROTECT, related_name='vitamins')
-    slug = AutoSlugField(populate_from='title', max_length=300, slugify_function=slugify)
+    # A slug set before the first save is kept, see vitamins.catalog
+    slug = AutoSlugField(populate_from='title', max_length=300, slugify_function=slugify, overwrite_on_add=False)
     tags = models.ManyToManyField(Tag, blank=True, related_name='vitamins')
     brand = models.ForeignKey('Brand', on_delete=models.PROTECT, blank=True,
                               default=None, null=True, related_name='vitamins')
@@ -53,29 +54,80 @@ class Vitamin(models.Model):
     def __str__(self):
         return self.title
 
+    def _change_stock(self, field: str, delta: int):
+        """
+        Changes a stock counter with an atomic F() increment recorded in the stock ledger, see `vitamins.stock`.
+        """
+        from vitamins.stock import adjust_stock
+
+        adjust_stock(self.pk, {field: delta})
+        self.refresh_from_db(fields=[field])
+
     def decrease_count(self, quantity):
-        if self.count >= quantity:
-            self.count -= quantity
-            self.save()
-        else:
-            raise ValueError("Недостаточно товара на складе")
+        """
+        Takes the quantity from the stock without counting it as sold, for corrections of the count.
+        """
+        from vitamins.stock import OutOfStock, adjust_stock
+
+        if not adjust_stock(self.pk, {StockField.COUNT: -quantity}, condition=models.Q(count__gte=quantity)):
+            raise OutOfStock([self])
+        self.refresh_from_db(fields=['count'])
 
     def adding_count(self, quantity):
-        self.count += quantity
-        self.save()
+        self._change_stock(StockField.COUNT, quantity)
 
     def adding_sold(self, quantity):
-        self.total_sold += quantity
-        self.save()
+        self._change_stock(StockField.TOTAL_SOLD, quantity)
 
     def adding_preorder_count(self, quantity):
-        self.preorder_count += quantity
-        self.save()
+        self._change_stock(StockField.PREORDER_COUNT, quantity)
 
     def decrease_preorder_count(self, quantity):
-        if self.preorder_count >= quantity:
-            self.preorder_count -= quantity
-            self.save()
+        from vitamins.stock import release_preorders
+
+        release_preorders([(None, self.pk, quantity)], MovementSource.ADMIN)
+        self.refresh_from_db(fields=['preorder_count'])
+
+
+class StockField(models.TextChoices):
+    COUNT = 'count', 'На складе'
+    ORDERED = 'ordered', 'Заказано у поставщика'
+    PREORDER_COUNT = 'preorder_count', 'Предзаказано'
+    TOTAL_SOLD = 'total_sold', 'Продано'
+
+
+class MovementSource(models.TextChoices):
+    ORDER = 'order', 'Заказ'
+    PREORDER = 'preorder', 'Предзаказ'
+    ADMIN = 'admin', 'Администратор'
+    IMPORT = 'import', 'Импорт'
+    ARRIVAL = 'arrival', 'Поступление'
+    ADJUSTMENT = 'adjustment', 'Сверка'
+    BALANCE = 'balance', 'Остаток'
+
+
+class StockMovement(models.Model):
+    """
+    An append-only record of a change of one of the stock counters of a product, see `vitamins.stock`.
+    The counters on Vitamin are the sums of their movements, checked by the `reconcile_stock` command.
+    """
+    product = models.ForeignKey(Vitamin, on_delete=models.DO_NOTHING, db_constraint=False,
+                                related_name='stock_movements')
+    field = models.CharField(max_length=20, choices=StockField.choices)
+    delta = models.IntegerField()
+    source = models.CharField(max_length=20, choices=MovementSource.choices)
+    # The order or preorder id for movements of these sources
+    reference_id = models.PositiveBigIntegerField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['product', 'field'], name='stock_movement_product_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.product_id} {self.field} {self.delta:+d} ({self.source})'
 
 
 class VitaminImage(models.Model):
@@ -90,7 +142,8 @@ class VitaminImage(models.Model):
 class Brand(models.Model):
     name = models.CharField(max_length=200)
     content = models.TextField(blank=True)
-    slug = AutoSlugField(populate_from='name', unique=True, max_length=300, slugify_function=slugify)
+    slug = AutoSlugField(populate_from='name', unique=True, max_length=300, slugify_function=slugify,
+                         overwrite_on_add=False)
     image = models.ImageField(upload_to='brand_images/', null=True, default=None)
 
     class Meta:
@@ -102,7 +155,8 @@ class Brand(models.Model):
 
 class Category(models.Model):
     name = models.CharField(max_length=100, db_index=True)
-    slug = AutoSlugField(populate_from='name', unique=True, max_length=300, slugify_function=slugify)
+    slug = AutoSlugField(populate_from='name', unique=True, max_length=300, slugify_function=slugify,
+                         overwrite_on_add=False)
 
     def get_absolut_url(self):
         return reverse('category', kwargs={'cat_slug': self.slug})
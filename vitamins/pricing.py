@@ -0,0 +1,42 @@
+from uuid import uuid4
+
+from django.core.cache import cache
+
+PRICING_VERSION_CACHE_KEY = 'pricing_version'
+
+
+def get_pricing_version() -> str:
+    """
+    Returns the current pricing version.
+
+    The version is an opaque token stored in the cache. It changes every time one of the
+    global pricing settings (percent, exchange rate, delivery cost) or a promo code is saved,
+    so anything computed from prices can tell whether it is still valid.
+    """
+    return cache.get_or_set(PRICING_VERSION_CACHE_KEY, lambda: uuid4().hex, None)
+
+
+def bump_pricing_version() -> str:
+    """
+    Invalidates everything computed with the previous pricing version.
+    """
+    version = uuid4().hex
+    cache.set(PRICING_VERSION_CACHE_KEY, version, None)
+    return version
+
+
+def get_price_settings() -> tuple:
+    """
+    Returns the global markup percent, exchange rate and delivery cost per kg.
+
+    The values are cached under the current pricing version, so they are read
+    from the database once per change instead of on every price calculation.
+    """
+    from vitamins.models import Percent, ExchangeRate, DeliveryCost
+
+    def load():
+        return (Percent.objects.all().first().percent,
+                ExchangeRate.objects.all().first().rate,
+                DeliveryCost.objects.all().first().cost_per_kg)
+
+    return cache.get_or_set(f'price_settings:{get_pricing_version()}', load, 60 * 60)
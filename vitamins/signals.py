@@ -0,0 +1,12 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from vitamins.models import Percent, ExchangeRate, DeliveryCost
+from vitamins.pricing import bump_pricing_version
+
+
+@receiver([post_save, post_delete], sender=Percent)
+@receiver([post_save, post_delete], sender=ExchangeRate)
+@receiver([post_save, post_delete], sender=DeliveryCost)
+def pricing_settings_changed(sender, instance, **kwargs):
+    bump_pricing_version()
@@ -0,0 +1,238 @@
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Q, Sum, Value, When
+
+from .models import MovementSource, StockField, StockMovement, Vitamin
+
+
+class OutOfStock(ValueError):
+    """
+    Raised when there is not enough stock for some of the products. Nothing is changed in that case.
+    """
+
+    def __init__(self, products=()):
+        self.products = list(products)
+        titles = ', '.join(product.title for product in self.products)
+        super().__init__(f"Недостаточно товара на складе для {titles}" if titles else "Недостаточно товара на складе")
+
+
+def quantity_case(quantities: dict) -> Case:
+    """
+    Returns a CASE expression mapping product ids to the given quantities, for updating several rows at once.
+    """
+    return Case(*[When(pk=pk, then=Value(quantity)) for pk, quantity in quantities.items()],
+                default=Value(0), output_field=IntegerField())
+
+
+def lock_products(product_ids):
+    """
+    Locks the product rows in primary key order, so concurrent stock updates can not deadlock.
+    Does nothing on databases without row locks.
+    """
+    list(Vitamin.objects.select_for_update().filter(pk__in=product_ids).order_by('pk').values_list('pk', flat=True))
+
+
+def sum_lines(lines) -> dict:
+    """
+    Sums the quantities of the stock lines per product. A line is a (reference id, product id, quantity) tuple,
+    the reference being the order or preorder the quantity belongs to, or None.
+    """
+    quantities = defaultdict(int)
+    for _, product_id, quantity in lines:
+        quantities[product_id] += quantity
+    return {pk: quantity for pk, quantity in quantities.items() if quantity}
+
+
+def change_stock(changes: dict, source: str, condition: Q | None = None) -> int:
+    """
+    Applies the changes of the stock counters with one UPDATE of F() increments and records
+    them in the ledger with one INSERT.
+
+    Args:
+        changes: Maps counter names (`StockField`) to lists of (reference id, product id, delta) lines.
+        source: The `MovementSource` of the changes.
+        condition: Updates only the products matching it, if given.
+
+    Returns:
+        int: The number of updated products.
+    """
+    changes = {field: [line for line in lines if line[2]] for field, lines in changes.items()}
+    deltas = {field: sum_lines(lines) for field, lines in changes.items()}
+    product_ids = set().union(*deltas.values())
+    if not product_ids:
+        return 0
+
+    products = Vitamin.objects.filter(pk__in=product_ids)
+    if condition is not None:
+        products = products.filter(condition)
+    updated = products.update(**{field: F(field) + quantity_case(field_deltas)
+                                 for field, field_deltas in deltas.items() if field_deltas})
+    if not updated:
+        return 0
+    StockMovement.objects.bulk_create([
+        StockMovement(product_id=product_id, field=field, delta=delta, source=source, reference_id=reference_id)
+        for field, lines in changes.items() for reference_id, product_id, delta in lines
+    ])
+    return updated
+
+
+def negate(lines) -> list:
+    return [(reference_id, product_id, -quantity) for reference_id, product_id, quantity in lines]
+
+
+def take_stock(lines, source: str = MovementSource.ORDER):
+    """
+    Takes the quantities of products from the stock and adds them to the sold counts.
+
+    All products are updated with a single conditional UPDATE ... WHERE count >= quantity,
+    so placing an order takes the same number of statements whatever the number of lines.
+
+    Raises:
+        OutOfStock: If any of the products is short. The stock is left unchanged.
+    """
+    lines = list(lines)
+    quantities = sum_lines(lines)
+    if not quantities:
+        return
+
+    in_stock = Q()
+    for pk, quantity in quantities.items():
+        in_stock |= Q(pk=pk, count__gte=quantity)
+
+    try:
+        with transaction.atomic():
+            lock_products(quantities)
+            updated = change_stock({StockField.COUNT: negate(lines), StockField.TOTAL_SOLD: lines}, source, in_stock)
+            if updated != len(quantities):
+                raise OutOfStock
+    except OutOfStock:
+        products = Vitamin.objects.filter(pk__in=quantities).only('title', 'count').in_bulk()
+        raise OutOfStock([product for pk, product in sorted(products.items())
+                          if product.count < quantities[pk]]) from None
+
+
+def return_stock(lines, source: str = MovementSource.ORDER):
+    """
+    Returns the quantities of products to the stock.
+    """
+    change_stock({StockField.COUNT: list(lines)}, source)
+
+
+def reserve_preorders(lines, source: str = MovementSource.PREORDER):
+    """
+    Adds the quantities of products to the preordered and sold counts.
+    """
+    lines = list(lines)
+    change_stock({StockField.PREORDER_COUNT: lines, StockField.TOTAL_SOLD: lines}, source)
+
+
+def release_preorders(lines, source: str = MovementSource.PREORDER):
+    """
+    Decreases the preordered quantities of products.
+    A product whose preorder count is less than its quantity is left unchanged.
+    """
+    lines = list(lines)
+    quantities = sum_lines(lines)
+    if not quantities:
+        return
+    with transaction.atomic():
+        lock_products(quantities)
+        preorder_counts = dict(Vitamin.objects.filter(pk__in=quantities).values_list('pk', 'preorder_count'))
+        lines = [line for line in lines if preorder_counts.get(line[1], 0) >= quantities[line[1]]]
+        change_stock({StockField.PREORDER_COUNT: negate(lines)}, source)
+
+
+def adjust_stock(product_id: int, deltas: dict, source: str = MovementSource.ADMIN, reference_id=None,
+                 condition: Q | None = None) -> bool:
+    """
+    Changes the stock counters of a product by the deltas, a map of `StockField` names to amounts.
+    With `condition`, changes them only if the product matches it. Returns True if the product was changed.
+    """
+    return bool(change_stock({field: [(reference_id, product_id, delta)] for field, delta in deltas.items()},
+                             source, condition))
+
+
+def record_balances(products, source: str = MovementSource.BALANCE):
+    """
+    Records the current counters of new products in the ledger, without changing them.
+    """
+    StockMovement.objects.bulk_create([
+        StockMovement(product_id=product.pk, field=field, delta=getattr(product, field), source=source)
+        for product in products for field in StockField.values if getattr(product, field)
+    ])
+
+
+def ledger_totals(product_ids=None) -> dict:
+    """
+    Returns the sums of the movements as a map of (product id, field) to amounts, with one GROUP BY.
+    """
+    movements = StockMovement.objects.order_by()
+    if product_ids is not None:
+        movements = movements.filter(product_id__in=product_ids)
+    return {(product_id, field): total for product_id, field, total in
+            movements.values('product_id', 'field').annotate(total=Sum('delta'))
+            .values_list('product_id', 'field', 'total')}
+
+
+def stock_drift(product_ids=None) -> list:
+    """
+    Compares the counters of the products with the sums of their movements.
+
+    Returns:
+        list: (product id, field, counter, ledger total) tuples of the counters that differ.
+    """
+    totals = ledger_totals(product_ids)
+    products = Vitamin.objects.order_by('pk')
+    if product_ids is not None:
+        products = products.filter(pk__in=product_ids)
+    drift = []
+    for product in products.values('pk', *StockField.values).iterator(chunk_size=2000):
+        for field in StockField.values:
+            total = totals.get((product['pk'], field), 0)
+            if product[field] != total:
+                drift.append((product['pk'], field, product[field], total))
+    return drift
+
+
+def compact_movements(before) -> int:
+    """
+    Replaces the movements created before the moment with one balance movement per product and counter,
+    so the ledger stays small while its sums stay the same.
+
+    Returns:
+        int: The number of removed movements.
+    """
+    with transaction.atomic():
+        old = StockMovement.objects.filter(created_at__lt=before)
+        totals = list(old.order_by().values('product_id', 'field').annotate(total=Sum('delta'))
+                      .values_list('product_id', 'field', 'total'))
+        deleted, _ = old.delete()
+        StockMovement.objects.bulk_create([
+            StockMovement(product_id=product_id, field=field, delta=total, source=MovementSource.BALANCE)
+            for product_id, field, total in totals if total
+        ])
+    return deleted
+
+
+def record_adjustments(drift):
+    """
+    Records the differences found by `stock_drift` in the ledger, so its sums match the counters again.
+    """
+    StockMovement.objects.bulk_create([
+        StockMovement(product_id=product_id, field=field, delta=counter - total, source=MovementSource.ADJUSTMENT)
+        for product_id, field, counter, total in drift
+    ])
+
+
+def restore_counters(drift):
+    """
+    Sets the counters that differ to the sums of their movements, one UPDATE per counter.
+    """
+    by_field = defaultdict(dict)
+    for product_id, field, counter, total in drift:
+        by_field[field][product_id] = total
+    with transaction.atomic():
+        lock_products({product_id for totals in by_field.values() for product_id in totals})
+        for field, totals in by_field.items():
+            Vitamin.objects.filter(pk__in=totals).update(**{field: quantity_case(totals)})
@@ -0,0 +1,181 @@
+import csv
+import json
+from datetime import date
+from itertools import chain, islice
+
+from django.db import transaction
+
+from .models import MovementSource, StockField, Vitamin
+from .pricing import bump_pricing_version
+from .stock import change_stock
+
+CHUNK_SIZE = 1000
+
+
+def parse_count(value) -> int:
+    value = int(value)
+    if value < 0:
+        raise ValueError(value)
+    return value
+
+
+def parse_weight(value) -> float:
+    value = float(str(value).replace(',', '.'))
+    if value < 0:
+        raise ValueError(value)
+    return value
+
+
+# The supplier columns with their parsers. Empty values leave the field unchanged
+IMPORT_FIELDS = {
+    'price': parse_count,
+    'count': parse_count,
+    'ordered': parse_count,
+    'arrival_date': lambda value: date.fromisoformat(str(value)),
+    'weight': parse_weight,
+}
+STOCK_FIELDS = (StockField.COUNT, StockField.ORDERED)
+PRICE_FIELDS = ('price', 'weight')
+
+
+class ImportReport:
+    """
+    Counts the results of an import and writes a line for every row that was not unchanged to a CSV file.
+    """
+    STATUSES = {'updated': 'Обновлен', 'unchanged': 'Без изменений', 'unknown': 'Нет товара', 'invalid': 'Ошибка'}
+
+    def __init__(self, file=None):
+        self.counts = dict.fromkeys(self.STATUSES, 0)
+        self.price_changed = False
+        self.writer = csv.writer(file) if file is not None else None
+        if self.writer:
+            self.writer.writerow(['Строка', 'Артикул', 'Результат', 'Подробности'])
+
+    def add(self, line: int, product_code: str, status: str, details: str = ''):
+        self.counts[status] += 1
+        if self.writer and status != 'unchanged':
+            self.writer.writerow([line, product_code, self.STATUSES[status], details])
+
+    @property
+    def total(self) -> int:
+        return sum(self.counts.values())
+
+
+def read_rows(file, file_format: str):
+    """
+    Yields the rows of a supplier file as dicts, one by one, from a CSV file with a header
+    (comma or semicolon separated), JSON Lines or a JSON array of objects.
+    """
+    if file_format == 'csv':
+        header = file.readline()
+        delimiter = ';' if header.count(';') > header.count(',') else ','
+        fieldnames = [name.strip() for name in next(csv.reader([header], delimiter=delimiter))]
+        yield from csv.DictReader(file, fieldnames=fieldnames, delimiter=delimiter)
+        return
+
+    first_line = file.readline()
+    if first_line.lstrip().startswith('['):
+        # A JSON array is not split into lines, so it is read as a whole
+        yield from json.loads(first_line + file.read())
+        return
+    for line in chain([first_line], file):
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # Reported as an invalid row
+                yield None
+
+
+def validate(row: dict) -> tuple:
+    """
+    Returns the product code and the parsed values of a row, raising ValueError for an invalid one.
+    """
+    if not isinstance(row, dict):
+        raise ValueError('строка не является объектом JSON')
+    product_code = str(row.get('product_code') or '').strip()
+    if not product_code:
+        raise ValueError('нет артикула')
+    values = {}
+    for field, parse in IMPORT_FIELDS.items():
+        value = row.get(field)
+        if value is None or str(value).strip() == '':
+            continue
+        try:
+            values[field] = parse(str(value).strip())
+        except ValueError:
+            raise ValueError(f'{field}: неверное значение «{value}»') from None
+    return product_code, values
+
+
+def import_chunk(rows, report: ImportReport, dry_run: bool = False):
+    """
+    Validates a chunk of (line number, row) pairs, compares them with the products read by one query
+    and applies the changes in one transaction: the prices, weights and arrival dates with one
+    `bulk_update`, the stock with one F() UPDATE recorded in the stock ledger.
+    """
+    parsed = {}
+    for line, row in rows:
+        try:
+            product_code, values = validate(row)
+        except ValueError as e:
+            product_code = row.get('product_code') if isinstance(row, dict) else None
+            report.add(line, str(product_code or ''), 'invalid', str(e))
+            continue
+        if product_code in parsed:
+            # A product repeated in the chunk takes its last row
+            report.add(parsed[product_code][0], product_code, 'invalid', f'повторяется в строке {line}')
+        parsed[product_code] = (line, values)
+
+    with transaction.atomic():
+        products = Vitamin.objects.filter(product_code__in=parsed).order_by('pk') \
+            .only('pk', 'product_code', *IMPORT_FIELDS)
+        if not dry_run:
+            # The stock is changed by differences from the locked values
+            products = products.select_for_update()
+        products = {product.product_code: product for product in products}
+
+        changed, stock_lines = [], {field: [] for field in STOCK_FIELDS}
+        for product_code, (line, values) in parsed.items():
+            product = products.get(product_code)
+            if product is None:
+                report.add(line, product_code, 'unknown')
+                continue
+            differences = {field: (getattr(product, field), value) for field, value in values.items()
+                           if getattr(product, field) != value}
+            if not differences:
+                report.add(line, product_code, 'unchanged')
+                continue
+            report.add(line, product_code, 'updated',
+                       '; '.join(f'{field}: {old} → {new}' for field, (old, new) in differences.items()))
+            report.price_changed |= any(field in PRICE_FIELDS for field in differences)
+            for field, (old, new) in differences.items():
+                if field in STOCK_FIELDS:
+                    stock_lines[field].append((None, product.pk, new - old))
+                else:
+                    setattr(product, field, new)
+            if any(field not in STOCK_FIELDS for field in differences):
+                changed.append(product)
+
+        if not dry_run:
+            fields = [field for field in IMPORT_FIELDS if field not in STOCK_FIELDS]
+            Vitamin.objects.bulk_update(changed, fields, batch_size=CHUNK_SIZE)
+            change_stock(stock_lines, MovementSource.IMPORT)
+
+
+def import_supplier_file(file, file_format: str, report: ImportReport, dry_run: bool = False) -> ImportReport:
+    """
+    Imports the prices, stock, arrival dates and weights of the products from a supplier file keyed
+    by `product_code`, streaming it in chunks of `CHUNK_SIZE` rows, so memory use does not depend on its size.
+
+    Every chunk is applied in its own transaction. If any price or weight changed, the pricing
+    version is bumped once at the end, so the prices are recalculated in a single pass.
+    """
+    # The header is line 1 of a CSV file
+    first_line = 2 if file_format == 'csv' else 1
+    rows = enumerate(read_rows(file, file_format), first_line)
+    while chunk := list(islice(rows, CHUNK_SIZE)):
+        import_chunk(chunk, report, dry_run)
+    if report.price_changed and not dry_run:
+        bump_pricing_version()
+    return report
@@ -0,0 +1,27 @@
+from datetime import timedelta
+
+from celery import shared_task
+from django.utils import timezone
+import logging
+
+from vitamins.stock import compact_movements, stock_drift
+
+
+# Получаем экземпляр логгера Django, который был настроен в settings.py
+logger = logging.getLogger('django')
+
+# Movements are kept for this long before they are compacted into balances
+STOCK_LEDGER_RETENTION = timedelta(days=90)
+
+
+@shared_task
+def compact_stock_ledger():
+    """
+    Compacts the old stock movements and logs the counters that drifted from the ledger.
+    """
+    deleted = compact_movements(timezone.now() - STOCK_LEDGER_RETENTION)
+    logger.info(f'Сжато движений склада: {deleted}')
+    drift = stock_drift()
+    if drift:
+        logger.warning(f'Расхождение остатков с журналом склада: {len(drift)} счетчиков')
+    return deleted
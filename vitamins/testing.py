@@ -0,0 +1,126 @@
+"""
+Helpers for the query budget tests of the catalog views and the API.
+
+`seed_catalog` creates a catalog of the given size in bulk, `QueryBudgetMixin` measures the SQL
+queries of a request, fails a test when they exceed the declared budget or grow with the page size,
+and appends the measurements to the JSON Lines file named by the QUERY_BUDGET_REPORT environment variable.
+
+The tests run on the configured database, so they run offline on SQLite
+and on a local PostgreSQL with settings that point to it.
+"""
+import io
+import json
+import os
+import random
+import time
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from .catalog import CatalogLoader
+from .models import Brand, DeliveryCost, ExchangeRate, Percent, Vitamin, VitaminImage
+
+# The number of products seeded, raise it to check the budgets on a larger catalog
+CATALOG_SIZE = int(os.getenv('QUERY_BUDGET_CATALOG_SIZE', 2000))
+
+
+def catalog_manifest(size: int, brands: int = 40, categories: int = 12, tags: int = 30, seed: int = 1):
+    """
+    Yields the rows of a generated catalog manifest, see `vitamins.catalog.read_manifest`.
+    Brands get products unevenly, so the brand pages differ in size.
+    """
+    generator = random.Random(seed)
+    for number in range(size):
+        yield {
+            'product_code': f'SEED{number:05}',
+            'title': f'Витамин {number}',
+            'category': f'Категория {number % categories}',
+            'brand': f'Бренд {min(int(generator.paretovariate(1.2)), brands) - 1}',
+            'packaging': generator.choice((30, 60, 90, 120, 180)),
+            'unit': generator.choice(('caps', 'tabs', 'softgels')),
+            'price': generator.randint(3, 80),
+            'count': generator.choice((0, 0, 1, 5, 20)),
+            'discount': generator.choice((0, 0, 0, 10, 25)),
+            'weight': round(generator.uniform(0.05, 0.6), 2),
+            'tags': [f'tag-{tag}' for tag in generator.sample(range(tags), 3)],
+            'analogs': [f'SEED{analog:05}' for analog in generator.sample(range(size), min(size, 2))],
+        }
+
+
+def seed_catalog(size: int = CATALOG_SIZE, images_per_product: int = 3):
+    """
+    Creates the pricing settings and a catalog of `size` products with brands, categories, tags, analogs
+    and image rows, the first image of a product being the main one. The image files are not created,
+    the pages only render their URLs.
+    """
+    Percent.objects.create(percent=10)
+    ExchangeRate.objects.create(rate=95)
+    DeliveryCost.objects.create(cost_per_kg=1500)
+    manifest = io.StringIO('\n'.join(json.dumps(row) for row in catalog_manifest(size)))
+    report = CatalogLoader().load(manifest)
+    VitaminImage.objects.bulk_create([
+        VitaminImage(vitamin_id=pk, image=f'vitamins/{slug}-{index + 1}.jpg', is_main=index == 0)
+        for pk, slug in Vitamin.objects.values_list('pk', 'slug') for index in range(images_per_product)
+    ], batch_size=1000)
+    brands = list(Brand.objects.all())
+    for brand in brands:
+        brand.image = f'brand_images/{brand.slug}.jpg'
+    Brand.objects.bulk_update(brands, ['image'])
+    return report
+
+
+class QueryBudgetMixin:
+    """
+    A TestCase mixin for checking the SQL queries of views with the test client.
+    """
+
+    def measure(self, url: str, data: dict | None = None) -> dict:
+        """
+        Requests the URL and returns the status, the number of queries and the SQL time in milliseconds.
+
+        The URL is requested once before, so the pricing settings and the cached template fragments are loaded
+        and the budget applies to the warm request every visitor but the first one gets.
+        """
+        self.client.get(url, data)
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            response = self.client.get(url, data)
+            elapsed = time.perf_counter() - started
+        return {
+            'url': url,
+            'params': data or {},
+            'status': response.status_code,
+            'queries': len(queries),
+            'sql_ms': round(sum(float(query['time']) for query in queries.captured_queries) * 1000, 3),
+            'total_ms': round(elapsed * 1000, 3),
+            'vendor': connection.vendor,
+            'sql': [query['sql'] for query in queries.captured_queries],
+        }
+
+    def assertQueryBudget(self, name: str, url: str, budget: int, data: dict | None = None) -> dict:
+        """
+        Fails if the request does not succeed or runs more than `budget` queries. Returns the measurement.
+        """
+        result = self.measure(url, data)
+        self.record(name, budget, result)
+        self.assertEqual(result['status'], 200, f'{name}: {url} returned {result["status"]}')
+        if result['queries'] > budget:
+            self.fail(f'{name}: {result["queries"]} queries, the budget is {budget}\n' + '\n'.join(result['sql']))
+        return result
+
+    def assertQueriesDoNotGrow(self, name: str, counts: dict):
+        """
+        Fails if the numbers of queries measured for different page sizes, `{size: queries}`, are not equal.
+        """
+        if len(set(counts.values())) > 1:
+            self.fail(f'{name}: queries grow with the page size: '
+                      + ', '.join(f'{size}: {queries}' for size, queries in sorted(counts.items())))
+
+    @staticmethod
+    def record(name: str, budget: int, result: dict):
+        path = os.getenv('QUERY_BUDGET_REPORT')
+        if not path:
+            return
+        with open(path, 'a', encoding='utf-8') as file:
+            row = {'name': name, 'budget': budget, **{key: value for key, value in result.items() if key != 'sql'}}
+            file.write(json.dumps(row, ensure_ascii=False) + '\n')
@@ -0,0 +1,350 @@
+from datetime import timedelta
+
+from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from users.models import User
+from .models import Brand, Category, MovementSource, StockField, StockMovement, Vitamin
+from .stock import OutOfStock, compact_movements, ledger_totals, record_adjustments, record_balances, \
+    release_preorders, restore_counters, return_stock, stock_drift, take_stock
+
+
+class StockLedgerTestCase(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Supplements', slug='supplements')
+        brand = Brand.objects.create(name='Nature Made', slug='nature-made')
+        self.vitamins = [Vitamin.objects.create(title=f"Vitamin {i}", price=100, count=10, preorder_count=2,
+                                                cat=category, brand=brand, product_code=f"VIT{i}", packaging=1,
+                                                unit='bottle')
+                         for i in range(2)]
+        record_balances(self.vitamins)
+
+    def test_movements_are_recorded_with_their_source(self):
+        take_stock([(1, self.vitamins[0].pk, 3), (1, self.vitamins[1].pk, 1)])
+        return_stock([(1, self.vitamins[0].pk, 3)])
+        release_preorders([(7, self.vitamins[1].pk, 2)], MovementSource.PREORDER)
+
+        self.vitamins[0].refresh_from_db()
+        self.assertEqual((self.vitamins[0].count, self.vitamins[0].total_sold), (10, 3))
+        self.assertEqual(StockMovement.objects.filter(source=MovementSource.ORDER, reference_id=1).count(), 5)
+        self.assertEqual(StockMovement.objects.get(source=MovementSource.PREORDER).delta, -2)
+        self.assertEqual(stock_drift(), [])
+
+    def test_short_stock_records_nothing(self):
+        movements = StockMovement.objects.count()
+        with self.assertRaises(OutOfStock):
+            take_stock([(1, self.vitamins[0].pk, 3), (1, self.vitamins[1].pk, 11)])
+        self.assertEqual(StockMovement.objects.count(), movements)
+
+    def test_decrease_count_is_not_a_sale(self):
+        self.vitamins[0].decrease_count(4)
+        self.assertEqual((self.vitamins[0].count, self.vitamins[0].total_sold), (6, 0))
+        self.assertEqual(StockMovement.objects.get(source=MovementSource.ADMIN).delta, -4)
+
+        with self.assertRaises(OutOfStock):
+            self.vitamins[0].decrease_count(7)
+        self.vitamins[0].refresh_from_db()
+        self.assertEqual((self.vitamins[0].count, self.vitamins[0].total_sold), (6, 0))
+        self.assertEqual(stock_drift(), [])
+
+    def test_drift_is_detected_and_fixed(self):
+        Vitamin.objects.filter(pk=self.vitamins[0].pk).update(count=8)
+        drift = stock_drift()
+        self.assertEqual(drift, [(self.vitamins[0].pk, StockField.COUNT, 8, 10)])
+
+        restore_counters(drift)
+        self.vitamins[0].refresh_from_db()
+        self.assertEqual(self.vitamins[0].count, 10)
+
+        Vitamin.objects.filter(pk=self.vitamins[0].pk).update(count=8)
+        record_adjustments(stock_drift())
+        self.assertEqual(stock_drift(), [])
+
+    def test_compaction_keeps_the_sums(self):
+        take_stock([(1, self.vitamins[0].pk, 3)])
+        return_stock([(1, self.vitamins[0].pk, 1)])
+        totals = ledger_totals()
+        self.assertEqual(compact_movements(timezone.now() + timedelta(seconds=1)), 7)
+        self.assertEqual(ledger_totals(), totals)
+        self.assertEqual(StockMovement.objects.filter(product=self.vitamins[0]).count(), 3)
+
+    def test_admin_changes_counters_by_the_difference(self):
+        admin_user = User.objects.create_superuser(username='admin', password='adminpass', email='admin@test.com')
+        self.client.force_login(admin_user)
+        url = reverse('admin:vitamins_vitamin_change', args=[self.vitamins[0].pk])
+        form = self.client.get(url).context['adminform'].form
+        data = {name: value for name, value in form.initial.items() if value is not None and name != 'analog'}
+        data.update({f'initial-{field}': form.initial[field] for field in StockField.values})
+        data.update({'tags': [], 'count': 15})
+
+        # An order placed while the form is open
+        take_stock([(1, self.vitamins[0].pk, 2)])
+        response = self.client.post(url, data)
+        self.assertEqual(response.status_code, 302)
+
+        self.vitamins[0].refresh_from_db()
+        self.assertEqual(self.vitamins[0].count, 13)
+        self.assertEqual(StockMovement.objects.get(source=MovementSource.ADMIN).delta, 5)
+        self.assertEqual(stock_drift(), [])
+
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from .models import VitaminImage
+
+
+class VitaminAdminQueriesTestCase(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name='Supplements', slug='supplements')
+        self.admin_user = User.objects.create_superuser(username='admin', password='adminpass', email='admin@test.com')
+        self.client.force_login(self.admin_user)
+
+    def add_vitamins(self, number: int):
+        for i in range(Vitamin.objects.count(), Vitamin.objects.count() + number):
+            brand = Brand.objects.create(name=f'Brand {i}', slug=f'brand-{i}')
+            vitamin = Vitamin.objects.create(title=f"Vitamin {i}", price=100, cat=self.category, brand=brand,
+                                             product_code=f"VIT{i}", packaging=1, unit='bottle')
+            VitaminImage.objects.create(vitamin=vitamin, image=f'vitamins_images/{i}.jpg', is_main=True)
+            VitaminImage.objects.create(vitamin=vitamin, image=f'vitamins_images/{i}-back.jpg')
+
+    def changelist_queries(self) -> int:
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('admin:vitamins_vitamin_changelist'))
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_changelist_queries_do_not_grow_with_rows(self):
+        self.add_vitamins(1)
+        one_row = self.changelist_queries()
+        self.add_vitamins(6)
+        response = self.client.get(reverse('admin:vitamins_vitamin_changelist'))
+        self.assertContains(response, "src='/media/vitamins_images/6.jpg'")
+        self.assertNotContains(response, '6-back.jpg')
+        self.assertEqual(self.changelist_queries(), one_row)
+
+
+import csv
+import io
+import json
+import tempfile
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import override_settings
+from .pricing import get_pricing_version
+from .supplier_import import ImportReport, import_supplier_file
+
+
+class SupplierImportTestCase(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Supplements', slug='supplements')
+        self.vitamins = [Vitamin.objects.create(title=f"Vitamin {i}", price=10, count=5, weight=0.1, cat=category,
+                                                product_code=f"VIT{i}", packaging=1, unit='bottle')
+                         for i in range(3)]
+
+    def run_import(self, content: str, file_format: str = 'csv', dry_run: bool = False) -> tuple:
+        report_file = io.StringIO()
+        report = import_supplier_file(io.StringIO(content), file_format, ImportReport(report_file), dry_run)
+        return report, list(csv.reader(io.StringIO(report_file.getvalue())))
+
+    def test_csv_changes_are_diffed_and_applied(self):
+        version = get_pricing_version()
+        report, lines = self.run_import('product_code;price;count;arrival_date;weight\n'
+                                        'VIT0;12;5;;\n'
+                                        'VIT1;10;8;2026-11-01;0,2\n'
+                                        'VIT2;10;5;;0.1\n'
+                                        'NOPE;1;1;;\n'
+                                        'VIT0;abc;;;\n')
+        self.assertEqual(report.counts, {'updated': 2, 'unchanged': 1, 'unknown': 1, 'invalid': 1})
+        self.assertEqual([line[:3] for line in lines[1:]],
+                         [['6', 'VIT0', 'Ошибка'], ['2', 'VIT0', 'Обновлен'], ['3', 'VIT1', 'Обновлен'],
+                          ['5', 'NOPE', 'Нет товара']])
+        self.assertEqual(list(Vitamin.objects.order_by('pk').values_list('price', 'count', 'weight')),
+                         [(12, 5, 0.1), (10, 8, 0.2), (10, 5, 0.1)])
+        self.assertEqual(str(Vitamin.objects.get(pk=self.vitamins[1].pk).arrival_date), '2026-11-01')
+        self.assertEqual(list(StockMovement.objects.values_list('product_id', 'field', 'delta', 'source')),
+                         [(self.vitamins[1].pk, StockField.COUNT, 3, MovementSource.IMPORT)])
+        self.assertNotEqual(get_pricing_version(), version)
+
+    def test_dry_run_changes_nothing(self):
+        report, _ = self.run_import('product_code,price,count\nVIT0,20,1\n', dry_run=True)
+        self.assertEqual(report.counts['updated'], 1)
+        self.assertEqual(Vitamin.objects.get(pk=self.vitamins[0].pk).price, 10)
+        self.assertFalse(StockMovement.objects.exists())
+
+    def test_command_imports_json_lines(self):
+        output = io.StringIO()
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl', encoding='utf-8') as file:
+            file.write(json.dumps({'product_code': 'VIT2', 'ordered': 4}) + '\nnot json\n')
+            file.flush()
+            call_command('import_supplier_file', file.name, stdout=output)
+        self.assertIn('updated: 1', output.getvalue())
+        self.assertIn('invalid: 1', output.getvalue())
+        self.assertEqual(Vitamin.objects.get(pk=self.vitamins[2].pk).ordered, 4)
+
+    def test_admin_upload(self):
+        admin_user = User.objects.create_superuser(username='admin', password='adminpass', email='admin@test.com')
+        self.client.force_login(admin_user)
+        upload = SimpleUploadedFile('prices.csv', '\ufeffproduct_code,price\nVIT0,15\n'.encode())
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            response = self.client.post(reverse('admin:vitamins_vitamin_import'), {'file': upload})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['report'].counts['updated'], 1)
+        self.assertIn('/media/imports/supplier_', response.context['report_url'])
+        self.assertEqual(Vitamin.objects.get(pk=self.vitamins[0].pk).price, 15)
+
+
+import os
+
+from PIL import Image
+from .catalog import CatalogLoader
+from .models import Tag
+
+
+class CatalogLoaderTestCase(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.TemporaryDirectory()
+        self.image_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media_root.cleanup)
+        self.addCleanup(self.image_dir.cleanup)
+        Image.new('RGBA', (2400, 1200), 'red').save(os.path.join(self.image_dir.name, 'a.png'))
+        Brand.objects.create(name='Nature Made', slug='nature-made')
+        self.manifest = '\n'.join(json.dumps(row) for row in [
+            {'product_code': 'C1', 'title': 'Витамин C', 'category': 'Витамины', 'brand': 'Nature Made',
+             'packaging': 60, 'unit': 'caps', 'price': 10, 'count': 3, 'tags': ['immune', 'daily'],
+             'analogs': ['C2'], 'images': ['a.png', 'missing.png']},
+            {'product_code': 'C2', 'title': 'Витамин C', 'category': 'Витамины', 'brand': 'Now',
+             'packaging': 120, 'unit': 'caps', 'tags': ['immune']},
+            {'product_code': 'C3', 'title': 'No category', 'packaging': 1, 'unit': 'caps'},
+        ]) + '\nnot json\n'
+
+    def load(self, workers: int = 0):
+        with override_settings(MEDIA_ROOT=self.media_root.name):
+            return CatalogLoader(self.image_dir.name, workers).load(io.StringIO(self.manifest))
+
+    def test_catalog_is_created_in_bulk(self):
+        with CaptureQueriesContext(connection) as queries:
+            report = self.load()
+        self.assertLess(len(queries), 30)
+        self.assertEqual(report.counts, {'vitamins': 2, 'skipped': 0, 'brands': 1, 'categories': 1, 'tags': 2,
+                                         'analogs': 1, 'images': 1})
+        self.assertEqual([line for line, _ in report.errors], [3, 4, 1])
+
+        first, second = Vitamin.objects.order_by('product_code')
+        self.assertEqual((first.slug, second.slug), ('vitamin-c', 'vitamin-c-2'))
+        self.assertEqual(first.brand.slug, 'nature-made')
+        self.assertEqual(set(first.tags.values_list('name', flat=True)), {'immune', 'daily'})
+        self.assertEqual(list(first.analog.all()), [second])
+        self.assertEqual(ledger_totals([first.pk]), {(first.pk, StockField.COUNT): 3})
+
+        image = VitaminImage.objects.get()
+        self.assertTrue(image.is_main)
+        with Image.open(os.path.join(self.media_root.name, image.image.name)) as stored:
+            self.assertEqual((stored.format, stored.size), ('JPEG', (1200, 600)))
+
+    def test_loading_again_creates_nothing(self):
+        self.load(workers=2)
+        self.assertEqual(VitaminImage.objects.count(), 1)
+        report = self.load()
+        self.assertEqual(report.counts['skipped'], 2)
+        self.assertEqual(report.counts['vitamins'], 0)
+        self.assertEqual((Vitamin.objects.count(), Tag.objects.count(), VitaminImage.objects.count()), (2, 2, 1))
+
+
+
+from unittest import mock
+
+from django.core.cache import cache
+from .testing import QueryBudgetMixin, seed_catalog
+from .views import ShopVitamin
+
+
+class CatalogQueryBudgetTestCase(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        seed_catalog()
+        cls.brand = Brand.objects.get(name='Бренд 0')
+        cls.vitamin = Vitamin.objects.filter(count__gt=0, analog__isnull=False).select_related('brand') \
+            .order_by('pk').first()
+
+    def setUp(self):
+        cache.clear()
+
+    def test_home(self):
+        self.assertQueryBudget('home', reverse('home'), 2)
+
+    def test_vitamin(self):
+        self.assertQueryBudget('vitamin', self.vitamin.get_absolute_url(), 8)
+
+    def test_shop(self):
+        # The count, the page and its main images, the filtered brand is read once more
+        for name, data, budget in [('shop', {}, 3), ('shop-brand', {'brand': self.brand.slug}, 4),
+                                   ('shop-tag', {'tag': 'tag-1'}, 3), ('shop-discount', {'discount': '1'}, 3),
+                                   ('shop-search', {'query': 'Витамин 1'}, 3), ('shop-last-page', {'page': 'last'}, 3)]:
+            counts = {}
+            for size in (6, 48):
+                with mock.patch.object(ShopVitamin, 'paginate_by', size):
+                    result = self.assertQueryBudget(name, reverse('shop'), budget, data)
+                counts[size] = result['queries']
+                # The page is read with LIMIT, not the whole catalog
+                products = [sql for sql in result['sql'] if sql.startswith('SELECT "vitamins_vitamin"."id"')]
+                self.assertTrue(products and all('LIMIT' in sql for sql in products), name)
+            self.assertQueriesDoNotGrow(name, counts)
+
+
+from internet_store.metrics import REGISTRY, UNRESOLVED
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'internet_store.metrics.LocMemCache'}})
+class InstrumentationTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        seed_catalog(20)
+        cls.staff = User.objects.create_user(username='staff', password='password', is_staff=True)
+
+    def setUp(self):
+        cache.clear()
+        REGISTRY.reset()
+
+    def test_server_timing_for_staff(self):
+        self.client.force_login(self.staff)
+        header = self.client.get(reverse('home'))['Server-Timing']
+        self.assertRegex(header, r'^db;dur=[\d.]+;desc="\d+ queries", cache;desc="\d+ hits, \d+ misses", '
+                                 r'tpl;dur=[\d.]+, total;dur=[\d.]+$')
+
+    def test_no_server_timing_for_visitors(self):
+        self.assertNotIn('Server-Timing', self.client.get(reverse('home')))
+
+    def test_registry(self):
+        self.client.get(reverse('home'))
+        self.client.get(reverse('home'))
+        self.client.get('/no-such-page/')
+
+        self.assertEqual(REGISTRY.requests[('home', 'GET', 200)], 2)
+        self.assertEqual(REGISTRY.requests[(UNRESOLVED, 'GET', 404)], 1)
+        stats = REGISTRY.views['home']
+        self.assertEqual(sum(stats.buckets), 2)
+        self.assertGreater(stats.queries, 0)
+        self.assertGreater(stats.template_seconds, 0)
+        # The second request reads the fragments the first one cached
+        self.assertGreater(stats.cache_misses, 0)
+        self.assertGreater(stats.cache_hits, 0)
+
+    @override_settings(METRICS_ALLOWED_IPS=['127.0.0.1'])
+    def test_metrics_view(self):
+        self.client.get(reverse('home'))
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        body = response.content.decode()
+        self.assertIn('store_http_requests_total{view="home",method="GET",status="200"} 1\n', body)
+        self.assertIn('store_http_request_duration_seconds_bucket{view="home",le="+Inf"} 1\n', body)
+        self.assertIn('store_http_request_duration_seconds_count{view="home"} 1\n', body)
+        self.assertRegex(body, r'store_http_request_db_queries_total\{view="home"\} [1-9]')
+
+    def test_metrics_view_is_staff_only_by_default(self):
+        # The test client comes from 127.0.0.1, like every client behind a local reverse proxy
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 404)
+        self.client.force_login(self.staff)
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 200)
@@ -2,19 +2,18 @@ from typing import List
 
 from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.core.mail import send_mail
 from django.core.paginator import Paginator
 from django.db.models import Prefetch, Q
 from django.http import HttpResponseNotFound
 from django.shortcuts import render, get_object_or_404
-from django.template.loader import render_to_string
 from django.urls import reverse_lazy
-from django.utils.html import strip_tags
 from django.views.generic import ListView, DetailView, CreateView, TemplateView
 
 from internet_store import settings
+from orders.outbox import queue_email
 from .forms import SearchForm, RequestForDeliveryForm
-from .models import Category, Vitamin, Brand, Tag, ExchangeRate, DeliveryCost, VitaminImage, Percent, DeliveryRequest
+from .models import Category, Vitamin, Brand, Tag, VitaminImage, DeliveryRequest
+from .pricing import get_price_settings
 
 
 def calculate_price(vitamins: List[Vitamin] | Vitamin) -> List[Vitamin] | Vitamin:
@@ -24,9 +23,7 @@ def calculate_price(vitamins: List[Vitamin] | Vitamin) -> List[Vitamin] | Vitami
     Calculate final price and sale price if vitamin has discount
     Returns vitamin object or vitamins queryset
     """
-    percent = Percent.objects.all().first().percent
-    exchange_rate = ExchangeRate.objects.all().first().rate
-    delivery_cost = DeliveryCost.objects.all().first().cost_per_kg
+    percent, exchange_rate, delivery_cost = get_price_settings()
 
     if isinstance(vitamins, Vitamin):
         vitamins.final_price = round((vitamins.price * exchange_rate) * (1 + max(percent, vitamins.percent) / 100) +
@@ -155,13 +152,15 @@ class ShopVitamin(ListView):
         """
         Returns the context data to pass to the template.
 
-        Retrieves additional context data such as tags, categories, pagination details, and current filters,
-        and passes the data to the template.
+        Calculates prices for the vitamins of the page and retrieves additional context data such as tags,
+        categories, pagination details, and current filters, and passes the data to the template.
 
         Returns:
             dict: A dictionary containing the context data.
         """
         context = super().get_context_data(**kwargs)
+        # Only the products of the page are priced, pricing the queryset would load the whole catalog
+        calculate_price(context['vitamins'])
         context['tags'] = Tag.objects.all()
         context['cats'] = Category.objects.all()
         context['page_range'] = context['paginator'].get_elided_page_range(
@@ -185,10 +184,10 @@ class ShopVitamin(ListView):
         Returns the queryset of vitamins based on applied filters.
 
         Retrieves a queryset of vitamins from the database based on applied filters such as brand, category, tag,
-        discount, and search query. Calculates prices for the vitamins and returns the queryset.
+        discount, and search query. The prices are calculated for the page in `get_context_data`.
 
         Returns:
-            Queryset: A queryset of vitamins with calculated prices.
+            Queryset: A queryset of vitamins.
         """
         queryset = Vitamin.objects.select_related('brand').prefetch_related(
             Prefetch('images', queryset=VitaminImage.objects.filter(is_main=True), to_attr='main_images')
@@ -221,7 +220,7 @@ class ShopVitamin(ListView):
                                        Q(product_code__icontains=query) |
                                        Q(slug__icontains=query))
 
-        return calculate_price(queryset)
+        return queryset
 
 
 class RequestForDelivery(LoginRequiredMixin, CreateView):
@@ -240,7 +239,7 @@ class RequestForDelivery(LoginRequiredMixin, CreateView):
         """
         Handles the valid form submission.
 
-        Sets the requesting user, sends a confirmation email to the user and the admin,
+        Sets the requesting user, queues a confirmation email to the user and the admin,
         and displays a success message.
 
         Returns:
@@ -255,11 +254,7 @@ class RequestForDelivery(LoginRequiredMixin, CreateView):
         message = f'Ваш завка #{request_id} оформлена!!! В ближайшее время наш менеджер обработает ее и' \
                   f' свяжется с вами для подтверждения и уточнения деталей.'
 
-        html_message = render_to_string('email_template.html', {'message': message})
-
-        plain_message = strip_tags(html_message)
-        email_from = settings.EMAIL_HOST_USER
-        send_mail(subject, plain_message, email_from, [self.object.email, settings.MY_EMAIL], html_message=html_message)
+        queue_email(f'delivery-request-created:{request_id}', subject, message, [self.object.email, settings.MY_EMAIL])
         return response
 
     def get_context_data(self, *, object_list=None, **kwargs):